@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+"""
+
+Build an index of who has an ACL where from the backups written by
+backup_acls.py, and query it without touching the file system.
+
+Every named user and group entry of every ACL and default ACL in the backup
+becomes a row keyed by the principal, so "where does group X have an ACL"
+is an index lookup instead of a pass over the whole backup.
+
+   acl_index.py --build /data/acl/backups/fs0_20260101 -i fs0.idx
+   acl_index.py -i fs0.idx -g nfsnobody --prefix /data/proj
+   acl_index.py -i fs0.idx -u ckerner -a rw-- --count
+
+There is _NO_ support. Use it at your own risk.
+
+If you find a bug, fix it.  Then, send me the diff and I'll merge it into the code.
+
+"""
+
+from __future__ import print_function
+import sys
+import os
+import time
+import json
+import sqlite3
+from ssacl import *
+
+# Rows inserted per executemany() while building.
+INSERT_BATCH = 10000
+
+SCHEMA = [ 'CREATE TABLE meta ( key TEXT PRIMARY KEY, value TEXT )',
+           'CREATE TABLE principals ( id INTEGER PRIMARY KEY, kind TEXT, name TEXT )',
+           'CREATE TABLE paths ( id INTEGER PRIMARY KEY, path TEXT, type TEXT )',
+           'CREATE TABLE grants ( principal INTEGER, path INTEGER, dflt INTEGER, perms TEXT, effective TEXT )' ]
+
+# Created after the rows are loaded, which is much faster than keeping them up to date.
+INDEXES = [ 'CREATE UNIQUE INDEX principals_name ON principals ( kind, name )',
+            'CREATE INDEX grants_principal ON grants ( principal, path )' ]
+
+def parse_options( argv ):
+    """
+    This function handles the parsing of the command line arguments.
+
+    Args:
+      argv: A list of command line arguments, passed in from sys.argv
+
+    Returns
+      options: A dictionary of the command line option settings
+      args   : A list of files
+
+    """
+
+    import argparse
+    import textwrap
+    parser = argparse.ArgumentParser(
+                                     formatter_class = argparse.RawTextHelpFormatter,
+                                     prog = 'acl_index.py',
+                                     description = textwrap.dedent('''\
+                                             acl_index.py - Find where a user or group has an ACL
+
+                                             --build reads a backup written by backup_acls.py, in any format,
+                                             and writes an SQLite index of the named user and group entries of
+                                             every ACL and default ACL in it. The other options query the index:
+
+                                             rwx- acl  /data/proj/results
+                                             r-x- dacl /data/proj
+
+                                             '''),
+                                     epilog = textwrap.dedent('''\
+
+                                             Chad Kerner - ckerner@illinois.edu
+                                             Senior Storage Engineer, Storage Enabling Technologies
+                                             National Center for Supercomputing Applications
+                                             University of Illinois, Urbana-Champaign''')
+                                    )
+
+    parser.add_argument( "-i", "--index",
+                         dest = "index",
+                         default = None,
+                         action = 'store',
+                         help = "The index file. Default: %(default)s")
+
+    parser.add_argument( "--build",
+                         dest = "build",
+                         default = None,
+                         action = 'store',
+                         help = "Build the index from this backup file or prefix, replacing the index file. Default: %(default)s")
+
+    parser.add_argument( "-u", "--uid",
+                         dest = "uid",
+                         default = None,
+                         action = 'store',
+                         help = "Find the ACL entries of this user. Default: %(default)s")
+
+    parser.add_argument( "-g", "--gid",
+                         dest = "gid",
+                         default = None,
+                         action = 'store',
+                         help = "Find the ACL entries of this group. Default: %(default)s")
+
+    parser.add_argument( "-a", "--acl",
+                         dest = "acl_mask",
+                         default = None,
+                         action = 'store',
+                         help = "Only the entries granting at least these permissions, eg. rw--. Default: %(default)s")
+
+    parser.add_argument( "--prefix",
+                         dest = "prefix",
+                         default = None,
+                         action = 'store',
+                         help = "Only the paths at or below this directory. Default: %(default)s")
+
+    parser.add_argument( "-d", "--default",
+                         dest = "default",
+                         default = None,
+                         action = 'store_true',
+                         help = "Only the entries in default ACLs. Default: both")
+
+    parser.add_argument( "-A", "--access",
+                         dest = "default",
+                         action = 'store_false',
+                         help = "Only the entries in access ACLs. Default: both")
+
+    parser.add_argument( "-c", "--count",
+                         dest = "count",
+                         default = False,
+                         action = 'store_true',
+                         help = "Only print the number of entries found. Default: %(default)s")
+
+    parser.add_argument( "-j", "--json",
+                         dest = "json",
+                         default = False,
+                         action = 'store_true',
+                         help = "Print the entries as JSON lines. Default: %(default)s")
+
+    parser.add_argument( "--principals",
+                         dest = "principals",
+                         default = False,
+                         action = 'store_true',
+                         help = "List every user and group in the index with its number of entries. Default: %(default)s")
+
+    parser.add_argument( "-v", "--verbose",
+                         dest = "verbose",
+                         default = False,
+                         action = 'store_true',
+                         help = "Run in verbose mode. Reports progress and timings. Default: %(default)s")
+
+    options, args = parser.parse_known_args( argv )
+    return ( options, args )
+
+
+def acl_grants( acl, dflt=0 ):
+    """
+    The named entries of an ACL dict.
+
+    :param: The ACL dict, or None.
+    :param: 1 if it is a default ACL.
+    :return: A list of ( dflt, kind, name, perms, effective ) tuples. kind is
+             u or g.
+    """
+    grants = []
+    if not acl:
+       return grants
+    for ( kind, key ) in [ ( 'u', 'USERS' ), ( 'g', 'GROUPS' ) ]:
+        for ( name, entry ) in acl.get( key, {} ).items():
+            grants.append( ( dflt, kind, name, entry.get( 'PERMS' ), entry.get( 'EFFECTIVE' ) ) )
+    return grants
+
+
+def backup_entries( backup ):
+    """
+    Stream the paths of a backup with the named entries of their ACLs. In a
+    deduplicated backup the entries of each distinct ACL are worked out once
+    instead of rebuilding the ACL dicts for every file.
+
+    :param: The backup file or prefix.
+    :return: A generator of ( path, type, grants ) tuples, grants as
+             returned by acl_grants() for the ACL and default ACL together.
+    """
+    for name in backup_files( backup ):
+        first = ''
+        if name != '-':
+           lines = iter_backup_lines( name )
+           first = next( lines, '' )
+        if not first.startswith( DEDUP_HEADER ):
+           if name != '-':
+              lines.close()
+           for record in read_backup( name ):
+               yield ( record['path'], record.get( 'type' ), acl_grants( record.get( 'acl' ) ) + acl_grants( record.get( 'dacl' ), 1 ) )
+           continue
+
+        reader = dedup_backup_reader( lines )
+        known = {}
+        for ( path, inode, gen, ctime, kind, owner, group, aclid, daclid ) in reader:
+            grants = known.get( ( aclid, daclid ) )
+            if grants == None:
+               grants = []
+               if aclid != None:
+                  grants += acl_grants( json.loads( reader.acls[aclid] ) )
+               if daclid != None:
+                  grants += acl_grants( json.loads( reader.acls[daclid] ), 1 )
+               known[ ( aclid, daclid ) ] = grants
+            yield ( path, kind, grants )
+
+
+def build_index( backup, dbfile, verbose=False ):
+    """
+    Build the index of a backup. It is written next to dbfile and renamed
+    over it when complete, so queries never see a half built index.
+
+    :param: The backup file or prefix.
+    :param: The index file.
+    :param: Report progress on stderr.
+    :return: The number of ( paths, entries ) indexed.
+    """
+    tmpfile = '%s.%d.tmp' % ( dbfile, os.getpid() )
+    if os.path.exists( tmpfile ):
+       os.unlink( tmpfile )
+
+    db = sqlite3.connect( tmpfile )
+    db.execute( 'PRAGMA journal_mode = OFF' )
+    db.execute( 'PRAGMA synchronous = OFF' )
+    for statement in SCHEMA:
+        db.execute( statement )
+
+    start = time.time()
+    principals = {}
+    paths = []
+    grants = []
+    path_count = 0
+    grant_count = 0
+    report = 100000
+    for ( path, ftype, entries ) in backup_entries( backup ):
+        if not entries:
+           continue
+
+        path_count += 1
+        paths.append( ( path_count, path, ftype ) )
+        for ( dflt, kind, name, perms, effective ) in entries:
+            principal = principals.get( ( kind, name ) )
+            if principal == None:
+               principal = len( principals ) + 1
+               principals[ ( kind, name ) ] = principal
+            grants.append( ( principal, path_count, dflt, perms, effective ) )
+
+        if len( grants ) >= INSERT_BATCH:
+           db.executemany( 'INSERT INTO paths VALUES ( ?, ?, ? )', paths )
+           db.executemany( 'INSERT INTO grants VALUES ( ?, ?, ?, ?, ? )', grants )
+           grant_count += len( grants )
+           paths = []
+           grants = []
+           if verbose and path_count >= report:
+              print("Indexed %d paths in %d seconds" % ( path_count, time.time() - start ), file=sys.stderr)
+              report += 100000
+
+    db.executemany( 'INSERT INTO paths VALUES ( ?, ?, ? )', paths )
+    db.executemany( 'INSERT INTO grants VALUES ( ?, ?, ?, ?, ? )', grants )
+    grant_count += len( grants )
+    db.executemany( 'INSERT INTO principals VALUES ( ?, ?, ? )',
+                    [ ( principal, kind, name ) for ( ( kind, name ), principal ) in principals.items() ] )
+    db.executemany( 'INSERT INTO meta VALUES ( ?, ? )',
+                    [ ( 'backup', os.path.abspath( backup ) ), ( 'built', time.strftime( '%Y-%m-%d %H:%M:%S' ) ),
+                      ( 'paths', str( path_count ) ), ( 'entries', str( grant_count ) ) ] )
+    for statement in INDEXES:
+        db.execute( statement )
+    db.commit()
+    db.close()
+
+    os.rename( tmpfile, dbfile )
+    return ( path_count, grant_count )
+
+
+def like_pattern( mask ):
+    """
+    A LIKE pattern matching the permissions with at least the bits of mask
+    set, eg. r-x- gives r_x_.
+    """
+    return ''.join( [ char if char != '-' else '_' for char in mask[0:4] ] )
+
+
+def query_index( db, kind, name, prefix=None, mask=None, default=None ):
+    """
+    Find the entries of one principal.
+
+    :param: An sqlite3 connection to the index.
+    :param: u for a user, g for a group.
+    :param: The user or group name, as it appears in the ACLs.
+    :param: Only the paths at or below this directory.
+    :param: Only the entries granting at least these permissions.
+    :param: True for the default ACL entries only, False for the access ACL
+            entries only, None for both.
+    :return: A generator of ( path, type, dflt, perms, effective ) tuples,
+             sorted by path.
+    """
+    sql = 'SELECT p.path, p.type, g.dflt, g.perms, g.effective FROM principals n ' \
+          'JOIN grants g ON g.principal = n.id JOIN paths p ON p.id = g.path ' \
+          'WHERE n.kind = ? AND n.name = ?'
+    params = [ kind, name ]
+
+    if prefix:
+       # Everything below prefix/ sorts between prefix/ and prefix0.
+       prefix = prefix.rstrip( '/' )
+       sql += ' AND ( p.path = ? OR ( p.path >= ? AND p.path < ? ) )'
+       params += [ prefix, prefix + '/', prefix + '0' ]
+    if mask:
+       sql += ' AND g.perms LIKE ?'
+       params.append( like_pattern( mask ) )
+    if default != None:
+       sql += ' AND g.dflt = ?'
+       params.append( int( default ) )
+    sql += ' ORDER BY p.path, g.dflt'
+
+    for row in db.execute( sql, params ):
+        yield row
+
+
+def list_principals( db ):
+    """
+    :return: A list of ( kind, name, entries ) tuples.
+    """
+    return db.execute( 'SELECT n.kind, n.name, COUNT(*) FROM principals n JOIN grants g ON g.principal = n.id '
+                       'GROUP BY n.id ORDER BY n.kind, n.name' ).fetchall()
+
+
+if __name__ == '__main__':
+   ( options, args ) = parse_options( sys.argv[1:] )
+
+   start_time = time.time()
+   if options.index == None:
+      print("You must specify an index file.")
+      sys.exit(1)
+
+   if options.build:
+      if not backup_files( options.build ):
+         print("ERROR: Backup: %s not found!" % ( options.build ))
+         sys.exit(1)
+      ( path_count, grant_count ) = build_index( options.build, options.index, options.verbose )
+      if options.verbose:
+         print("Indexed %d entries on %d paths in %d seconds" % ( grant_count, path_count, time.time() - start_time ), file=sys.stderr)
+      sys.exit(0)
+
+   if not os.path.isfile( options.index ):
+      print("ERROR: Index: %s not found!" % ( options.index ))
+      sys.exit(1)
+   db = sqlite3.connect( options.index )
+
+   if options.principals:
+      for ( kind, name, count ) in list_principals( db ):
+          print("%s %-32s %d" % ( kind, name, count ))
+      sys.exit(0)
+
+   if options.uid == None and options.gid == None:
+      print("ERROR: Neither --uid or --gid was specified.")
+      sys.exit(1)
+
+   found = 0
+   for ( kind, name ) in [ ( 'u', options.uid ), ( 'g', options.gid ) ]:
+       if name == None:
+          continue
+       for ( path, ftype, dflt, perms, effective ) in query_index( db, kind, name, options.prefix, options.acl_mask, options.default ):
+           found += 1
+           if options.count:
+              continue
+           if options.json:
+              entry = {}
+              entry['path'] = path
+              entry['type'] = ftype
+              entry['principal'] = '%s:%s' % ( 'user' if kind == 'u' else 'group', name )
+              entry['default'] = bool( dflt )
+              entry['perms'] = perms
+              entry['effective'] = effective
+              print( json.dumps( entry, sort_keys=True ) )
+           else:
+              print("%s %-4s %s" % ( perms, 'dacl' if dflt else 'acl', path ))
+
+   if options.count:
+      print( found )
+   if options.verbose:
+      print("Found %d entries in %.3f seconds" % ( found, time.time() - start_time ), file=sys.stderr)
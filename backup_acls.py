@@ -18,6 +18,7 @@ from __future__ import print_function
 import sys
 import os
 import pprint
+import time
 from tempfile import mkstemp
 import json
 from ssacl import *
@@ -45,6 +46,17 @@ def parse_options( argv ):
                                      description = textwrap.dedent('''\
                                              backup_acls.py - Backup the ACLs on the files in the cluster
 
+                                             Reads the file list written by the mmapplypolicy LIST rule in
+                                             backup_acls.sh, fetches the ACL of every file, and the default
+                                             ACL of every directory, with a pool of workers and writes one
+                                             JSON record per line:
+
+                                             {"acl": {...}, "dacl": {...}, "inode": "...", "path": "...", "type": "d"}
+
+                                             With --format dedup each distinct ACL is written once and the
+                                             files refer to it by id, grouped by directory. --convert rewrites
+                                             an existing backup, in any format, in the chosen one.
+
                                              '''),
                                      epilog = textwrap.dedent('''\
 
@@ -62,11 +74,82 @@ def parse_options( argv ):
                          action = 'store',
                          help = "The file sysystem path to map to the specified group. Default: %(default)s")
 
+    parser.add_argument( "-o", "--output",
+                         dest = "output",
+                         default = '-',
+                         action = 'store',
+                         help = "The prefix of the backup files. The records are written to\nPREFIX.NNN.jsonl, or to stdout for -. Default: %(default)s")
+
+    parser.add_argument( "-j", "--jobs",
+                         dest = "jobs",
+                         default = 8,
+                         type = int,
+                         action = 'store',
+                         help = "The number of workers fetching ACLs. Default: %(default)s")
+
+    parser.add_argument( "-b", "--batch",
+                         dest = "batch",
+                         default = BATCH_SIZE,
+                         type = int,
+                         action = 'store',
+                         help = "The number of files each worker fetches per shell. Default: %(default)s")
+
+    parser.add_argument( "-s", "--shards",
+                         dest = "shards",
+                         default = 1,
+                         type = int,
+                         action = 'store',
+                         help = "Spread the records over this many files. Default: %(default)s")
+
+    parser.add_argument( "-z", "--gzip",
+                         dest = "compress",
+                         default = False,
+                         action = 'store_true',
+                         help = "Compress the backup files with gzip. Default: %(default)s")
+
+    parser.add_argument( "-F", "--format",
+                         dest = "format",
+                         default = 'jsonl',
+                         choices = [ 'jsonl', 'dedup' ],
+                         action = 'store',
+                         help = "The backup format. dedup writes PREFIX.NNN.dedup. Default: %(default)s")
+
+    parser.add_argument( "--convert",
+                         dest = "convert",
+                         default = None,
+                         action = 'store',
+                         help = "Convert this backup to --format instead of reading a file list. Default: %(default)s")
+
+    parser.add_argument( "-p", "--previous",
+                         dest = "previous",
+                         default = None,
+                         action = 'store',
+                         help = "An earlier backup to take unchanged entries from. Only files whose inode,\ngeneration or change time differ from it are fetched. Both are sorted by path\nin TMPDIR to match them up. The output is not in path order: fetched records\nare written as they come back and mixed in with the carried-forward ones. Default: %(default)s")
+
     parser.add_argument( "-v", "--verbose",
                          dest = "verbose",
                          default = False,
                          action = 'store_true',
-                         help = "Run in verbose mode. Default: %(default)s")
+                         help = "Run in verbose mode. Reports progress. Default: %(default)s")
+
+    parser.add_argument( "--backend",
+                         dest = "backend",
+                         default = os.environ.get( 'SSACL_BACKEND', 'mm' ),
+                         choices = [ 'mm', 'xattr' ],
+                         action = 'store',
+                         help = "How ACLs are read and written: mm runs mmgetacl and mmputacl, xattr uses the\nPOSIX ACL extended attributes in process. Default: %(default)s")
+
+    parser.add_argument( "--stats",
+                         dest = "stats",
+                         default = False,
+                         action = 'store_true',
+                         help = "Print the call counts and timings of each phase on stderr at exit. Default: %(default)s")
+
+    parser.add_argument( "--stats-file",
+                         dest = "stats_file",
+                         default = None,
+                         action = 'store',
+                         help = "Write the timings to this file every 30 seconds, in the Prometheus text\nformat when it ends in .prom and JSON otherwise. Default: %(default)s")
 
     parser.add_argument( "-d", "--debug",
                          dest = "debug",
@@ -78,32 +161,190 @@ def parse_options( argv ):
     return ( options, args )
 
 
+def policy_records( filename ):
+    """
+    Read the policy list file one line at a time.
+    """
+    pfile = open( filename, 'r' )
+    for line in pfile:
+        record = parse_policy_line( line )
+        if record != None:
+           yield record
+    pfile.close()
+
+
+def change_time( record ):
+    """
+    The change time from the SHOW fields. It is the last field in the policy
+    rule, and it contains a space.
+    """
+    return ' '.join( record['SHOW'][4:] )
+
+
+def sorted_policy_records( filename ):
+    """
+    Read the policy list file sorted by path, with bounded memory, the order
+    of previous_entries().
+    """
+    def entries():
+        for record in policy_records( filename ):
+            yield json.dumps( record['PATH'] ) + '\t' + json.dumps( record ) + '\n'
+
+    for line in sorted_lines( entries() ):
+        yield json.loads( line[line.index( '\t' ) + 1:] )
+
+
+def previous_entries( path ):
+    """
+    The entries of an earlier backup sorted by path, with bounded memory.
+    Each is a line of tab separated JSON: the path, the generation, the change
+    time, the inode and the record.
+
+    :param: The backup file or prefix.
+    :return: A generator of the lines, in order.
+    """
+    def entries():
+        for backup in read_backup( path ):
+            if backup.get( 'ctime' ):
+               fields = [ backup['path'], backup.get( 'gen' ), backup['ctime'], backup['inode'] ]
+               yield '\t'.join( [ json.dumps( field ) for field in fields ] ) + '\t' + json.dumps( backup, sort_keys=True ) + '\n'
+
+    return sorted_lines( entries() )
+
+
+def carry_forward( records, entries ):
+    """
+    Merge the policy records with the entries of an earlier backup, both
+    sorted by path, and find the files that did not change since.
+
+    :param: The policy records, from sorted_policy_records().
+    :param: The earlier backup, from previous_entries().
+    :return: A generator of ( record, line ) tuples. line is the earlier
+             backup line for the file when its inode, generation, change time
+             and path all match, otherwise None.
+    """
+    entry = next( entries, None )
+    for record in records:
+        key = json.dumps( record['PATH'] )
+        while entry != None and entry[0:entry.index( '\t' )] < key:
+           entry = next( entries, None )
+
+        line = None
+        if entry != None and entry[0:entry.index( '\t' )] == key:
+           ( path, gen, ctime, inode, backup ) = entry.rstrip( '\n' ).split( '\t' )
+           if json.loads( gen ) == record['GEN'] and json.loads( ctime ) == change_time( record ) and json.loads( inode ) == record['INODE']:
+              line = backup + '\n'
+        yield ( record, line )
+
+
+def file_type( record ):
+    """
+    The type of the file from the mode in the SHOW fields: d, f or l.
+    """
+    if len( record['SHOW'] ) > 2:
+       mode = record['SHOW'][2]
+       if mode.startswith('d'):
+          return 'd'
+       elif mode.startswith('l'):
+          return 'l'
+    return 'f'
+
+
+def fetch_records( records ):
+    """
+    The fetch stage. Get the ACLs, and the default ACLs of the directories,
+    for a batch of policy records with one shell.
+
+    :param: A list of policy records.
+    :return: A list of backup records.
+    """
+    paths = [ record['PATH'] for record in records ]
+    results = []
+    for ( record, result ) in zip( records, fetch_acls( paths, True, options.batch ) ):
+        ( fqpn, acls, default_acls, error ) = result
+        if error != None:
+           print("ERROR: %s: %s" % ( record['PATH'], error.strip() ), file=sys.stderr)
+           totals.add( 'failed' )
+           continue
+
+        backup = {}
+        backup['path'] = record['PATH']
+        backup['inode'] = record['INODE']
+        backup['gen'] = record['GEN']
+        backup['ctime'] = change_time( record )
+        backup['type'] = file_type( record )
+        backup['acl'] = acls
+        backup['dacl'] = default_acls
+        results.append( backup )
+    return results
+
+
+def write_record( backup ):
+    """
+    The write stage.
+    """
+    writer.write( backup )
+    if options.verbose and writer.count % 100000 == 0:
+       elapsed = time.time() - start_time
+       print("Backed up %d files in %d seconds" % ( writer.count, elapsed ), file=sys.stderr)
+
+
 if __name__ == '__main__':
    ( options, args ) = parse_options( sys.argv[1:] )
 
+   start_time = time.time()
+   totals = counters()
+
+   try:
+      set_backend( options.backend )
+   except OSError as e:
+      print("ERROR: %s" % ( e.strerror ))
+      sys.exit(1)
+
+   stats = None
+   if options.stats or options.stats_file:
+      stats = enable_stats()
+      if options.stats_file:
+         stats.start_writer( options.stats_file )
+
+   if options.convert:
+      writer = open_backup_writer( options.output, options.shards, options.compress, options.format )
+      for backup in read_backup( options.convert ):
+          writer.write( backup )
+      writer.close()
+      if options.verbose:
+         print("Converted %d files in %d seconds" % ( writer.count, time.time() - start_time ), file=sys.stderr)
+      sys.exit(0)
+
    if options.filename == None:
       print("You must specify a file to parse.")
       sys.exit(1)
 
-   pfile = open( options.filename, 'r' )
-   for line in pfile:
-       idx = line.find(' -- ') + 4
-       #idx = idx + 4 + 4
-       fqpn = line[idx:].rstrip()
-       #if options.verbose:
-       #   print("Processing: %s" % (fqpn))
+   writer = open_backup_writer( options.output, options.shards, options.compress, options.format )
 
+   pipe = acl_pipeline( [ ( 'fetch', fetch_records, options.jobs, options.batch ),
+                          ( 'write', write_record, 1 ) ],
+                        options.jobs * options.batch * 4 )
+   if options.previous:
+      records = carry_forward( sorted_policy_records( options.filename ), previous_entries( options.previous ) )
+   else:
+      records = ( ( record, None ) for record in policy_records( options.filename ) )
 
-       myacl = mmacls( fqpn )
-       acl = json.dumps( myacl.acls )
-       if options.verbose:
-          print("   ACL: %s" % ( acl ))
+   for ( record, line ) in records:
+       if line != None:
+          writer.write_line( record['PATH'], line )
+          totals.add( 'carried' )
+       else:
+          pipe.submit( record )
+   pipe.close()
+   writer.close()
 
-       if line.split()[5].startswith('d'):
-          myacl.get_default_acl()
-          dacl = json.dumps( myacl.default_acls )
-          if options.verbose:
-             print("  DACL: %s" % ( dacl ) )
+   failed = totals.get( 'failed' ) + sum( pipe.failed.values() )
+   if options.verbose:
+      print("Backed up %d files, %d carried forward, %d failed, in %d seconds" % ( writer.count, totals.get( 'carried' ), failed, time.time() - start_time ), file=sys.stderr)
 
-   pfile.close()
+   if options.stats:
+      print( stats.report(), file=sys.stderr )
 
+   if failed:
+      sys.exit(2)
@@ -29,7 +29,7 @@ mkdir -p ${BKUPDIR} &>/dev/null
 
 cat <<EOPOLICY >${POLICY_FILE}
 RULE 'listall' LIST 'all-files' DIRECTORIES_PLUS
-SHOW ( varchar(user_id) || '  ' || varchar(group_id) || '  ' || mode || '  ' || misc_attributes )
+SHOW ( varchar(user_id) || '  ' || varchar(group_id) || '  ' || mode || '  ' || misc_attributes || '  ' || varchar(change_time) )
 WHERE MISC_ATTRIBUTES like '%+%'
 EOPOLICY
 
@@ -49,5 +49,16 @@ fi
 # OK, we have the list of files, lets go to work
 MYDIR=`dirname $0`
 
-${MYDIR}/backup_acls.py -f ${CURRENT} -v &>"${BKUPDIR}/${GPFSDEV}_${MYDATE}"
+# JOBS workers fetch the ACLs; the backup is written to SHARDS gzipped files in
+# the deduplicated format, named ${GPFSDEV}_${MYDATE}.NNN.dedup.gz
+JOBS=16
+SHARDS=8
+# Only files that changed since the last backup are fetched again, the rest
+# are carried forward from it.
+PREVIOUS=`ls -1 ${BKUPDIR}/${GPFSDEV}_*.000.jsonl* ${BKUPDIR}/${GPFSDEV}_*.000.dedup* 2>/dev/null | grep -v "_${MYDATE}\." | sort | tail -1`
+if [ "x${PREVIOUS}" != "x" ] ; then
+   PREVIOUS="-p ${PREVIOUS%.000.*}"
+fi
+
+${MYDIR}/backup_acls.py -f ${CURRENT} -o "${BKUPDIR}/${GPFSDEV}_${MYDATE}" ${PREVIOUS} -F dedup -j ${JOBS} -s ${SHARDS} -z -v &>"${BKUPDIR}/${GPFSDEV}_${MYDATE}.log"
 
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+Check that the xattr backend writes and reads back ACLs unchanged, and
+compare its ACL operations per second with the mm backend.
+
+The mm backend runs the stand-ins in this directory unless SSACL_MMGETACL
+and SSACL_MMPUTACL are already set. The files are created in --dir, which
+must be on a file system with POSIX ACLs, eg. ext4 or tmpfs.
+
+   python3 bench/bench_backend.py [ -n FILES ] [ -m MMFILES ] [ --dir DIR ]
+
+"""
+
+from __future__ import print_function
+import sys
+import os
+import time
+import shutil
+import tempfile
+
+BENCHDIR = os.path.dirname( os.path.abspath( __file__ ) )
+sys.path.insert( 0, os.path.join( BENCHDIR, '..' ) )
+os.environ.setdefault( 'SSACL_MMGETACL', os.path.join( BENCHDIR, 'mmgetacl' ) )
+os.environ.setdefault( 'SSACL_MMPUTACL', os.path.join( BENCHDIR, 'mmputacl' ) )
+import ssacl
+
+
+def make_acl_text( idx ):
+    """
+    A synthetic ACL. The ids are numeric and above the ones in use, so they
+    read back the way they were written.
+    """
+    lines = [ 'user::rwxc', 'group::r-x-', 'other::----', 'mask::rwx-' ]
+    for count in range( idx % 4 ):
+        lines.append( 'user:%d:r-x-' % ( 60000 + idx + count ) )
+    for count in range( idx % 3 ):
+        lines.append( 'group:%d:rw--' % ( 61000 + idx + count ) )
+    return '\n'.join( lines ) + '\n'
+
+
+def round_trip( backend, workdir, count ):
+    """
+    Put every synthetic ACL on a file and a directory, as access and
+    default ACLs, and compare what comes back.
+
+    :return: The number of mismatches.
+    """
+    bad = 0
+    for idx in range( count ):
+        text = make_acl_text( idx )
+        aclfile = os.path.join( workdir, 'acl%d' % ( idx ) )
+        with open( aclfile, 'w' ) as fd:
+           fd.write( text )
+        wanted = ssacl.acl_signature( ssacl.parse_acl( text ) )
+
+        dirname = os.path.join( workdir, 'rt%d' % ( idx ) )
+        os.mkdir( dirname )
+        filename = os.path.join( dirname, 'file' )
+        open( filename, 'w' ).close()
+
+        for ( path, default ) in [ ( filename, False ), ( dirname, False ), ( dirname, True ) ]:
+            backend.put_acl( path, aclfile, default )
+            got = ssacl.acl_signature( ssacl.parse_acl( backend.get_acl_text( path, default ) ) )
+            if got != wanted:
+               print("MISMATCH: %s default=%s\n  wanted %s\n  got    %s" % ( path, default, wanted, got ))
+               bad += 1
+    return bad
+
+
+def time_backend( backend, paths, aclfile ):
+    """
+    :return: The get plus parse, and the put, operations per second.
+    """
+    start = time.time()
+    for path in paths:
+        ssacl.parse_acl( backend.get_acl_text( path ), path )
+    gets = len( paths ) / max( time.time() - start, 0.000001 )
+
+    start = time.time()
+    for path in paths:
+        backend.put_acl( path, aclfile )
+    puts = len( paths ) / max( time.time() - start, 0.000001 )
+    return ( gets, puts )
+
+
+def parse_options( argv ):
+    import argparse
+    parser = argparse.ArgumentParser( prog = 'bench_backend.py' )
+
+    parser.add_argument( "-n", dest = "count", default = 10000, type = int,
+                         help = "Files for the xattr backend. Default: %(default)s")
+
+    parser.add_argument( "-m", dest = "mmcount", default = 50, type = int,
+                         help = "Files for the mm backend, which forks for every call. Default: %(default)s")
+
+    parser.add_argument( "-t", dest = "trips", default = 200, type = int,
+                         help = "ACLs in the round trip check. Default: %(default)s")
+
+    parser.add_argument( "--dir", dest = "topdir", default = None,
+                         help = "Where to create the files. Default: a temporary directory")
+
+    return parser.parse_args( argv )
+
+
+if __name__ == '__main__':
+   options = parse_options( sys.argv[1:] )
+
+   workdir = tempfile.mkdtemp( prefix='ssacl-bench.', dir=options.topdir )
+   os.environ['SSACL_ACL_STORE'] = os.path.join( workdir, 'store' )
+   try:
+      xattr = ssacl.xattr_backend()
+      bad = round_trip( xattr, workdir, options.trips )
+      print("Round trip: %d ACLs, %d mismatches" % ( options.trips * 3, bad ))
+
+      aclfile = os.path.join( workdir, 'acl1' )
+      paths = []
+      for idx in range( max( options.count, options.mmcount ) ):
+          path = os.path.join( workdir, 'f%d' % ( idx ) )
+          open( path, 'w' ).close()
+          paths.append( path )
+
+      for ( backend, count ) in [ ( ssacl.mm_backend(), options.mmcount ), ( xattr, options.count ) ]:
+          if count == 0:
+             continue
+          ( gets, puts ) = time_backend( backend, paths[0:count], aclfile )
+          print("%-6s %8d files  %10.0f get/s  %10.0f put/s" % ( backend.name, count, gets, puts ))
+   finally:
+      shutil.rmtree( workdir )
+
+   if bad:
+      sys.exit(1)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Compare the memory held by ACL dicts from parse_acl() with the same ACLs as
+compact_acl values, and the time to convert between them.
+
+The memory is measured with tracemalloc, so this needs Python 3.
+
+   python3 bench/bench_compact.py [ -n ACLS ] [ -e ENTRIES ] [ -d DISTINCT ]
+
+"""
+
+import sys
+import os
+import time
+import tracemalloc
+
+BENCHDIR = os.path.dirname( os.path.abspath( __file__ ) )
+sys.path.insert( 0, os.path.join( BENCHDIR, '..' ) )
+sys.path.insert( 0, BENCHDIR )
+from ssacl import parse_acl, compact_acl
+from bench_parse import make_acl_text
+
+
+def held( build ):
+    """
+    :return: The result of build() and the bytes it holds on to.
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return ( result, after - before )
+
+
+def parse_options( argv ):
+    import argparse
+    parser = argparse.ArgumentParser( prog = 'bench_compact.py' )
+
+    parser.add_argument( "-n", dest = "count", default = 200000, type = int,
+                         help = "The number of ACLs to hold. Default: %(default)s")
+
+    parser.add_argument( "-e", dest = "entries", default = 4, type = int,
+                         help = "Named user/group entries per ACL. Default: %(default)s")
+
+    parser.add_argument( "-d", dest = "distinct", default = 1000, type = int,
+                         help = "Distinct ACL texts among them. Default: %(default)s")
+
+    return parser.parse_args( argv )
+
+
+if __name__ == '__main__':
+   options = parse_options( sys.argv[1:] )
+
+   texts = [ make_acl_text( idx, options.entries ) for idx in range( options.distinct ) ]
+   paths = [ '/gpfs/fs/dir%d/file%d' % ( idx % 100, idx ) for idx in range( options.count ) ]
+
+   ( dicts, dict_bytes ) = held( lambda: [ parse_acl( texts[idx % options.distinct], paths[idx], os.path.dirname( paths[idx] ) )
+                                           for idx in range( options.count ) ] )
+
+   ( values, value_bytes ) = held( lambda: [ compact_acl.from_dict( acl ) for acl in dicts ] )
+
+   # Timed again, outside tracemalloc, which slows allocation down.
+   start = time.time()
+   values = [ compact_acl.from_dict( acl ) for acl in dicts ]
+   to_compact = time.time() - start
+
+   # Equal values can be shared, the way a backup planner would keep them.
+   pool = {}
+   ( shared, shared_bytes ) = held( lambda: [ pool.setdefault( value, value ) for value in values ] )
+
+   start = time.time()
+   for idx in range( options.count ):
+       if values[idx].to_dict( paths[idx], os.path.dirname( paths[idx] ) ) != dicts[idx]:
+          print("MISMATCH: %s" % ( texts[idx % options.distinct] ))
+          sys.exit(1)
+   to_dict = time.time() - start
+
+   print("%-14s %12.0f bytes/ACL" % ( 'dict', dict_bytes / float( options.count ) ))
+   print("%-14s %12.0f bytes/ACL  %8.2f us/ACL from_dict  %8.2f us/ACL to_dict" % ( 'compact_acl', value_bytes / float( options.count ),
+         to_compact * 1e6 / options.count, to_dict * 1e6 / options.count ))
+   print("%-14s %12.0f bytes/ACL  %d distinct" % ( 'shared', shared_bytes / float( options.count ), len( pool ) ))
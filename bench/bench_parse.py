@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+Microbenchmark for the mmgetacl output parser.
+
+Compares ssacl.parse_acl and ssacl.parse_acls against the parse loop that
+mmacls.get_acl used to carry, on a synthetic set of ACL texts.
+
+   python bench/bench_parse.py [ -n ACLS ] [ -e ENTRIES ] [ -r REPEAT ]
+
+"""
+
+from __future__ import print_function
+import sys
+import os
+import timeit
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..' ) )
+from ssacl import parse_acl, parse_acls
+
+
+def legacy_parse( output, fqpn, dirname ):
+    """
+    The parse loop as it was in mmacls.get_acl, kept here as the baseline.
+    """
+    mydict = {}
+    mydict['GROUPS'] = {}
+    mydict['USERS'] = {}
+    mydict['FQPN'] = fqpn
+    mydict['DIRNAME'] = dirname
+
+    for line in output.splitlines():
+        if '#owner:' in line:
+           mydict['OWNER'] = line.split(':')[1]
+        elif '#group:' in line:
+           mydict['GROUP'] = line.split(':')[1]
+        elif line.startswith('user:'):
+           if line.split(':')[1] == '':
+              mydict['USERP'] = line.split(':')[2]
+           else:
+              user_name=line.split(':')[1]
+              mydict['USERS'][user_name] = {}
+              mydict['USERS'][user_name]['PERMS']=line.split(':')[2][0:4]
+              if 'effective' in line:
+                 mydict['USERS'][user_name]['EFFECTIVE']=line.split(':')[3][1:5]
+              else:
+                 mydict['USERS'][user_name]['EFFECTIVE']='????'
+        elif line.startswith('group:'):
+           if line.split(':')[1] == '':
+              mydict['GROUPP'] = line.split(':')[2]
+           else:
+              group_name=line.split(':')[1]
+              mydict['GROUPS'][group_name] = {}
+              mydict['GROUPS'][group_name]['PERMS']=line.split(':')[2][0:4]
+              if 'effective' in line:
+                 mydict['GROUPS'][group_name]['EFFECTIVE']=line.split(':')[3][1:5]
+              else:
+                 mydict['GROUPS'][group_name]['EFFECTIVE']='????'
+        elif 'other::' in line:
+           mydict['OTHERP'] = line.split(':')[2]
+        elif 'mask::' in line:
+           mydict['MASK'] = line.split(':')[2]
+    return mydict
+
+
+def make_acl_text( idx, entries ):
+    lines = [ '#owner:user%d' % ( idx % 50 ),
+              '#group:group%d' % ( idx % 20 ),
+              'user::rwxc',
+              'group::r-x-',
+              'other::----',
+              'mask::r-x-' ]
+    for count in range( entries ):
+        if count % 2:
+           lines.append( 'user:user%d:rw--\t#effective: r---' % ( count ) )
+        else:
+           lines.append( 'group:group%d:r-x-' % ( count ) )
+    return '\n'.join( lines ) + '\n'
+
+
+def parse_options( argv ):
+    import argparse
+    parser = argparse.ArgumentParser( prog = 'bench_parse.py' )
+
+    parser.add_argument( "-n", dest = "count", default = 20000, type = int,
+                         help = "The number of ACL texts to parse. Default: %(default)s")
+
+    parser.add_argument( "-e", dest = "entries", default = 4, type = int,
+                         help = "Named user/group entries per ACL. Default: %(default)s")
+
+    parser.add_argument( "-r", dest = "repeat", default = 5, type = int,
+                         help = "Take the best of this many runs. Default: %(default)s")
+
+    return parser.parse_args( argv )
+
+
+if __name__ == '__main__':
+   options = parse_options( sys.argv[1:] )
+
+   texts = [ make_acl_text( idx, options.entries ) for idx in range( options.count ) ]
+   fqpns = [ '/gpfs/fs/dir%d/file%d' % ( idx % 100, idx ) for idx in range( options.count ) ]
+   dirnames = [ os.path.dirname( fqpn ) for fqpn in fqpns ]
+
+   for idx in range( options.count ):
+       if legacy_parse( texts[idx], fqpns[idx], dirnames[idx] ) != parse_acl( texts[idx], fqpns[idx], dirnames[idx] ):
+          print("MISMATCH: %s" % ( texts[idx] ))
+          sys.exit(1)
+
+   # Every variant keeps its results, the way a backup or restore batch does.
+   def run_legacy():
+       return [ legacy_parse( texts[idx], fqpns[idx], dirnames[idx] ) for idx in range( options.count ) ]
+
+   def run_single():
+       return [ parse_acl( texts[idx], fqpns[idx], dirnames[idx] ) for idx in range( options.count ) ]
+
+   def run_batch():
+       return parse_acls( texts, fqpns, dirnames )
+
+   lines = options.count * ( 6 + options.entries )
+   for ( name, func ) in [ ( 'legacy', run_legacy ), ( 'parse_acl', run_single ), ( 'parse_acls', run_batch ) ]:
+       # Run with the collector on, as the real code does; timeit turns it off.
+       timer = timeit.Timer( func, 'import gc; gc.enable()' )
+       best = min( timer.repeat( number=1, repeat=options.repeat ) )
+       print("%-12s %8.3f s  %10.0f ACLs/s  %12.0f lines/s" % ( name, best, options.count / best, lines / best ))
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+Benchmark the directory walkers on a synthetic tree.
+
+Compares ssacl.iter_directory_tree against the recursive os.listdir plus
+os.stat walk that the ssacl CLI used before.
+
+   python bench/bench_walk.py [ -w WIDTH ] [ -D DEPTH ] [ -n FILES ] [ --dir DIR ]
+
+"""
+
+from __future__ import print_function
+import sys
+import os
+import time
+import shutil
+import tempfile
+from stat import *
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..' ) )
+from ssacl import iter_directory_tree
+
+
+def legacy_walk( topdir, found ):
+    """
+    The walk_directory_tree loop as it was, kept here as the baseline.
+    """
+    for file in os.listdir( topdir ):
+       pathname = os.path.join( topdir, file )
+       try:
+          mystat = os.stat( pathname )
+       except OSError:
+          continue
+
+       mode = mystat[ST_MODE]
+       if S_ISDIR(mode):
+          if not pathname.endswith( '/.snapshots' ):
+             found.append( pathname )
+             legacy_walk( pathname, found )
+       elif S_ISREG(mode):
+          found.append( pathname )
+
+
+def make_tree( topdir, width, depth, files ):
+    """
+    Build a tree with width sub-directories per directory, depth levels deep
+    and files regular files in every directory.
+
+    :return: The number of entries below topdir.
+    """
+    count = 0
+    level = [ topdir ]
+    for lvl in range( depth + 1 ):
+        next_level = []
+        for dirpath in level:
+            for idx in range( files ):
+                open( os.path.join( dirpath, 'file%d' % ( idx ) ), 'w' ).close()
+                count += 1
+            if lvl < depth:
+               for idx in range( width ):
+                   subdir = os.path.join( dirpath, 'dir%d' % ( idx ) )
+                   os.mkdir( subdir )
+                   next_level.append( subdir )
+                   count += 1
+        level = next_level
+    return count
+
+
+def parse_options( argv ):
+    import argparse
+    parser = argparse.ArgumentParser( prog = 'bench_walk.py' )
+
+    parser.add_argument( "-w", dest = "width", default = 8, type = int,
+                         help = "Sub-directories per directory. Default: %(default)s")
+
+    parser.add_argument( "-D", dest = "depth", default = 3, type = int,
+                         help = "Directory levels. Default: %(default)s")
+
+    parser.add_argument( "-n", dest = "files", default = 100, type = int,
+                         help = "Files per directory. Default: %(default)s")
+
+    parser.add_argument( "-r", dest = "repeat", default = 3, type = int,
+                         help = "Take the best of this many runs. Default: %(default)s")
+
+    parser.add_argument( "--dir", dest = "topdir", default = None,
+                         help = "Walk this existing tree instead of building one. Default: %(default)s")
+
+    return parser.parse_args( argv )
+
+
+if __name__ == '__main__':
+   options = parse_options( sys.argv[1:] )
+
+   cleanup = False
+   if options.topdir == None:
+      options.topdir = tempfile.mkdtemp( prefix='ssacl-bench.' )
+      cleanup = True
+      count = make_tree( options.topdir, options.width, options.depth, options.files )
+      print("Built %d entries in %s" % ( count, options.topdir ))
+
+   def run_legacy():
+       found = []
+       legacy_walk( options.topdir, found )
+       return found
+
+   def run_scandir():
+       return [ pathname for ( pathname, kind ) in iter_directory_tree( options.topdir ) if kind in 'df' ]
+
+   try:
+      if sorted( run_legacy() ) != sorted( run_scandir() ):
+         print("MISMATCH: the walkers found different entries")
+         sys.exit(1)
+
+      for ( name, func ) in [ ( 'legacy', run_legacy ), ( 'scandir', run_scandir ) ]:
+          best = None
+          for count in range( options.repeat ):
+              start = time.time()
+              entries = len( func() )
+              elapsed = time.time() - start
+              if best == None or elapsed < best:
+                 best = elapsed
+          print("%-10s %8.3f s  %10.0f entries/s" % ( name, best, entries / best ))
+   finally:
+      if cleanup:
+         shutil.rmtree( options.topdir )
@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+"""
+Stand-ins for the SpectrumScale ACL commands, so ssacl can be exercised on a
+machine without GPFS.
+
+ACLs are kept as mmgetacl style text files in the directory named by
+SSACL_ACL_STORE, one file per path. A path with no stored ACL reports the
+ACL implied by its mode bits. Point ssacl at the stand-ins with:
+
+   export SSACL_MMGETACL=/path/to/bench/mmgetacl
+   export SSACL_MMPUTACL=/path/to/bench/mmputacl
+   export SSACL_MMDELACL=/path/to/bench/mmdelacl
+   export SSACL_MMAPPLYPOLICY=/path/to/bench/mmapplypolicy
+
+Two more variables are used by the benchmarks:
+
+   SSACL_FAKE_LATENCY   Seconds every call sleeps, to mimic a loaded cluster.
+   SSACL_FAKE_COUNT     A file that every call appends its name to, so the
+                        calls can be counted.
+
+"""
+
+from __future__ import print_function
+import sys
+import os
+import hashlib
+import time
+import pwd
+import grp
+import re
+from stat import *
+
+
+def store_path( fqpn, default=False ):
+    """
+    The store file holding the ACL for a path, or None when no store is set.
+    """
+    store = os.environ.get( 'SSACL_ACL_STORE' )
+    if not store:
+       return None
+
+    if hasattr( os, 'fsencode' ):
+       name = os.fsencode( fqpn )
+    else:
+       name = fqpn
+    key = hashlib.sha1( name ).hexdigest()
+    if default:
+       return os.path.join( store, key[0:2], key + '.dacl' )
+    return os.path.join( store, key[0:2], key + '.acl' )
+
+
+def mode_perms( bits, control ):
+    perms = ''
+    perms += 'r' if bits & 4 else '-'
+    perms += 'w' if bits & 2 else '-'
+    perms += 'x' if bits & 1 else '-'
+    perms += 'c' if control else '-'
+    return perms
+
+
+def owner_names( mystat ):
+    try:
+       owner = pwd.getpwuid( mystat.st_uid ).pw_name
+    except KeyError:
+       owner = str( mystat.st_uid )
+
+    try:
+       group = grp.getgrgid( mystat.st_gid ).gr_name
+    except KeyError:
+       group = str( mystat.st_gid )
+    return ( owner, group )
+
+
+def get_acl_text( fqpn, default=False ):
+    """
+    Return the ACL text for a path the way mmgetacl prints it.
+    """
+    mystat = os.stat( fqpn )
+    ( owner, group ) = owner_names( mystat )
+    header = '#owner:%s\n#group:%s\n' % ( owner, group )
+
+    stored = store_path( fqpn, default )
+    if stored and os.path.isfile( stored ):
+       with open( stored ) as fd:
+          return header + fd.read()
+
+    if default:
+       return header
+
+    mode = mystat.st_mode
+    return header + 'user::%s\ngroup::%s\nother::%s\n' % ( mode_perms( mode >> 6, True ),
+                                                          mode_perms( mode >> 3, False ),
+                                                          mode_perms( mode, False ) )
+
+
+def record_call( name ):
+    """
+    Count the call and add the configured latency.
+    """
+    counter = os.environ.get( 'SSACL_FAKE_COUNT' )
+    if counter:
+       fd = os.open( counter, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644 )
+       os.write( fd, ( name + '\n' ).encode( 'utf-8' ) )
+       os.close( fd )
+
+    latency = float( os.environ.get( 'SSACL_FAKE_LATENCY', 0 ) )
+    if latency > 0:
+       time.sleep( latency )
+
+
+def count_calls( counter ):
+    """
+    Read back a SSACL_FAKE_COUNT file.
+
+    :return: A dict of command name: number of calls.
+    """
+    counts = {}
+    if os.path.isfile( counter ):
+       with open( counter ) as fd:
+          for line in fd:
+              name = line.strip()
+              counts[name] = counts.get( name, 0 ) + 1
+    return counts
+
+
+def put_acl_text( fqpn, text, default=False ):
+    """
+    Store ACL text for a path. The #owner and #group comments are dropped,
+    they come from the file itself.
+    """
+    stored = store_path( fqpn, default )
+    if not stored:
+       return
+
+    lines = [ line for line in text.splitlines() if line.strip() and not line.startswith( '#' ) ]
+    if not os.path.isdir( os.path.dirname( stored ) ):
+       try:
+          os.makedirs( os.path.dirname( stored ) )
+       except OSError:
+          pass
+    with open( stored, 'w' ) as fd:
+       fd.write( '\n'.join( lines ) + '\n' )
+
+
+def mmgetacl_main( argv ):
+    record_call( 'mmgetacl' )
+
+    import argparse
+    parser = argparse.ArgumentParser( prog = 'mmgetacl' )
+    parser.add_argument( "-d", dest = "default", default = False, action = 'store_true' )
+    parser.add_argument( "-o", dest = "outfile", default = None )
+    parser.add_argument( "-k", dest = "acltype", default = None )
+    parser.add_argument( "filename" )
+    options = parser.parse_args( argv )
+
+    fqpn = os.path.abspath( options.filename )
+    try:
+       mystat = os.stat( fqpn )
+    except OSError as e:
+       print("mmgetacl: %s: %s" % ( options.filename, e.strerror ), file=sys.stderr)
+       return 1
+
+    if options.default and not S_ISDIR( mystat.st_mode ):
+       print("mmgetacl: %s: Default ACLs are only valid for directories." % ( options.filename ), file=sys.stderr)
+       return 1
+
+    text = get_acl_text( fqpn, options.default )
+    if options.outfile:
+       with open( options.outfile, 'w' ) as fd:
+          fd.write( text )
+    else:
+       sys.stdout.write( text )
+    return 0
+
+
+def mmputacl_main( argv ):
+    record_call( 'mmputacl' )
+
+    import argparse
+    parser = argparse.ArgumentParser( prog = 'mmputacl' )
+    parser.add_argument( "-d", dest = "default", default = False, action = 'store_true' )
+    parser.add_argument( "-i", dest = "infile", default = None )
+    parser.add_argument( "filename" )
+    options = parser.parse_args( argv )
+
+    fqpn = os.path.abspath( options.filename )
+    try:
+       mystat = os.stat( fqpn )
+    except OSError as e:
+       print("mmputacl: %s: %s" % ( options.filename, e.strerror ), file=sys.stderr)
+       return 1
+
+    if options.default and not S_ISDIR( mystat.st_mode ):
+       print("mmputacl: %s: Default ACLs are only valid for directories." % ( options.filename ), file=sys.stderr)
+       return 1
+
+    if options.infile:
+       with open( options.infile ) as fd:
+          text = fd.read()
+    else:
+       text = sys.stdin.read()
+
+    put_acl_text( fqpn, text, options.default )
+    return 0
+
+
+def mmdelacl_main( argv ):
+    record_call( 'mmdelacl' )
+
+    import argparse
+    parser = argparse.ArgumentParser( prog = 'mmdelacl' )
+    parser.add_argument( "-d", dest = "default", default = False, action = 'store_true' )
+    parser.add_argument( "filename" )
+    options = parser.parse_args( argv )
+
+    fqpn = os.path.abspath( options.filename )
+    try:
+       mystat = os.stat( fqpn )
+    except OSError as e:
+       print("mmdelacl: %s: %s" % ( options.filename, e.strerror ), file=sys.stderr)
+       return 1
+
+    if options.default and not S_ISDIR( mystat.st_mode ):
+       print("mmdelacl: %s: Default ACLs are only valid for directories." % ( options.filename ), file=sys.stderr)
+       return 1
+
+    stored = store_path( fqpn, options.default )
+    if stored and os.path.isfile( stored ):
+       os.unlink( stored )
+    return 0
+
+
+def has_acl( fqpn ):
+    """
+    True when the store holds an ACL or a default ACL for the path.
+    """
+    for default in [ False, True ]:
+        stored = store_path( fqpn, default )
+        if stored and os.path.isfile( stored ):
+           return True
+    return False
+
+
+def mmapplypolicy_main( argv ):
+    """
+    Run the LIST rule of a policy the way mmapplypolicy -I defer does, and
+    write the files and directories below the path that match it to
+    PREFIX.list.NAME, or DIR/list.NAME when -f is a directory.
+
+    Only two WHERE clauses are understood: none, which lists everything,
+    and MISC_ATTRIBUTES LIKE '%+%', which lists the paths with an ACL in
+    the store.
+    """
+    record_call( 'mmapplypolicy' )
+
+    import argparse
+    parser = argparse.ArgumentParser( prog = 'mmapplypolicy' )
+    parser.add_argument( "-P", dest = "policy", required = True )
+    parser.add_argument( "-f", dest = "prefix", required = True )
+    parser.add_argument( "-I", dest = "action", default = 'yes' )
+    parser.add_argument( "path" )
+    ( options, rest ) = parser.parse_known_args( argv )
+
+    with open( options.policy ) as fd:
+       policy = fd.read()
+
+    match = re.search( r"LIST\s+'([^']+)'", policy )
+    if match == None or options.action != 'defer':
+       print("[E] The stand-in only runs a LIST rule with -I defer.", file=sys.stderr)
+       return 1
+    listname = match.group( 1 )
+
+    acls_only = False
+    match = re.search( r"\bWHERE\b(.*)", policy, re.I | re.S )
+    if match:
+       where = ' '.join( match.group( 1 ).split() ).strip( '() ' )
+       if not re.match( r"MISC_ATTRIBUTES\s+LIKE\s+'%\+%'$", where, re.I ):
+          print("[E] The stand-in does not understand WHERE %s" % ( where ), file=sys.stderr)
+          return 1
+       acls_only = True
+
+    entries = []
+    for ( dirpath, dirnames, filenames ) in os.walk( os.path.abspath( options.path ) ):
+        dirnames[:] = [ name for name in dirnames if name != '.snapshots' ]
+        entries.append( dirpath )
+        entries += [ os.path.join( dirpath, name ) for name in filenames ]
+    if acls_only:
+       entries = [ pathname for pathname in entries if has_acl( os.path.abspath( pathname ) ) ]
+
+    print("[I] Inodes scanned: %d" % ( len( entries ) ))
+    if entries:
+       if os.path.isdir( options.prefix ):
+          listfile = os.path.join( options.prefix, 'list.' + listname )
+       else:
+          listfile = options.prefix + '.list.' + listname
+       write_policy_list( listfile, entries )
+    print("[I] Policy: %d files listed for %s." % ( len( entries ), listname ))
+    return 0
+
+
+def bench_acl_text( idx ):
+    """
+    The idx'th of the synthetic ACLs put on a generated tree.
+    """
+    return 'user::rwxc\ngroup::r-x-\nother::----\nmask::rwxc\nuser:bench%d:r-x-\ngroup:benchgrp%d:r---\n' % ( idx, idx % 7 )
+
+
+def make_tree( topdir, width, depth, files, acls=0 ):
+    """
+    Build a tree with width sub-directories per directory, depth levels deep
+    and files regular files in every directory. When acls is set, entry n
+    gets the ACL bench_acl_text( n % acls ) in the store, and directories a
+    default ACL as well.
+
+    :return: A list of the entries below topdir, directories first.
+    """
+    entries = []
+    level = [ topdir ]
+    count = 0
+    for lvl in range( depth + 1 ):
+        next_level = []
+        for dirpath in level:
+            for idx in range( files ):
+                pathname = os.path.join( dirpath, 'file%d' % ( idx ) )
+                open( pathname, 'w' ).close()
+                entries.append( pathname )
+            if lvl < depth:
+               for idx in range( width ):
+                   subdir = os.path.join( dirpath, 'dir%d' % ( idx ) )
+                   os.mkdir( subdir )
+                   entries.append( subdir )
+                   next_level.append( subdir )
+        level = next_level
+
+    if acls:
+       for pathname in entries:
+           text = bench_acl_text( count % acls )
+           put_acl_text( pathname, text )
+           if os.path.isdir( pathname ):
+              put_acl_text( pathname, text, True )
+           count += 1
+    return entries
+
+
+def write_policy_list( listfile, entries ):
+    """
+    Write the entries as the mmapplypolicy LIST file that backup_acls.sh
+    produces, so backup_acls.py can be run on them.
+    """
+    with open( listfile, 'w' ) as fd:
+       for pathname in entries:
+           mystat = os.lstat( pathname )
+           if S_ISDIR( mystat.st_mode ):
+              mode = 'drwxr-x---'
+           else:
+              mode = '-rwxr-x---'
+           ctime = time.strftime( '%Y-%m-%d %H:%M:%S', time.localtime( mystat.st_ctime ) )
+           fd.write( '%d 1 0  %d  %d  %s  D+  %s -- %s\n' % ( mystat.st_ino, mystat.st_uid, mystat.st_gid, mode, ctime, pathname ) )
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+"""
+Benchmark the ssacl CLI and backup_acls.py on a synthetic tree, with the
+stand-in mmgetacl, mmputacl and mmdelacl from fakegpfs.py.
+
+Every operation is run as its own process and reports the files per second,
+the number of mmgetacl, mmputacl and mmdelacl calls, and the peak RSS of the command
+and its children. The results can be saved as a baseline and later runs
+compared against it:
+
+   python bench/run_bench.py --save baseline.json
+   python bench/run_bench.py --compare baseline.json
+
+A tree of about a million entries is -w 10 -D 4 -n 90.
+
+"""
+
+from __future__ import print_function
+import sys
+import os
+import time
+import json
+import shutil
+import tempfile
+from subprocess import Popen
+
+BENCHDIR = os.path.dirname( os.path.abspath( __file__ ) )
+TOPDIR = os.path.dirname( BENCHDIR )
+sys.path.insert( 0, BENCHDIR )
+from fakegpfs import make_tree, write_policy_list, count_calls
+
+
+def operations( options, workdir, tree ):
+    """
+    The operations to time, in the order they run. Later ones depend on the
+    state the earlier ones leave behind.
+
+    :return: A list of ( name, argv ) tuples.
+    """
+    ssacl = [ sys.executable, os.path.join( TOPDIR, 'ssacl' ) ]
+    backup = [ sys.executable, os.path.join( TOPDIR, 'backup_acls.py' ) ]
+    parallel = [ '--jobs', str( options.jobs ), '--batch', str( options.batch ) ]
+    prefix = os.path.join( workdir, 'backup' )
+
+    return [ ( 'list',         ssacl + [ '--list', '-d', '-r', tree ] ),
+             ( 'json',         ssacl + [ '--json', '-r', tree ] + parallel ),
+             ( 'backup',       backup + [ '-f', os.path.join( workdir, 'list' ), '-o', prefix, '-F', 'dedup',
+                                          '-j', str( options.jobs ), '-b', str( options.batch ) ] ),
+             ( 'add',          ssacl + [ '--add', '-g', 'benchadd', '-a', 'r-x-', '-d', '-r', '-q', tree ] + parallel ),
+             ( 'add-noop',     ssacl + [ '--add', '-g', 'benchadd', '-a', 'r-x-', '-d', '-r', '-q', tree ] + parallel ),
+             ( 'add-policy',   ssacl + [ '--add', '-g', 'benchadd', '-a', 'r-x-', '-d', '--policy', '-q', tree ] + parallel ),
+             ( 'del',          ssacl + [ '--del', '-g', 'benchadd', '-d', '-r', '-q', tree ] + parallel ),
+             ( 'clear',        ssacl + [ '--clear', '-d', '-r', '-q', tree ] + parallel ),
+             ( 'restore',      ssacl + [ '--restore', prefix, '-q' ] + parallel ),
+             ( 'restore-noop', ssacl + [ '--restore', prefix, '-q' ] + parallel ) ]
+
+
+def measure( argv, env, counter ):
+    """
+    Run one operation.
+
+    :return: A dict of seconds, rc, peak_rss_kb and the calls per command.
+    """
+    if os.path.exists( counter ):
+       os.unlink( counter )
+
+    devnull = open( os.devnull, 'w' )
+    start = time.time()
+    subp = Popen( argv, stdout=devnull, stderr=devnull, env=env )
+    ( pid, status, usage ) = os.wait4( subp.pid, 0 )
+    elapsed = time.time() - start
+    subp.returncode = status
+    devnull.close()
+
+    calls = count_calls( counter )
+    result = {}
+    result['seconds'] = round( elapsed, 3 )
+    result['rc'] = os.WEXITSTATUS( status )
+    result['peak_rss_kb'] = usage.ru_maxrss
+    result['mmgetacl'] = calls.get( 'mmgetacl', 0 )
+    result['mmputacl'] = calls.get( 'mmputacl', 0 )
+    result['mmdelacl'] = calls.get( 'mmdelacl', 0 )
+    return result
+
+
+def compare( results, baseline, tolerance ):
+    """
+    Compare the results with a baseline.
+
+    :return: A list of the regressions found, as text.
+    """
+    regressions = []
+    for ( name, base ) in sorted( baseline['results'].items() ):
+        result = results.get( name )
+        if result == None:
+           continue
+
+        if result['files_per_sec'] < base['files_per_sec'] * ( 1 - tolerance ):
+           regressions.append( "%s: %.0f files/s, baseline %.0f" % ( name, result['files_per_sec'], base['files_per_sec'] ) )
+
+        for key in [ 'mmgetacl', 'mmputacl', 'mmdelacl' ]:
+            if result[key] > base.get( key, 0 ):
+               regressions.append( "%s: %d %s calls, baseline %d" % ( name, result[key], key, base.get( key, 0 ) ) )
+
+        if result['peak_rss_kb'] > base['peak_rss_kb'] * ( 1 + tolerance ):
+           regressions.append( "%s: %d KB peak RSS, baseline %d KB" % ( name, result['peak_rss_kb'], base['peak_rss_kb'] ) )
+    return regressions
+
+
+def parse_options( argv ):
+    import argparse
+    parser = argparse.ArgumentParser( prog = 'run_bench.py' )
+
+    parser.add_argument( "-w", dest = "width", default = 4, type = int,
+                         help = "Sub-directories per directory. Default: %(default)s")
+
+    parser.add_argument( "-D", dest = "depth", default = 2, type = int,
+                         help = "Directory levels. Default: %(default)s")
+
+    parser.add_argument( "-n", dest = "files", default = 10, type = int,
+                         help = "Files per directory. Default: %(default)s")
+
+    parser.add_argument( "-a", dest = "acls", default = 5, type = int,
+                         help = "The number of distinct ACLs put on the tree. Default: %(default)s")
+
+    parser.add_argument( "-l", "--latency", dest = "latency", default = 0.0, type = float,
+                         help = "Seconds every stand-in call takes. Default: %(default)s")
+
+    parser.add_argument( "-j", "--jobs", dest = "jobs", default = 8, type = int,
+                         help = "Passed to --jobs. Default: %(default)s")
+
+    parser.add_argument( "-b", "--batch", dest = "batch", default = 64, type = int,
+                         help = "Passed to --batch. Default: %(default)s")
+
+    parser.add_argument( "-o", "--ops", dest = "ops", default = None,
+                         help = "A comma separated list of the operations to report. Default: all")
+
+    parser.add_argument( "--dir", dest = "workdir", default = None,
+                         help = "Build the tree here and keep it. Default: a temporary directory")
+
+    parser.add_argument( "--save", dest = "save", default = None,
+                         help = "Save the results as a baseline to this file. Default: %(default)s")
+
+    parser.add_argument( "--compare", dest = "compare", default = None,
+                         help = "Compare the results with this baseline. Default: %(default)s")
+
+    parser.add_argument( "--tolerance", dest = "tolerance", default = 0.2, type = float,
+                         help = "The slowdown or growth allowed against the baseline. Default: %(default)s")
+
+    return parser.parse_args( argv )
+
+
+if __name__ == '__main__':
+   options = parse_options( sys.argv[1:] )
+
+   cleanup = False
+   workdir = options.workdir
+   if workdir == None:
+      workdir = tempfile.mkdtemp( prefix='ssacl-bench.' )
+      cleanup = True
+   elif not os.path.isdir( workdir ):
+      os.makedirs( workdir )
+
+   config = {}
+   for key in [ 'width', 'depth', 'files', 'acls', 'latency', 'jobs', 'batch' ]:
+       config[key] = getattr( options, key )
+
+   env = dict( os.environ )
+   env['SSACL_MMGETACL'] = os.path.join( BENCHDIR, 'mmgetacl' )
+   env['SSACL_MMPUTACL'] = os.path.join( BENCHDIR, 'mmputacl' )
+   env['SSACL_MMDELACL'] = os.path.join( BENCHDIR, 'mmdelacl' )
+   env['SSACL_MMAPPLYPOLICY'] = os.path.join( BENCHDIR, 'mmapplypolicy' )
+   env['SSACL_ACL_STORE'] = os.path.join( workdir, 'store' )
+   env['SSACL_FAKE_COUNT'] = os.path.join( workdir, 'calls' )
+   env['SSACL_FAKE_LATENCY'] = str( options.latency )
+   env['PYTHONPATH'] = TOPDIR + os.pathsep + env.get( 'PYTHONPATH', '' )
+
+   results = {}
+   try:
+      tree = os.path.join( workdir, 'tree' )
+      os.mkdir( tree )
+      os.environ['SSACL_ACL_STORE'] = env['SSACL_ACL_STORE']
+      start = time.time()
+      entries = make_tree( tree, options.width, options.depth, options.files, options.acls )
+      write_policy_list( os.path.join( workdir, 'list' ), entries )
+      count = len( entries ) + 1
+      print("Built %d entries with %d distinct ACLs in %.1f s" % ( count, options.acls, time.time() - start ))
+
+      wanted = None
+      if options.ops:
+         wanted = options.ops.split( ',' )
+
+      print("%-13s %9s %11s %9s %9s %9s %10s %3s" % ( 'operation', 'seconds', 'files/s', 'mmgetacl', 'mmputacl', 'mmdelacl', 'rss KB', 'rc' ))
+      for ( name, argv ) in operations( options, workdir, tree ):
+          result = measure( argv, env, env['SSACL_FAKE_COUNT'] )
+          result['files_per_sec'] = round( count / max( result['seconds'], 0.001 ), 1 )
+          if wanted == None or name in wanted:
+             results[name] = result
+             print("%-13s %9.3f %11.0f %9d %9d %9d %10d %3d" % ( name, result['seconds'], result['files_per_sec'],
+                   result['mmgetacl'], result['mmputacl'], result['mmdelacl'], result['peak_rss_kb'], result['rc'] ))
+   finally:
+      if cleanup:
+         shutil.rmtree( workdir, ignore_errors=True )
+
+   if options.save:
+      with open( options.save, 'w' ) as fd:
+         json.dump( { 'config': config, 'results': results }, fd, indent=2, sort_keys=True )
+         fd.write( '\n' )
+
+   rc = 0
+   for ( name, result ) in results.items():
+       if result['rc'] != 0:
+          print("FAILED: %s exited with %d" % ( name, result['rc'] ))
+          rc = 1
+
+   if options.compare:
+      with open( options.compare ) as fd:
+         baseline = json.load( fd )
+      if baseline.get( 'config' ) != config:
+         print("WARNING: the baseline was run with %s" % ( baseline.get( 'config' ) ))
+
+      regressions = compare( results, baseline, options.tolerance )
+      for line in regressions:
+          print("REGRESSION: %s" % ( line ))
+      if regressions:
+         rc = 1
+      else:
+         print("No regressions against %s" % ( options.compare ))
+
+   sys.exit( rc )
@@ -1,8 +1,14 @@
+import sys
 from distutils.core import setup
 
+# The asyncio engine needs Python 3.5 or later.
+modules = [ 'ssacl' ]
+if sys.version_info >= ( 3, 5 ):
+   modules.append( 'ssacl_aio' )
+
 setup( name = 'ssacl',
              version = '1.00',
-             py_modules = [ 'ssacl' ],
+             py_modules = modules,
            )
 
 
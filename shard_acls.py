@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+"""
+
+Split an ssacl run across hosts. One host running ssacl is limited by its
+own CPU and by how fast it can fork mmputacl, so this runs N workers, each
+with ssacl --shard i/N, on the hosts given or as local processes. The paths
+are walked, or found with --policy, once here with ssacl --split N, which
+writes the entries of the directories that hash to each shard to a list in
+the work directory. Every worker reads its own list, so the shards never
+overlap and the metadata is scanned once rather than by every worker. A
+--restore is split the same way from the backup, by every worker.
+
+While they run, the output of the workers is relayed with the shard in
+front of every line, and their --stats-file reports are merged into one
+progress line. At the end the totals, and with --stats the timings, of
+all the workers are added up.
+
+   shard_acls.py --hosts nsd01,nsd02,nsd03,nsd04 --work-dir /gpfs/fs0/tmp/shards -- --add -g nfsnobody -a r-x- -r --jobs 16 /data/acl
+   shard_acls.py -n 8 -- --restore /data/acl/backups/fs0_20260101 --jobs 16 /data/acl
+
+The hosts are reached with ssh and must see the same file systems, the
+work directory included. Every worker runs in the current directory.
+
+There is _NO_ support. Use it at your own risk.
+
+If you find a bug, fix it.  Then, send me the diff and I'll merge it into the code.
+
+"""
+
+from __future__ import print_function
+import sys
+import os
+import time
+import json
+import shlex
+import shutil
+import tempfile
+import threading
+from subprocess import Popen, PIPE, STDOUT
+from ssacl import *
+
+try:
+   from shlex import quote
+except ImportError:
+   from pipes import quote
+
+# Keeps the lines relayed from the workers whole.
+OUTPUT_LOCK = threading.Lock()
+
+def parse_options( argv ):
+    """
+    This function handles the parsing of the command line arguments.
+
+    Args:
+      argv: A list of command line arguments, passed in from sys.argv
+
+    Returns
+      options: A dictionary of the command line option settings
+      args   : The ssacl arguments, everything after --
+
+    """
+
+    import argparse
+    import textwrap
+    parser = argparse.ArgumentParser(
+                                     formatter_class = argparse.RawTextHelpFormatter,
+                                     prog = 'shard_acls.py',
+                                     usage = 'shard_acls.py [options] -- ssacl arguments',
+                                     description = textwrap.dedent('''\
+                                             shard_acls.py - Split an ssacl run across hosts
+
+                                             Runs ssacl with the arguments after -- as N workers, each with
+                                             --shard i/N, and merges their output, progress and statistics.
+
+                                             '''),
+                                     epilog = textwrap.dedent('''\
+
+                                             Chad Kerner - ckerner@illinois.edu
+                                             Senior Storage Engineer, Storage Enabling Technologies
+                                             National Center for Supercomputing Applications
+                                             University of Illinois, Urbana-Champaign''')
+                                    )
+
+    parser.add_argument( "-n", "--shards",
+                         dest = "shards",
+                         default = None,
+                         type = int,
+                         action = 'store',
+                         help = "The number of workers. Default: one per host")
+
+    parser.add_argument( "--hosts",
+                         dest = "hosts",
+                         default = None,
+                         action = 'store',
+                         help = "Comma separated hosts to run the workers on, in turn. Default: all local")
+
+    parser.add_argument( "--rsh",
+                         dest = "rsh",
+                         default = 'ssh -o BatchMode=yes',
+                         action = 'store',
+                         help = "How to run a command on a host. Default: %(default)s")
+
+    parser.add_argument( "--ssacl",
+                         dest = "ssacl",
+                         default = 'ssacl',
+                         action = 'store',
+                         help = "The ssacl command on the hosts. Default: %(default)s")
+
+    parser.add_argument( "--work-dir",
+                         dest = "work_dir",
+                         default = None,
+                         action = 'store',
+                         help = "Where the workers write their statistics. It must be shared by all of the hosts.\nDefault: a temporary directory when all the workers are local")
+
+    parser.add_argument( "--journal",
+                         dest = "journal",
+                         default = None,
+                         action = 'store',
+                         help = "Give every worker a --journal, this prefix followed by .i for shard i. Default: %(default)s")
+
+    parser.add_argument( "--resume",
+                         dest = "resume",
+                         default = None,
+                         action = 'store',
+                         help = "Resume the shards recorded in the journals with this prefix. Default: %(default)s")
+
+    parser.add_argument( "--interval",
+                         dest = "interval",
+                         default = 10,
+                         type = int,
+                         action = 'store',
+                         help = "Seconds between the progress reports. Default: %(default)s")
+
+    parser.add_argument( "--stats",
+                         dest = "stats",
+                         default = False,
+                         action = 'store_true',
+                         help = "Print the merged call counts and timings of the workers on stderr at exit. Default: %(default)s")
+
+    parser.add_argument( "--stats-file",
+                         dest = "stats_file",
+                         default = None,
+                         action = 'store',
+                         help = "Write the merged timings to this file during the run, in the Prometheus text\nformat when it ends in .prom and JSON otherwise. Default: %(default)s")
+
+    parser.add_argument( "-q", "--quiet",
+                         dest = "quiet",
+                         default = False,
+                         action = 'store_true',
+                         help = "No progress reports. Default: %(default)s")
+
+    if '--' in argv:
+       idx = argv.index( '--' )
+       ( argv, command ) = ( argv[0:idx], argv[idx + 1:] )
+    else:
+       command = []
+
+    options = parser.parse_args( argv )
+    return ( options, command )
+
+
+class shard_worker:
+      """
+      One ssacl --shard i/N process, local or behind the remote shell.
+      """
+      def __init__( self, index, count, host, argv, stats_file ):
+          self.index = index
+          self.count = count
+          self.host = host
+          self.argv = argv
+          self.stats_file = stats_file
+          self.label = '%d/%d' % ( index, count )
+          self.proc = None
+          self.relay = None
+          self.rc = None
+          self.started = None
+          self.ended = None
+
+
+      def start( self, rsh ):
+          """
+          Start the worker and a thread relaying its output.
+
+          :param: The remote shell command as a list, used when it has a host.
+          """
+          env = dict( os.environ )
+          env['PYTHONUNBUFFERED'] = '1'
+          if self.host:
+             remote = 'cd %s && env PYTHONUNBUFFERED=1 %s' % ( quote( os.getcwd() ), ' '.join( [ quote( arg ) for arg in self.argv ] ) )
+             cmd = rsh + [ self.host, remote ]
+          else:
+             cmd = self.argv
+
+          self.started = time.time()
+          self.proc = Popen( cmd, stdout=PIPE, stderr=STDOUT, env=env )
+          self.relay = threading.Thread( target=self._relay )
+          self.relay.daemon = True
+          self.relay.start()
+
+
+      def _relay( self ):
+          # The lines are passed on as bytes, since they hold file names
+          # that need not be valid UTF-8.
+          prefix = ( '%s %s: ' % ( self.label, self.host or 'local' ) ).encode( 'utf-8' )
+          out = getattr( sys.stdout, 'buffer', sys.stdout )
+          for line in iter( self.proc.stdout.readline, b'' ):
+              with OUTPUT_LOCK:
+                 sys.stdout.flush()
+                 out.write( prefix + line )
+                 out.flush()
+          self.proc.stdout.close()
+
+
+      def poll( self ):
+          """
+          :return: True while the worker is running.
+          """
+          if self.rc == None:
+             self.rc = self.proc.poll()
+             if self.rc != None:
+                self.relay.join()
+                self.ended = time.time()
+          return self.rc == None
+
+
+      def terminate( self ):
+          if self.poll():
+             self.proc.terminate()
+
+
+      def stats( self ):
+          """
+          :return: The last statistics the worker wrote, or None before the first.
+          """
+          try:
+             with open( self.stats_file ) as fd:
+                return json.load( fd )
+          except ( IOError, OSError, ValueError ):
+             return None
+
+
+def splits_paths( command ):
+    """
+    True if the ssacl command works on paths that are walked, and not on
+    the records of a backup.
+    """
+    for arg in command:
+        if arg.split( '=' )[0] in [ '--restore', '--diff' ]:
+           return False
+    return True
+
+
+def split_paths( options, command, count, work_dir ):
+    """
+    Walk the paths once with ssacl --split, writing the list of each shard
+    to the work directory.
+
+    :return: The ssacl exit status.
+    """
+    argv = shlex.split( options.ssacl ) + command + [ '--split', str( count ), '--split-dir', work_dir ]
+    if options.quiet:
+       argv.append( '--quiet' )
+    return Popen( argv ).wait()
+
+
+def worker_argv( options, command, index, count, stats_file, split_dir=None ):
+    """
+    The ssacl command line of one worker.
+    """
+    argv = shlex.split( options.ssacl ) + command
+    argv += [ '--shard', '%d/%d' % ( index, count ),
+              '--stats-file', stats_file, '--stats-interval', str( options.interval ) ]
+    if split_dir:
+       argv += [ '--split-dir', split_dir ]
+    if options.journal:
+       argv += [ '--journal', '%s.%d' % ( options.journal, index ) ]
+    if options.resume:
+       argv += [ '--resume', '%s.%d' % ( options.resume, index ) ]
+    return argv
+
+
+def merge_stats( workers ):
+    """
+    Add up the statistics the workers have written so far.
+
+    :return: A run_stats object, with its totals set.
+    """
+    merged = run_stats()
+    merged.totals = counters()
+    for worker in workers:
+        stats = worker.stats()
+        if stats == None:
+           continue
+        merged.merge( stats )
+        for ( name, value ) in stats.get( 'totals', {} ).items():
+            merged.totals.add( name, value )
+    return merged
+
+
+def report_progress( merged, workers ):
+    totals = merged.totals
+    done = totals.get( 'changed' ) + totals.get( 'unchanged' ) + totals.get( 'failed' )
+    running = len( [ worker for worker in workers if worker.rc == None ] )
+    with OUTPUT_LOCK:
+       print("Progress: Changed: %d  Unchanged: %d  Failed: %d  %.0f files/s  Running: %d of %d" % (
+             totals.get( 'changed' ), totals.get( 'unchanged' ), totals.get( 'failed' ),
+             done / max( time.time() - merged.started, 0.001 ), running, len( workers ) ))
+       sys.stdout.flush()
+
+
+def report_shards( workers ):
+    """
+    Print how each worker ended and what it did.
+    """
+    print("%-7s %-20s %5s %10s %10s %8s %10s" % ( 'Shard', 'Host', 'Exit', 'Changed', 'Unchanged', 'Failed', 'Seconds' ))
+    for worker in workers:
+        totals = ( worker.stats() or {} ).get( 'totals', {} )
+        print("%-7s %-20s %5s %10d %10d %8d %10.1f" % ( worker.label, worker.host or 'local', worker.rc,
+              totals.get( 'changed', 0 ), totals.get( 'unchanged', 0 ), totals.get( 'failed', 0 ),
+              ( worker.ended or time.time() ) - worker.started ))
+
+
+if __name__ == '__main__':
+   ( options, command ) = parse_options( sys.argv[1:] )
+
+   if not command:
+      print("ERROR: No ssacl arguments were given after --.")
+      sys.exit(1)
+
+   for arg in command:
+       if arg.split( '=' )[0] in [ '--shard', '--split', '--split-dir', '--stats-file', '--stats-interval', '--journal', '--resume' ]:
+          print("ERROR: %s is set for every worker by shard_acls.py." % ( arg.split( '=' )[0] ))
+          sys.exit(1)
+
+   hosts = []
+   if options.hosts:
+      hosts = [ host for host in options.hosts.split( ',' ) if host ]
+   count = options.shards or len( hosts )
+   if count < 1:
+      print("ERROR: Give the number of shards with -n, or the hosts to run them on with --hosts.")
+      sys.exit(1)
+
+   if options.journal and options.resume:
+      print("ERROR: Give either --journal or --resume.")
+      sys.exit(1)
+
+   work_dir = options.work_dir
+   if work_dir == None:
+      if hosts:
+         print("ERROR: --hosts needs a --work-dir that all of the hosts can write to.")
+         sys.exit(1)
+      work_dir = tempfile.mkdtemp( prefix='ssacl-shards.' )
+   elif not os.path.isdir( work_dir ):
+      os.makedirs( work_dir )
+
+   split_dir = None
+   if splits_paths( command ):
+      split_dir = os.path.abspath( work_dir )
+      if split_paths( options, command, count, split_dir ) != 0:
+         print("ERROR: Splitting the paths into %d lists failed." % ( count ))
+         sys.exit(1)
+
+   workers = []
+   for index in range( count ):
+       stats_file = os.path.join( os.path.abspath( work_dir ), 'shard.%d.json' % ( index ) )
+       if os.path.exists( stats_file ):
+          os.unlink( stats_file )
+       host = hosts[index % len( hosts )] if hosts else None
+       workers.append( shard_worker( index, count, host, worker_argv( options, command, index, count, stats_file, split_dir ), stats_file ) )
+
+   rsh = shlex.split( options.rsh )
+   for worker in workers:
+       worker.start( rsh )
+
+   merged = merge_stats( workers )
+   last_report = time.time()
+   try:
+      while [ worker for worker in workers if worker.poll() ]:
+         time.sleep( 0.2 )
+         if time.time() - last_report >= options.interval:
+            merged = merge_stats( workers )
+            merged.started = workers[0].started
+            if options.stats_file:
+               merged.write( options.stats_file )
+            if not options.quiet:
+               report_progress( merged, workers )
+            last_report = time.time()
+   except KeyboardInterrupt:
+      print("Interrupted, stopping the workers.")
+      for worker in workers:
+          worker.terminate()
+      while [ worker for worker in workers if worker.poll() ]:
+         time.sleep( 0.2 )
+
+   merged = merge_stats( workers )
+   merged.started = workers[0].started
+   if options.stats_file:
+      merged.write( options.stats_file )
+
+   if not options.quiet:
+      report_shards( workers )
+   totals = merged.totals
+   print("Changed: %d  Unchanged: %d  Failed: %d" % ( totals.get( 'changed' ), totals.get( 'unchanged' ), totals.get( 'failed' ) ))
+
+   if options.stats:
+      print( merged.report(), file=sys.stderr )
+
+   if options.work_dir == None:
+      shutil.rmtree( work_dir )
+   elif split_dir:
+      for index in range( count ):
+          os.unlink( os.path.join( split_dir, 'paths.%d' % ( index ) ) )
+
+   failed = [ worker for worker in workers if worker.rc != 0 ]
+   if failed:
+      print("ERROR: %d of %d shards failed: %s" % ( len( failed ), count, ' '.join( [ worker.label for worker in failed ] ) ))
+   if failed or totals.get( 'failed' ):
+      sys.exit(1)
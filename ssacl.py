@@ -28,7 +28,7 @@ our needs arise in our clusters.
 """
 
 from __future__ import print_function
-from subprocess import Popen, PIPE
+from subprocess import Popen, PIPE, STDOUT
 import sys
 import os
 import shlex
@@ -36,10 +36,63 @@ import json
 from stat import *
 import tempfile
 import pprint
+import gc
+import uuid
+import itertools
+import collections
+import hashlib
+import shutil
+import atexit
+import gzip
+import zlib
+import glob
+import time
+import bisect
+import heapq
+import struct
+import errno
+import pwd
+import grp
+import threading
+try:
+   import queue
+except ImportError:
+   import Queue as queue
+try:
+   intern = sys.intern
+except AttributeError:
+   pass
+try:
+   from os import scandir
+except ImportError:
+   try:
+      from scandir import scandir
+   except ImportError:
+      scandir = None
 
 DRYRUN = 0
-MMGETACL = '/usr/lpp/mmfs/bin/mmgetacl'
-MMPUTACL = '/usr/lpp/mmfs/bin/mmputacl'
+MMGETACL = os.environ.get( 'SSACL_MMGETACL', '/usr/lpp/mmfs/bin/mmgetacl' )
+MMPUTACL = os.environ.get( 'SSACL_MMPUTACL', '/usr/lpp/mmfs/bin/mmputacl' )
+MMDELACL = os.environ.get( 'SSACL_MMDELACL', '/usr/lpp/mmfs/bin/mmdelacl' )
+MMAPPLYPOLICY = os.environ.get( 'SSACL_MMAPPLYPOLICY', '/usr/lpp/mmfs/bin/mmapplypolicy' )
+BATCH_SIZE = 256
+MAX_OPEN_DIRS = 64
+# A progress_journal is synced to disk every this many records or seconds.
+JOURNAL_SYNC_RECORDS = 1000
+JOURNAL_SYNC_SECONDS = 5
+# diff_backups() sorts this many records in memory at a time, and merges
+# this many sorted runs on disk at a time.
+DIFF_CHUNK = 200000
+DIFF_MERGE_WIDTH = 32
+# The run_stats collecting the timings, or None when they are not wanted.
+STATS = None
+# The acl_throttle pacing the mmgetacl and mmputacl calls, or None.
+THROTTLE = None
+# The ( run_stats, path ) of every --stats-file writer still running, see
+# run_stats.start_writer().
+STATS_WRITERS = set()
+# Every acl_file_cache whose directory has not been removed yet.
+ACL_FILE_CACHES = set()
 
 """
 ACL Dictionary Structure:
@@ -81,8 +134,19 @@ def execute_command( commandString=None, Debug=False ):
        return( 99999999, None, None )
 
     shellCommand = shlex.split( commandString )
-    subp = Popen( shellCommand, stdout=PIPE, stderr=PIPE )
-    ( outdata, errdata ) = subp.communicate()
+    throttle = THROTTLE if shellCommand[0] in ( MMGETACL, MMPUTACL, MMDELACL ) else None
+    if throttle:
+       throttle.acquire()
+    if STATS or throttle:
+       start = time.time()
+    try:
+       subp = Popen( shellCommand, stdout=PIPE, stderr=PIPE, universal_newlines=True )
+       ( outdata, errdata ) = subp.communicate()
+    finally:
+       if throttle:
+          throttle.release( time.time() - start )
+    if STATS:
+       STATS.record( os.path.basename( shellCommand[0] ), time.time() - start, subp.returncode != 0 )
 
     if Debug:
        print("DEBUG: Command: {}".format(commandString))
@@ -93,12 +157,615 @@ def execute_command( commandString=None, Debug=False ):
     return  ( subp.returncode, outdata, errdata )
 
 
+def parse_acl( aclText, fqpn=None, dirname=None ):
+    """
+    Parse the output of mmgetacl, for either an access or a default ACL, into
+    the ACL dictionary described above. Every line is split exactly once and
+    dispatched on its tag.
+
+    :param: The text printed by mmgetacl.
+    :param: The value for the FQPN key. Left out if None.
+    :param: The value for the DIRNAME key. Left out if None.
+    :return: A dict with the ACL information.
+    """
+    if STATS:
+       start = time.time()
+
+    mydict = {}
+    mydict['GROUPS'] = groups = {}
+    mydict['USERS'] = users = {}
+    if fqpn != None:
+       mydict['FQPN'] = fqpn
+    if dirname != None:
+       mydict['DIRNAME'] = dirname
+
+    if isinstance( aclText, bytes ) and not isinstance( aclText, str ):
+       aclText = aclText.decode()
+
+    for line in aclText.splitlines():
+        fields = line.split( ':', 3 )
+        nfields = len( fields )
+        if nfields < 2:
+           continue
+        tag = fields[0]
+
+        if tag == 'user' or tag == 'group':
+           if nfields < 3:
+              continue
+           name = fields[1]
+           if name == '':
+              if tag == 'user':
+                 mydict['USERP'] = fields[2]
+              else:
+                 mydict['GROUPP'] = fields[2]
+           else:
+              entry = {}
+              entry['PERMS'] = fields[2][0:4]
+              # Named entries outside the mask carry a "#effective: r---" comment.
+              if nfields == 4:
+                 entry['EFFECTIVE'] = fields[3].strip()[0:4]
+              else:
+                 entry['EFFECTIVE'] = '????'
+              if tag == 'user':
+                 users[name] = entry
+              else:
+                 groups[name] = entry
+        elif tag == 'other':
+           if nfields > 2:
+              mydict['OTHERP'] = fields[2]
+        elif tag == 'mask':
+           if nfields > 2:
+              mydict['MASK'] = fields[2]
+        elif tag == '#owner':
+           mydict['OWNER'] = fields[1]
+        elif tag == '#group':
+           mydict['GROUP'] = fields[1]
+
+    if STATS:
+       STATS.record( 'parse', time.time() - start )
+    return mydict
+
+
+def parse_acls( aclTexts, fqpns=None, dirnames=None ):
+    """
+    Parse a batch of mmgetacl outputs in one call. The garbage collector is
+    paused while the batch is built; the dicts hold no cycles and a large batch
+    otherwise triggers a full collection every few thousand ACLs.
+
+    :param: A list of ACL texts.
+    :param: An optional list of FQPN values, one per text.
+    :param: An optional list of DIRNAME values, one per text.
+    :return: A list of ACL dicts, in the same order as the texts.
+    """
+    count = len( aclTexts )
+    if fqpns == None:
+       fqpns = [ None ] * count
+    if dirnames == None:
+       dirnames = [ None ] * count
+
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+       return [ parse_acl( text, fqpn, dirname ) for ( text, fqpn, dirname ) in zip( aclTexts, fqpns, dirnames ) ]
+    finally:
+       if gc_enabled:
+          gc.enable()
+
+
+_FETCH_SCRIPT = """
+getacl=$1; token=$2; want_default=$3
+shift 3
+idx=0
+for p do
+   if [ -d "$p" ] ; then kind=d ; else kind=f ; fi
+   out=$("$getacl" "$p" 2>&1)
+   printf '%s %s acl %s %s\n%s\n' "$token" "$idx" "$?" "$kind" "$out"
+   if [ "$want_default" = 1 ] && [ "$kind" = d ] ; then
+      out=$("$getacl" -d "$p" 2>&1)
+      printf '%s %s dacl %s %s\n%s\n' "$token" "$idx" "$?" "$kind" "$out"
+   fi
+   idx=$((idx + 1))
+done
+"""
+
+
+def fetch_acls( paths, with_default=False, batch_size=BATCH_SIZE ):
+    """
+    Fetch the ACLs for many paths with one shell per batch instead of one
+    mmgetacl process started from python for every path. Each record the shell
+    prints starts with a header line carrying a random token, the index of the
+    path, which ACL it is, the mmgetacl return code and the file type.
+
+    :param: An iterable of file or directory names.
+    :param: Fetch the default ACL for the directories as well.
+    :param: The number of paths handed to each shell.
+    :return: A generator of ( path, acls, default_acls, error ) tuples, one per
+             path in input order. error is None, or the mmgetacl output of the
+             failing call.
+    """
+    paths = iter( paths )
+    while True:
+       batch = [ os.path.abspath( path ) for path in itertools.islice( paths, batch_size ) ]
+       if not batch:
+          break
+
+       for result in BACKEND.fetch_batch( batch, with_default ):
+           yield result
+
+
+def _fetch_acl_batch( batch, with_default ):
+    token = '#ssacl-' + uuid.uuid4().hex
+    cmd = [ '/bin/sh', '-c', _FETCH_SCRIPT, 'ssacl', MMGETACL, token, '1' if with_default else '0' ] + batch
+    # The shell runs the mmgetacl calls one after another, so the batch
+    # counts as one call in flight but every path against the rate.
+    if THROTTLE:
+       THROTTLE.acquire( len( batch ) )
+    if STATS or THROTTLE:
+       start = time.time()
+    try:
+       subp = Popen( cmd, stdout=PIPE, stderr=PIPE, universal_newlines=True )
+       ( outdata, errdata ) = subp.communicate()
+    finally:
+       if THROTTLE:
+          THROTTLE.release( time.time() - start, len( batch ) )
+    if STATS:
+       STATS.record( 'mmgetacl_batch', time.time() - start, subp.returncode != 0 )
+       STATS.count( 'mmgetacl_batch_paths', len( batch ) )
+
+    records = {}
+    header = None
+    lines = []
+    for line in outdata.splitlines() + [ token ]:
+        if line.startswith( token ):
+           if header:
+              records[ ( header[1], header[2] ) ] = ( header, '\n'.join( lines ) )
+           header = line.split()
+           lines = []
+        else:
+           lines.append( line )
+
+    for idx in range( len( batch ) ):
+        path = batch[idx]
+        record = records.get( ( str( idx ), 'acl' ) )
+        if record == None:
+           yield ( path, None, None, "mmgetacl batch failed: %s" % ( errdata ) )
+           continue
+
+        ( header, text ) = record
+        if header[3] != '0':
+           if STATS:
+              STATS.count( 'mmgetacl_batch_errors' )
+           yield ( path, None, None, text )
+           continue
+
+        if header[4] == 'd':
+           dirname = path
+        else:
+           dirname = os.path.dirname( path )
+        acls = parse_acl( text, path, dirname )
+
+        default_acls = None
+        record = records.get( ( str( idx ), 'dacl' ) )
+        if record != None:
+           ( header, text ) = record
+           if header[3] != '0':
+              yield ( path, acls, None, text )
+              continue
+           default_acls = parse_acl( text, dirname )
+
+        yield ( path, acls, default_acls, None )
+
+
+class mm_backend:
+      """
+      Read and write ACLs with the SpectrumScale mmgetacl and mmputacl
+      commands, one process per call, or one shell per batch of reads.
+      """
+      name = 'mm'
+
+      def get_command( self ):
+          return MMGETACL
+
+
+      def get_acl_text( self, filename, default=False ):
+          """
+          :param: The file or directory.
+          :param: Fetch the default ACL instead of the access ACL.
+          :return: The ACL text as mmgetacl prints it, or None if it failed.
+          """
+          if default:
+             cmd = MMGETACL + ' -d "' + filename + '"'
+          else:
+             cmd = MMGETACL + ' "' + filename + '"'
+          #cmd = [ MMGETACL, filename ]
+
+          ( rc, stdout, stderr ) = execute_command( cmd )
+          if rc != 0:
+             print("Command: %s ERROR: %s" % ( cmd, rc ) )
+             print("STDOUT: %s\nSTDERR: %s" % ( stdout, stderr ) )
+             return None
+          return stdout
+
+
+      def put_acl( self, filename, aclfile, default=False, dryrun=False, verbose=False ):
+          """
+          Set the ACL, or the default ACL, of a file to the contents of an ACL file.
+          An empty default ACL removes it, with mmdelacl -d.
+
+          :return: The mmputacl return code. 0 in dry-run mode.
+          """
+          if default and os.path.getsize( aclfile ) == 0:
+             cmd = MMDELACL + ' -d "' + filename + '"'
+          elif default:
+             cmd = MMPUTACL + ' -d -i ' + aclfile + ' "' + filename + '"'
+          else:
+             cmd = MMPUTACL + ' -i ' + aclfile + ' "' + filename + '"'
+          #cmd = [ MMPUTACL, '-i', aclfile, filename ]
+          rc = 0
+          if dryrun:
+             print( "".join(cmd) )
+          else:
+             if verbose:
+                print( "".join(cmd) )
+             ( rc, stdout, stderr ) = execute_command( cmd )
+             if rc != 0:
+                print("Command: %s ERROR: %s" % ( cmd, rc ) )
+                print("STDOUT: %s\nSTDERR: %s" % ( stdout, stderr ) )
+          return rc
+
+
+      def fetch_batch( self, batch, with_default ):
+          """
+          The ACLs of a list of absolute paths, as fetch_acls() returns them.
+          """
+          return _fetch_acl_batch( batch, with_default )
+
+
+ACL_XATTR_ACCESS = 'system.posix_acl_access'
+ACL_XATTR_DEFAULT = 'system.posix_acl_default'
+
+class xattr_backend:
+      """
+      Read and write POSIX ACLs in process, through the system.posix_acl_access
+      and system.posix_acl_default extended attributes, with no mmgetacl or
+      mmputacl processes. The binary attributes are decoded to, and encoded
+      from, the mmgetacl text format, so the rest of the module is the same
+      for both backends. Needs Linux and Python 3.3 or later.
+
+      POSIX ACLs have no control permission. The owner entry always shows
+      it, since the owner can always change the ACL, and it is ignored when
+      an ACL is written.
+      """
+      name = 'xattr'
+
+      VERSION = 2
+      USER_OBJ = 0x01
+      USER = 0x02
+      GROUP_OBJ = 0x04
+      GROUP = 0x08
+      MASK = 0x10
+      OTHER = 0x20
+      UNDEFINED_ID = 0xffffffff
+
+      def __init__( self ):
+          if not hasattr( os, 'getxattr' ):
+             raise OSError( errno.ENOTSUP, "The xattr backend needs os.getxattr, Python 3.3 or later on Linux" )
+          self.user_names = {}
+          self.group_names = {}
+          self.user_ids = {}
+          self.group_ids = {}
+          self.encoded = {}
+
+
+      def get_command( self ):
+          return 'getxattr'
+
+
+      def user_name( self, uid ):
+          name = self.user_names.get( uid )
+          if name == None:
+             try:
+                name = pwd.getpwuid( uid ).pw_name
+             except KeyError:
+                name = str( uid )
+             self.user_names[uid] = name
+          return name
+
+
+      def group_name( self, gid ):
+          name = self.group_names.get( gid )
+          if name == None:
+             try:
+                name = grp.getgrgid( gid ).gr_name
+             except KeyError:
+                name = str( gid )
+             self.group_names[gid] = name
+          return name
+
+
+      def user_id( self, name ):
+          uid = self.user_ids.get( name )
+          if uid == None:
+             if name.isdigit():
+                uid = int( name )
+             else:
+                uid = pwd.getpwnam( name ).pw_uid
+             self.user_ids[name] = uid
+          return uid
+
+
+      def group_id( self, name ):
+          gid = self.group_ids.get( name )
+          if gid == None:
+             if name.isdigit():
+                gid = int( name )
+             else:
+                gid = grp.getgrnam( name ).gr_gid
+             self.group_ids[name] = gid
+          return gid
+
+
+      def decode( self, blob ):
+          """
+          Decode a POSIX ACL extended attribute.
+
+          :return: A list of ( tag, permission bits, id ) tuples.
+          """
+          if len( blob ) < 4 or ( len( blob ) - 4 ) % 8 != 0:
+             raise ValueError( "Bad POSIX ACL attribute length %d" % ( len( blob ) ) )
+          if struct.unpack_from( '<I', blob )[0] != self.VERSION:
+             raise ValueError( "Unknown POSIX ACL version %d" % ( struct.unpack_from( '<I', blob )[0] ) )
+          return [ struct.unpack_from( '<HHI', blob, offset ) for offset in range( 4, len( blob ), 8 ) ]
+
+
+      def encode( self, entries ):
+          """
+          Encode ( tag, permission bits, id ) tuples as a POSIX ACL extended
+          attribute. The entries are put in the order the kernel requires.
+          """
+          entries = sorted( entries )
+          return struct.pack( '<I', self.VERSION ) + b''.join( [ struct.pack( '<HHI', tag, perm, uid ) for ( tag, perm, uid ) in entries ] )
+
+
+      def perm_text( self, perm, control=False ):
+          text = 'r' if perm & 4 else '-'
+          text += 'w' if perm & 2 else '-'
+          text += 'x' if perm & 1 else '-'
+          text += 'c' if control else '-'
+          return text
+
+
+      def perm_bits( self, text ):
+          perm = 0
+          if text[0:1] == 'r':
+             perm |= 4
+          if text[1:2] == 'w':
+             perm |= 2
+          if text[2:3] == 'x':
+             perm |= 1
+          return perm
+
+
+      def render( self, mystat, entries, default=False ):
+          """
+          The ACL text, as mmgetacl would print it, for the decoded entries.
+          Without entries the access ACL is the one implied by the mode bits
+          and the default ACL is empty.
+          """
+          lines = [ '#owner:%s' % ( self.user_name( mystat.st_uid ) ),
+                    '#group:%s' % ( self.group_name( mystat.st_gid ) ) ]
+          if entries == None:
+             if not default:
+                mode = mystat.st_mode
+                lines.append( 'user::' + self.perm_text( mode >> 6, True ) )
+                lines.append( 'group::' + self.perm_text( mode >> 3 ) )
+                lines.append( 'other::' + self.perm_text( mode ) )
+             return '\n'.join( lines ) + '\n'
+
+          mask = 7
+          for ( tag, perm, uid ) in entries:
+              if tag == self.MASK:
+                 mask = perm
+
+          named = []
+          for ( tag, perm, uid ) in entries:
+              if tag == self.USER_OBJ:
+                 lines.append( 'user::' + self.perm_text( perm, True ) )
+              elif tag == self.GROUP_OBJ:
+                 lines.append( 'group::' + self.perm_text( perm ) )
+              elif tag == self.OTHER:
+                 lines.append( 'other::' + self.perm_text( perm ) )
+              elif tag == self.MASK:
+                 lines.append( 'mask::' + self.perm_text( perm ) )
+              else:
+                 if tag == self.USER:
+                    line = 'user:%s:%s' % ( self.user_name( uid ), self.perm_text( perm ) )
+                 else:
+                    line = 'group:%s:%s' % ( self.group_name( uid ), self.perm_text( perm ) )
+                 if perm & mask != perm:
+                    line += '\t#effective:' + self.perm_text( perm & mask )
+                 named.append( line )
+          return '\n'.join( lines + named ) + '\n'
+
+
+      def acl_entries( self, myacls ):
+          """
+          The ( tag, permission bits, id ) entries for an ACL dict. A mask is
+          only kept when there are named entries; without one in the dict it
+          is the union of the group class permissions, as setfacl does.
+          """
+          if 'USERP' not in myacls:
+             return []
+
+          entries = [ ( self.USER_OBJ, self.perm_bits( myacls['USERP'] ), self.UNDEFINED_ID ),
+                      ( self.GROUP_OBJ, self.perm_bits( myacls.get( 'GROUPP', '' ) ), self.UNDEFINED_ID ),
+                      ( self.OTHER, self.perm_bits( myacls.get( 'OTHERP', '' ) ), self.UNDEFINED_ID ) ]
+
+          group_class = entries[1][1]
+          for ( name, entry ) in myacls.get( 'USERS', {} ).items():
+              perm = self.perm_bits( entry['PERMS'] )
+              entries.append( ( self.USER, perm, self.user_id( name ) ) )
+              group_class |= perm
+          for ( name, entry ) in myacls.get( 'GROUPS', {} ).items():
+              perm = self.perm_bits( entry['PERMS'] )
+              entries.append( ( self.GROUP, perm, self.group_id( name ) ) )
+              group_class |= perm
+
+          if len( entries ) > 3:
+             if 'MASK' in myacls:
+                entries.append( ( self.MASK, self.perm_bits( myacls['MASK'] ), self.UNDEFINED_ID ) )
+             else:
+                entries.append( ( self.MASK, group_class, self.UNDEFINED_ID ) )
+          return entries
+
+
+      def read_text( self, filename, mystat, default=False ):
+          """
+          The ACL text of a file. Raises OSError when the attribute can not be read.
+          """
+          if default:
+             attr = ACL_XATTR_DEFAULT
+          else:
+             attr = ACL_XATTR_ACCESS
+
+          if STATS:
+             start = time.time()
+          try:
+             entries = self.decode( os.getxattr( filename, attr ) )
+          except OSError as e:
+             # A file system without POSIX ACLs answers ENOTSUP; its mode
+             # bits are the whole ACL, as for a file with none set.
+             if e.errno not in ( errno.ENODATA, errno.ENOTSUP, errno.EOPNOTSUPP ):
+                if STATS:
+                   STATS.record( 'getxattr', time.time() - start, True )
+                raise
+             entries = None
+          if STATS:
+             STATS.record( 'getxattr', time.time() - start )
+          return self.render( mystat, entries, default )
+
+
+      def get_acl_text( self, filename, default=False ):
+          try:
+             mystat = os.stat( filename )
+             if default and not S_ISDIR( mystat.st_mode ):
+                raise OSError( errno.ENOTDIR, "Default ACLs are only valid for directories" )
+             return self.read_text( filename, mystat, default )
+          except ( OSError, ValueError ) as e:
+             print("Command: getxattr \"%s\" ERROR: %s" % ( filename, e ) )
+             return None
+
+
+      def put_acl( self, filename, aclfile, default=False, dryrun=False, verbose=False ):
+          """
+          Set the ACL, or the default ACL, of a file to the contents of an ACL
+          file. An empty default ACL removes it. The encoded ACL is kept for
+          each ACL file, so an ACL file applied to many files is read once.
+
+          :return: 0, or 1 when it failed.
+          """
+          if default:
+             attr = ACL_XATTR_DEFAULT
+          else:
+             attr = ACL_XATTR_ACCESS
+
+          cmd = 'setxattr ' + attr + ' ' + aclfile + ' "' + filename + '"'
+          if dryrun:
+             print( cmd )
+             return 0
+          if verbose:
+             print( cmd )
+
+          if STATS:
+             start = time.time()
+          rc = 0
+          try:
+             blob = self.encoded.get( aclfile )
+             if blob == None:
+                fd = open( aclfile )
+                entries = self.acl_entries( parse_acl( fd.read() ) )
+                fd.close()
+                if entries:
+                   blob = self.encode( entries )
+                else:
+                   blob = b''
+                self.encoded[aclfile] = blob
+
+             if blob:
+                os.setxattr( filename, attr, blob )
+             elif default:
+                try:
+                   os.removexattr( filename, attr )
+                except OSError as e:
+                   if e.errno != errno.ENODATA:
+                      raise
+             else:
+                raise ValueError( "%s holds no ACL" % ( aclfile ) )
+          except ( OSError, IOError, KeyError, ValueError ) as e:
+             print("Command: %s ERROR: %s" % ( cmd, e ) )
+             rc = 1
+          if STATS:
+             STATS.record( 'setxattr', time.time() - start, rc != 0 )
+          return rc
+
+
+      def fetch_batch( self, batch, with_default ):
+          """
+          The ACLs of a list of absolute paths, as fetch_acls() returns them.
+          """
+          for path in batch:
+              try:
+                 mystat = os.stat( path )
+                 if S_ISDIR( mystat.st_mode ):
+                    dirname = path
+                 else:
+                    dirname = os.path.dirname( path )
+                 acls = parse_acl( self.read_text( path, mystat ), path, dirname )
+              except ( OSError, ValueError ) as e:
+                 yield ( path, None, None, str( e ) )
+                 continue
+
+              default_acls = None
+              if with_default and S_ISDIR( mystat.st_mode ):
+                 try:
+                    default_acls = parse_acl( self.read_text( path, mystat, True ), dirname )
+                 except ( OSError, ValueError ) as e:
+                    yield ( path, acls, None, str( e ) )
+                    continue
+              yield ( path, acls, default_acls, None )
+
+
+BACKENDS = { 'mm': mm_backend, 'xattr': xattr_backend }
+BACKEND = mm_backend()
+
+def set_backend( name ):
+    """
+    Choose how ACLs are read and written: mm for the mmgetacl and mmputacl
+    commands, xattr for the POSIX ACL extended attributes.
+
+    :return: The backend object.
+    """
+    global BACKEND
+    BACKEND = BACKENDS[name]()
+    return BACKEND
+
+
+def get_backend():
+    return BACKEND
+
+
 class mmacls:
       """
       This class will handle the manipulation of the SpectrumScale ACLs
       on the files that need them.
       """
-      def __init__( self, fname=None ):
+      def __init__( self, fname=None, acls=None, default_acls=None ):
+          """
+          :param: The file or directory to work on.
+          :param: An ACL dict already fetched for it, eg. by fetch_acls(). The
+                  ACL is read with mmgetacl when this is None.
+          :param: A default ACL dict already fetched for it.
+          """
           self.debug = False
           self.dryrun = False
           self.verbose = False
@@ -118,7 +785,11 @@ class mmacls:
           else:
              self.dirname = os.path.dirname( self.filename )
 
-          self.get_acl()
+          self.default_acls = default_acls
+          if acls != None:
+             self.acls = acls
+          else:
+             self.get_acl()
 
 
       def dump_mmacl( self ):
@@ -128,31 +799,41 @@ class mmacls:
           pprint.pprint( self.acls )
 
 
-      def dump_raw_acl( self ):
-          cmd = MMGETACL + ' "' + self.filename + '"'
-          #cmd = [ MMGETACL, self.filename ]
+      def get_raw_acl( self, default=False ):
+          """
+          Return the ACL text exactly as mmgetacl prints it.
 
-          ( rc, stdout, stderr ) = execute_command( cmd )
-          if rc == 0:
+          :param: Fetch the default ACL instead of the access ACL.
+          :return: The ACL text, or None if mmgetacl failed.
+          """
+          return BACKEND.get_acl_text( self.filename, default )
+
+
+      def dump_raw_acl( self ):
+          output = self.get_raw_acl()
+          if output != None:
              for line in output.splitlines():
                  print( line )
              print("")
-          else:
-             print("Command: %s ERROR: %s" % ( cmd, rc ) )
-             print("STDOUT: %s\nSTDERR: %s" % ( stdout, stderr ) )
 
 
       def dump_raw_default_acl( self ):
-          cmd = MMGETACL + ' -d ' + self.filename
-          #cmd = [ MMGETACL, self.filename ]
-          ( rc, stdout, stderr ) = execute_command( cmd )
-          if rc == 0:
-             for line in stdout.splitlines():
+          output = self.get_raw_acl( default=True )
+          if output != None:
+             for line in output.splitlines():
                  print( line )
              print("")
-          else:
-             print("Command: %s ERROR: %s" % ( cmd, rc ) )
-             print("STDOUT: %s\nSTDERR: %s" % ( stdout, stderr ) )
+
+
+      def compact( self ):
+          """
+          The ACL and the default ACL as compact_acl values, to keep instead
+          of this object when many are held in memory.
+
+          :return: A ( compact_acl, compact_acl ) tuple. Either is None when
+                   that ACL was not fetched.
+          """
+          return ( compact_acl.from_dict( self.acls ), compact_acl.from_dict( self.default_acls ) )
 
 
       def clear_acls( self ):
@@ -180,53 +861,12 @@ class mmacls:
           :param fnam: The name of the file or directory to get the ACLs on.
           :return: Returns a dict with the ACL information.
           """
-
-          mydict = {}
-          mydict['GROUPS'] = {}
-          mydict['USERS'] = {}
-          mydict['FQPN'] = self.filename
-          mydict['DIRNAME'] = self.dirname
-
-          cmd = MMGETACL + ' "' + self.filename + '"'
-          #cmd = [ MMGETACL, self.filename ]
-          ( rc, output, stderr ) = execute_command( cmd )
-          if rc != 0:
-             print("Command: %s ERROR: %s" % ( cmd, rc ) )
-             print("STDOUT: %s\nSTDERR: %s" % ( stdout, stderr ) )
+          output = self.get_raw_acl()
+          if output == None:
+             self.acls = None
              return None
 
-          for line in output.splitlines():
-              if '#owner:' in line:
-                 mydict['OWNER'] = line.split(':')[1]
-              elif '#group:' in line:
-                 mydict['GROUP'] = line.split(':')[1]
-              elif line.startswith('user:'):
-                 if line.split(':')[1] == '':
-                    mydict['USERP'] = line.split(':')[2]
-                 else:
-                    user_name=line.split(':')[1]
-                    mydict['USERS'][user_name] = {}
-                    mydict['USERS'][user_name]['PERMS']=line.split(':')[2][0:4]
-                    if 'effective' in line:
-                       mydict['USERS'][user_name]['EFFECTIVE']=line.split(':')[3][1:5]
-                    else:
-                       mydict['USERS'][user_name]['EFFECTIVE']='????'
-              elif line.startswith('group:'):
-                 if line.split(':')[1] == '':
-                    mydict['GROUPP'] = line.split(':')[2]
-                 else:
-                    group_name=line.split(':')[1]
-                    mydict['GROUPS'][group_name] = {}
-                    mydict['GROUPS'][group_name]['PERMS']=line.split(':')[2][0:4]
-                    if 'effective' in line:
-                       mydict['GROUPS'][group_name]['EFFECTIVE']=line.split(':')[3][1:5]
-                    else:
-                       mydict['GROUPS'][group_name]['EFFECTIVE']='????'
-              elif 'other::' in line:
-                 mydict['OTHERP'] = line.split(':')[2]
-              elif 'mask::' in line:
-                 mydict['MASK'] = line.split(':')[2]
-          self.acls = mydict
+          self.acls = parse_acl( output, self.filename, self.dirname )
 
 
       def get_default_acl( self ):
@@ -236,53 +876,12 @@ class mmacls:
           :param fnam: The name of the file or directory to get the ACLs on.
           :return: Returns a dict with the ACL information.
           """
-
-          mydict = {}
-          mydict['GROUPS'] = {}
-          mydict['USERS'] = {}
-          mydict['FQPN'] = self.dirname
-
-          cmd = MMGETACL + ' -d "' + self.filename + '"'
-          #cmd = [ MMGETACL, self.filename ]
-          ( rc, output, stderr ) = execute_command( cmd )
-          if rc != 0:
-             print("Command: %s ERROR: %s" % ( cmd, rc ) )
-             print("STDOUT: %s\nSTDERR: %s" % ( stdout, stderr ) )
+          output = self.get_raw_acl( default=True )
+          if output == None:
+             self.default_acls = None
              return None
 
-
-          for line in output.splitlines():
-              if '#owner:' in line:
-                 mydict['OWNER'] = line.split(':')[1]
-              elif '#group:' in line:
-                 mydict['GROUP'] = line.split(':')[1]
-              elif line.startswith('user:'):
-                 if line.split(':')[1] == '':
-                    mydict['USERP'] = line.split(':')[2]
-                 else:
-                    user_name=line.split(':')[1]
-                    mydict['USERS'][user_name] = {}
-                    mydict['USERS'][user_name]['PERMS']=line.split(':')[2][0:4]
-                    if 'effective' in line:
-                       mydict['USERS'][user_name]['EFFECTIVE']=line.split(':')[3][1:5]
-                    else:
-                       mydict['USERS'][user_name]['EFFECTIVE']='????'
-              elif line.startswith('group:'):
-                 if line.split(':')[1] == '':
-                    mydict['GROUPP'] = line.split(':')[2]
-                 else:
-                    group_name=line.split(':')[1]
-                    mydict['GROUPS'][group_name] = {}
-                    mydict['GROUPS'][group_name]['PERMS']=line.split(':')[2][0:4]
-                    if 'effective' in line:
-                       mydict['GROUPS'][group_name]['EFFECTIVE']=line.split(':')[3][1:5]
-                    else:
-                       mydict['GROUPS'][group_name]['EFFECTIVE']='????'
-              elif 'other::' in line:
-                 mydict['OTHERP'] = line.split(':')[2]
-              elif 'mask::' in line:
-                 mydict['MASK'] = line.split(':')[2]
-          self.default_acls = mydict
+          self.default_acls = parse_acl( output, self.dirname )
 
 
       def add_user_acl( self, username, mask ):
@@ -375,7 +974,7 @@ class mmacls:
           :param: A username / uid for the user to remove.
           """
           if username in self.acls['USERS'].keys():
-             del self.default_acls['USERS'][username]
+             del self.acls['USERS'][username]
           else:
              print("%s does not have a user ACL on %s" % ( username, self.filename ))
 
@@ -443,19 +1042,9 @@ class mmacls:
           contents of the file specified in the function call.
 
           :param: A string containing the fully qualified path to the ACL file.
-          :return: Nothing
+          :return: The mmputacl return code. 0 in dry-run mode.
           """
-          cmd = MMPUTACL +  '-d -i ' + aclfile + ' "' + self.filename + '"'
-          #cmd = [ MMPUTACL, '-d', '-i', aclfile, "'"+self.filename+"'" ]
-          if self.dryrun:
-             print( "".join(cmd) )
-          else:
-             if self.verbose:
-                print( "".join(cmd) )
-             ( rc, stdout, stderr ) = execute_command( cmd )
-             if rc != 0:
-                print("Command: %s ERROR: %s" % ( cmd, rc ) )
-                print("STDOUT: %s\nSTDERR: %s" % ( stdout, stderr ) )
+          return BACKEND.put_acl( self.filename, aclfile, True, self.dryrun, self.verbose )
 
 
       def set_acl( self, aclfile=None ):
@@ -464,20 +1053,9 @@ class mmacls:
           contents of the file specified in the function call.
 
           :param: A string containing the fully qualified path to the ACL file.
-          :return: Nothing
+          :return: The mmputacl return code. 0 in dry-run mode.
           """
-          cmd = MMPUTACL + ' -i ' + aclfile + ' "' + self.filename + '"'
-          #cmd = [ MMPUTACL, '-i', aclfile, "'"+self.filename+"'" ]
-          if self.dryrun:
-             print( "".join(cmd) )
-          else:
-             if self.verbose:
-                print( "".join(cmd) )
-
-             ( rc, stdout, stderr ) = execute_command( cmd )
-             if rc != 0:
-                print("Command: %s ERROR: %s" % ( cmd, rc ) )
-                print("STDOUT: %s\nSTDERR: %s" % ( stdout, stderr ) )
+          return BACKEND.put_acl( self.filename, aclfile, False, self.dryrun, self.verbose )
 
 
       def debug_on( self ):
@@ -599,15 +1177,16 @@ def chown_file( fnam=None, owner=-1, group=-1 ):
        print("Error: %s %s %s" % ( fnam, owner, group ) )
 
 
-def write_acl_file( aclfile=None, myacls=None, def_acl=None ):
-    """
-    Write an ACL file. This does not have to be part of a class. You may
-    want to write one for other thigns.
+def render_acl_text( myacls=None, def_acl=None ):
     """
-    if not aclfile:
-       print("Error: write_acl_file: 3")
-       return None
+    Render an ACL dict as the text of an mmputacl ACL file. Any of the POSIX
+    permissions missing from the ACL are taken from def_acl. The named entries
+    are sorted, so equal ACLs always render to the same text.
 
+    :param: The ACL dict to render.
+    :param: The ACL dict to take missing permissions from.
+    :return: The ACL file text, or None on bad arguments.
+    """
     if not myacls:
        print("Error: write_acl_file: 1")
        return None
@@ -617,125 +1196,1088 @@ def write_acl_file( aclfile=None, myacls=None, def_acl=None ):
        print( def_acl )
        return None
 
-    fd = open( aclfile, "w" )
+    lines = []
     if 'USERP' in myacls:
-       fd.write( "user::" + myacls['USERP'] + "\n" )
+       lines.append( "user::" + myacls['USERP'] + "\n" )
     else:
-       fd.write( "user::" + def_acl['USERP'] + "\n" )
+       lines.append( "user::" + def_acl['USERP'] + "\n" )
 
     if 'GROUPP' in myacls:
-       fd.write( "group::" + myacls['GROUPP'] + "\n" )
+       lines.append( "group::" + myacls['GROUPP'] + "\n" )
     else:
-       fd.write( "group::" + def_acl['GROUPP'] + "\n" )
+       lines.append( "group::" + def_acl['GROUPP'] + "\n" )
 
     if 'OTHERP' in myacls:
-       fd.write( "other::" + myacls['OTHERP'] + "\n" )
+       lines.append( "other::" + myacls['OTHERP'] + "\n" )
     else:
-       fd.write( "other::" + def_acl['OTHERP'] + "\n" )
+       lines.append( "other::" + def_acl['OTHERP'] + "\n" )
 
     if 'MASK' in myacls.keys():
-       fd.write( "mask::" + myacls['MASK'] + "\n" )
+       lines.append( "mask::" + myacls['MASK'] + "\n" )
     else:
        # If we have USER and GROUP ACLs, we need a default mask
        if 'USERS' in myacls.keys():
           if 'GROUPS' in myacls.keys():
-             fd.write( "mask::rwxc" + "\n" )
+             lines.append( "mask::rwxc" + "\n" )
 
     if 'USERS' in myacls.keys():
-       for user in myacls['USERS'].keys():
-           fd.write( "user:" + user + ":" + myacls['USERS'][user]['PERMS'] + "\n" )
+       for user in sorted( myacls['USERS'].keys() ):
+           lines.append( "user:" + user + ":" + myacls['USERS'][user]['PERMS'] + "\n" )
 
     if 'GROUPS' in myacls.keys():
-       for group in myacls['GROUPS'].keys():
-           fd.write( "group:" + group + ":" + myacls['GROUPS'][group]['PERMS'] + "\n" )
-    fd.close()
+       for group in sorted( myacls['GROUPS'].keys() ):
+           lines.append( "group:" + group + ":" + myacls['GROUPS'][group]['PERMS'] + "\n" )
+    return "".join( lines )
 
-def get_temp_filename():
+def write_acl_file( aclfile=None, myacls=None, def_acl=None ):
     """
-    Use the tempfile module to generate unique temporary work filenames.
-    (For the future when this gets to be parallelized.)
+    Write an ACL file. This does not have to be part of a class. You may
+    want to write one for other thigns.
     """
-    #if options.debug:
-    #   print("Trace: %s" % ( sys._getframe().f_code.co_name))
+    if not aclfile:
+       print("Error: write_acl_file: 3")
+       return None
 
-    tf = tempfile.NamedTemporaryFile()
-    return tf.name
+    if STATS:
+       start = time.time()
 
+    text = render_acl_text( myacls, def_acl )
+    if text == None:
+       return None
 
-def gac_update_default_acl( filename=None, aclGroup=None, aclPerms=None, dryrun=False, verbose=False ):
+    fd = open( aclfile, "w" )
+    fd.write( text )
+    fd.close()
+
+    if STATS:
+       STATS.record( 'write_acl_file', time.time() - start )
+
+def acl_signature( myacls=None, def_acl=None ):
     """
-    This function will update the default ACL on a directory to the contents of the specified ACL file.
+    Reduce an ACL dict to what mmputacl would put on disk, so two ACLs can be
+    compared regardless of ownership comments, effective masks, entry order
+    or the FQPN and DIRNAME keys. A mask only counts when there are named
+    entries.
+
+    :param: The ACL dict.
+    :param: The ACL dict to take missing permissions from, as render_acl_text
+            does. Missing permissions stay None without it.
+    :return: A tuple that compares equal for equal ACLs.
     """
-    aclFile = get_temp_filename()
+    if myacls == None:
+       return None
 
-    cmd = MMGETACL + ' -d -o ' + aclFile + ' "' + filename + '"'
-    #cmd = [ MMGETACL, '-d', '-o', aclFile, filename ]
-    if dryrun:
-       print( "".join(cmd) )
-    else:
-       if verbose:
-          print( "".join(cmd) )
-       ( rc, stdout, stderr ) = execute_command( cmd )
-       if rc != 0:
-          print("Command: %s ERROR: %s" % ( cmd, rc ) )
-          print("STDOUT: %s\nSTDERR: %s" % ( stdout, stderr ) )
-          return None
+    if def_acl == None:
+       def_acl = {}
 
+    users = tuple( sorted( [ ( name, entry['PERMS'] ) for ( name, entry ) in myacls.get( 'USERS', {} ).items() ] ) )
+    groups = tuple( sorted( [ ( name, entry['PERMS'] ) for ( name, entry ) in myacls.get( 'GROUPS', {} ).items() ] ) )
 
-    found = False
-    foundUser = False
-    foundGroup = False
-    foundOther = False
-    foundMask = False
-    with open( aclFile ) as f:
-       inputLine = f.read()
-       if aclGroup in inputLine:
-          found = True
-       if 'user::' in inputLine:
-          foundUser = True
-       if 'group::' in inputLine:
-          foundGroup = True
-       if 'other::' in inputLine:
-          foundOther = True
-       if 'mask::' in inputLine:
-          foundMask = True
+    mask = None
+    if users or groups:
+       if 'MASK' in myacls:
+          mask = myacls['MASK']
+       else:
+          mask = 'rwxc'
 
-    if foundUser == False:
-       fd = open( aclFile, "a" )
-       fd.write( "user::rwxc\n" )
-       fd.write( "group::r-x-\n" )
-       fd.write( "other::----\n" )
-       fd.write( "mask::r-x-\n" )
-       foundMask = True
-       fd.close()
+    return ( myacls.get( 'USERP', def_acl.get( 'USERP' ) ),
+             myacls.get( 'GROUPP', def_acl.get( 'GROUPP' ) ),
+             myacls.get( 'OTHERP', def_acl.get( 'OTHERP' ) ),
+             mask, users, groups )
 
-    #if foundGroup == False:
-    #   fd = open( aclFile, "a" )
-    #   fd.close()
 
-    #if foundOther == False:
-    #   fd = open( aclFile, "a" )
-    #   fd.close()
+# The rwxc permission strings by their 4 bit mask, r being the high bit, and back.
+PERM_STRINGS = [ ''.join( [ char if bits & ( 8 >> idx ) else '-' for ( idx, char ) in enumerate( 'rwxc' ) ] ) for bits in range( 16 ) ]
+PERM_BITS = dict( [ ( PERM_STRINGS[bits], bits ) for bits in range( 16 ) ] )
 
-    #if foundMask == False:
-    #   fd = open( aclFile, "a" )
-    #   fd.close()
+def perm_bits( perms ):
+    """
+    The 4 bit mask of an rwxc permission string, eg. 10 for r-x-. Any
+    character other than - in a position sets its bit.
 
-    if found == False:
-       fd = open( aclFile, "a" )
-       if foundMask == False:
-          fd.write( "mask::r-x-\n" )
-       fd.write( "group:" + aclGroup + ":" + aclPerms + "\n" )
-       fd.close()
+    :return: The mask, or None for None.
+    """
+    if perms == None:
+       return None
+    bits = PERM_BITS.get( perms )
+    if bits == None:
+       bits = 0
+       for idx in range( min( 4, len( perms ) ) ):
+           if perms[idx] != '-':
+              bits |= 8 >> idx
+    return bits
 
-       cmd = MMPUTACL + ' -d -i ' + aclFile + ' "' + filename + '"'
-       #cmd = [ MMPUTACL, '-d', '-i', aclFile, filename ]
-       if dryrun:
-          print( "".join(cmd) )
-       else:
-          if verbose:
-             print( "".join(cmd) )
-          ( rc, stdout, stderr ) = execute_command( cmd )
+
+def intern_name( name ):
+    """
+    The one shared copy of a user or group name. Python 2 can only intern
+    byte strings, so names read back from JSON are kept as they are there.
+    """
+    try:
+       return intern( name )
+    except TypeError:
+       return name
+
+
+class compact_acl( object ):
+      """
+      An ACL as a small immutable value, for holding millions of them in
+      memory. The permissions are 4 bit masks, see perm_bits(), None where
+      the ACL has none, and the named entries are tuples of alternating
+      interned names and masks, sorted by name:
+
+         ( 'alice', 14, 'bob', 8 )
+
+      The owner and group of the file are kept, FQPN and DIRNAME are not,
+      and the effective permissions of the named entries are worked out from
+      the mask when needed. Two values are equal when all of that is, and
+      they can be sorted, hashed, used as dict keys and shared.
+      """
+      __slots__ = ( 'user', 'group', 'other', 'mask', 'users', 'groups', 'owner', 'owner_group' )
+
+      def __init__( self, user=None, group=None, other=None, mask=None, users=(), groups=(), owner=None, owner_group=None ):
+          self.user = user
+          self.group = group
+          self.other = other
+          self.mask = mask
+          self.users = users
+          self.groups = groups
+          self.owner = owner
+          self.owner_group = owner_group
+
+
+      @classmethod
+      def from_dict( cls, myacls ):
+          """
+          :param: An ACL dict, as parse_acl() returns it.
+          :return: A compact_acl, or None for None.
+          """
+          if myacls == None:
+             return None
+
+          named = []
+          for key in [ 'USERS', 'GROUPS' ]:
+              entries = []
+              for name in sorted( myacls.get( key, {} ) ):
+                  entries.append( intern_name( name ) )
+                  entries.append( perm_bits( myacls[key][name]['PERMS'] ) )
+              named.append( tuple( entries ) )
+
+          owner = myacls.get( 'OWNER' )
+          owner_group = myacls.get( 'GROUP' )
+          return cls( perm_bits( myacls.get( 'USERP' ) ), perm_bits( myacls.get( 'GROUPP' ) ),
+                      perm_bits( myacls.get( 'OTHERP' ) ), perm_bits( myacls.get( 'MASK' ) ),
+                      named[0], named[1],
+                      intern_name( owner ) if owner != None else None,
+                      intern_name( owner_group ) if owner_group != None else None )
+
+
+      @classmethod
+      def from_text( cls, aclText ):
+          """
+          :param: The text printed by mmgetacl.
+          :return: A compact_acl.
+          """
+          return cls.from_dict( parse_acl( aclText ) )
+
+
+      def to_dict( self, fqpn=None, dirname=None ):
+          """
+          The ACL in the dict layout of parse_acl(), for mmacls, return_json()
+          or write_acl_file(). EFFECTIVE is set where the mask takes bits away,
+          the way mmgetacl prints it, and '????' elsewhere.
+
+          :param: The value for the FQPN key. Left out if None.
+          :param: The value for the DIRNAME key. Left out if None.
+          """
+          mydict = {}
+          for ( key, entries ) in [ ( 'USERS', self.users ), ( 'GROUPS', self.groups ) ]:
+              mydict[key] = {}
+              for idx in range( 0, len( entries ), 2 ):
+                  bits = entries[idx + 1]
+                  entry = {}
+                  entry['PERMS'] = PERM_STRINGS[bits]
+                  if self.mask != None and bits & ~self.mask:
+                     entry['EFFECTIVE'] = PERM_STRINGS[bits & self.mask]
+                  else:
+                     entry['EFFECTIVE'] = '????'
+                  mydict[key][entries[idx]] = entry
+
+          for ( key, bits ) in [ ( 'USERP', self.user ), ( 'GROUPP', self.group ), ( 'OTHERP', self.other ), ( 'MASK', self.mask ) ]:
+              if bits != None:
+                 mydict[key] = PERM_STRINGS[bits]
+          if self.owner != None:
+             mydict['OWNER'] = self.owner
+          if self.owner_group != None:
+             mydict['GROUP'] = self.owner_group
+          if fqpn != None:
+             mydict['FQPN'] = fqpn
+          if dirname != None:
+             mydict['DIRNAME'] = dirname
+          return mydict
+
+
+      def user_bits( self, name ):
+          """
+          :return: The mask of the named user entry, or None if there is none.
+          """
+          return self._lookup( self.users, name )
+
+
+      def group_bits( self, name ):
+          """
+          :return: The mask of the named group entry, or None if there is none.
+          """
+          return self._lookup( self.groups, name )
+
+
+      def _lookup( self, entries, name ):
+          for idx in range( 0, len( entries ), 2 ):
+              if entries[idx] == name:
+                 return entries[idx + 1]
+          return None
+
+
+      def signature( self ):
+          """
+          :return: The acl_signature() of the ACL, without building its dict.
+          """
+          users = tuple( [ ( self.users[idx], PERM_STRINGS[self.users[idx + 1]] ) for idx in range( 0, len( self.users ), 2 ) ] )
+          groups = tuple( [ ( self.groups[idx], PERM_STRINGS[self.groups[idx + 1]] ) for idx in range( 0, len( self.groups ), 2 ) ] )
+          mask = None
+          if users or groups:
+             mask = PERM_STRINGS[self.mask] if self.mask != None else 'rwxc'
+          return tuple( [ PERM_STRINGS[bits] if bits != None else None for bits in ( self.user, self.group, self.other ) ] ) + ( mask, users, groups )
+
+
+      def _key( self ):
+          # None sorts before every mask and name.
+          return ( self.user if self.user != None else -1, self.group if self.group != None else -1,
+                   self.other if self.other != None else -1, self.mask if self.mask != None else -1,
+                   self.users, self.groups, self.owner or '', self.owner_group or '' )
+
+
+      def __eq__( self, other ):
+          return isinstance( other, compact_acl ) and self._key() == other._key()
+
+
+      def __ne__( self, other ):
+          return not self.__eq__( other )
+
+
+      def __lt__( self, other ):
+          return self._key() < other._key()
+
+
+      def __le__( self, other ):
+          return self._key() <= other._key()
+
+
+      def __gt__( self, other ):
+          return self._key() > other._key()
+
+
+      def __ge__( self, other ):
+          return self._key() >= other._key()
+
+
+      def __hash__( self ):
+          return hash( self._key() )
+
+
+      def __repr__( self ):
+          return 'compact_acl(%s)' % ( ', '.join( [ '%s=%r' % ( name, getattr( self, name ) ) for name in self.__slots__ ] ) )
+
+
+def mode_acl( mode ):
+    """
+    The ACL that plain POSIX mode bits amount to, for the directories on
+    another file system, whose ACLs are not fetched.
+
+    :param: The st_mode of the file.
+    :return: A compact_acl.
+    """
+    # rwx are the top three of the four rwxc bits.
+    return compact_acl( ( ( mode >> 6 ) & 7 ) << 1, ( ( mode >> 3 ) & 7 ) << 1, ( mode & 7 ) << 1 )
+
+
+class access_checker:
+      """
+      Works out locally whether a user may access a path, from the ACLs of the
+      path and of every directory above it, the way the file system would:
+
+         - root may read and write anything, and execute what anyone may.
+         - the owner of the file gets the user:: permissions.
+         - a named user entry applies next, limited by the mask.
+         - then the owning group and the named group entries the user is a
+           member of. Access is granted if one of them, limited by the mask,
+           has all of the permissions wanted.
+         - everybody else gets the other:: permissions.
+
+      Every directory above the path must grant x to be searched. The ACLs of
+      the directories are kept in an LRU cache, so checking many paths below
+      the same directories costs about one ACL fetch per directory. The
+      directories on another device than the path, eg. / above the file
+      system, are judged by their mode bits without running mmgetacl on them.
+      """
+      # The x bit of a 4 bit rwxc mask.
+      SEARCH = 2
+
+      def __init__( self, user, cache_size=4096 ):
+          """
+          :param: The user name, or uid.
+          :param: The number of directory ACLs to keep.
+          :raise: KeyError if the user name is not known.
+          """
+          try:
+             pwent = pwd.getpwnam( str( user ) )
+          except KeyError:
+             if not str( user ).isdigit():
+                raise
+             try:
+                pwent = pwd.getpwuid( int( user ) )
+             except KeyError:
+                pwent = None
+
+          if pwent != None:
+             self.uid = pwent.pw_uid
+             self.user_names = set( [ pwent.pw_name, str( pwent.pw_uid ) ] )
+             # getgrouplist() asks for the user's groups alone, where
+             # getgrall() would pull every group from LDAP or SSSD.
+             if hasattr( os, 'getgrouplist' ):
+                self.gids = set( os.getgrouplist( pwent.pw_name, pwent.pw_gid ) )
+             else:
+                self.gids = set( [ pwent.pw_gid ] )
+                for group in grp.getgrall():
+                    if pwent.pw_name in group.gr_mem:
+                       self.gids.add( group.gr_gid )
+          else:
+             self.uid = int( user )
+             self.user_names = set( [ str( user ) ] )
+             self.gids = set()
+
+          self.group_names = set()
+          for gid in self.gids:
+              self.group_names.add( str( gid ) )
+              try:
+                 self.group_names.add( grp.getgrgid( gid ).gr_name )
+              except KeyError:
+                 pass
+
+          self.dirs = lru_cache( cache_size )
+          self.fetches = 0
+
+
+      def entry( self, path, device, mystat=None ):
+          """
+          The ACL and ownership of a path, from the cache for directories.
+
+          :param: The absolute path.
+          :param: The device of the file system holding the ACLs. The ACLs of
+                  paths on other devices are not fetched.
+          :param: Its os.stat() result, if it is at hand.
+          :return: A ( compact_acl, uid, gid, is directory ) tuple.
+          :raise: OSError if the path, or its ACL, can not be read.
+          """
+          cached = self.dirs.get( path )
+          if cached != None:
+             return cached
+
+          if mystat == None:
+             mystat = os.stat( path )
+          isdir = S_ISDIR( mystat.st_mode )
+          if mystat.st_dev == device:
+             # With an ACL the group mode bits are its mask, so they can not
+             # stand in for an ACL that failed to be read.
+             self.fetches += 1
+             text = BACKEND.get_acl_text( path )
+             if text == None:
+                raise OSError( errno.EIO, "the ACL could not be read" )
+             acl = compact_acl.from_text( text )
+             if acl.user == None:
+                raise OSError( errno.ENOTSUP, "the ACL is not a POSIX ACL" )
+          else:
+             acl = mode_acl( mystat.st_mode )
+
+          result = ( acl, mystat.st_uid, mystat.st_gid, isdir )
+          if isdir:
+             self.dirs.put( path, result )
+          return result
+
+
+      def allows( self, entry, wanted ):
+          """
+          :param: An entry() tuple.
+          :param: The 4 bit mask of the permissions wanted.
+          :return: True if the user has all of them.
+          """
+          ( acl, uid, gid, isdir ) = entry
+          if self.uid == 0:
+             if wanted & self.SEARCH and not isdir:
+                anyone = ( acl.user or 0 ) | ( acl.group or 0 ) | ( acl.other or 0 )
+                for idx in range( 1, len( acl.users ), 2 ):
+                    anyone |= acl.users[idx]
+                for idx in range( 1, len( acl.groups ), 2 ):
+                    anyone |= acl.groups[idx]
+                return anyone & self.SEARCH != 0
+             return True
+
+          if uid == self.uid:
+             return ( acl.user or 0 ) & wanted == wanted
+
+          mask = acl.mask if acl.mask != None else 15
+          for name in self.user_names:
+              bits = acl.user_bits( name )
+              if bits != None:
+                 return bits & mask & wanted == wanted
+
+          matched = False
+          if gid in self.gids:
+             matched = True
+             if ( acl.group or 0 ) & mask & wanted == wanted:
+                return True
+          for name in self.group_names:
+              bits = acl.group_bits( name )
+              if bits != None:
+                 matched = True
+                 if bits & mask & wanted == wanted:
+                    return True
+          if matched:
+             return False
+
+          return ( acl.other or 0 ) & wanted == wanted
+
+
+      def check( self, path, wanted='r---' ):
+          """
+          May the user access a path?
+
+          :param: The path.
+          :param: The permissions wanted, as an rwxc string.
+          :return: A ( allowed, reason ) tuple. The reason is None when it is
+                   allowed, or says which directory or file denied it.
+          :raise: OSError if the path, or a directory above it, can not be read.
+          """
+          path = os.path.abspath( path )
+          mystat = os.stat( path )
+
+          # Every directory from the top down needs x to get to the path.
+          parents = []
+          child = path
+          parent = os.path.dirname( child )
+          while parent != child:
+             parents.append( parent )
+             ( child, parent ) = ( parent, os.path.dirname( parent ) )
+          for directory in reversed( parents ):
+              if not self.allows( self.entry( directory, mystat.st_dev ), self.SEARCH ):
+                 return ( False, 'no search permission on %s' % ( directory ) )
+
+          if not self.allows( self.entry( path, mystat.st_dev, mystat ), perm_bits( wanted ) ):
+             return ( False, '%s not granted on %s' % ( wanted, path ) )
+          return ( True, None )
+
+
+class counters:
+      """
+      A set of named, thread safe counters.
+      """
+      def __init__( self ):
+          self.lock = threading.Lock()
+          self.counts = {}
+
+
+      def add( self, name, value=1 ):
+          with self.lock:
+             self.counts[name] = self.counts.get( name, 0 ) + value
+
+
+      def get( self, name ):
+          return self.counts.get( name, 0 )
+
+
+class run_stats:
+      """
+      Call counts, error counts, total time and a latency histogram for each
+      phase of a run, eg. mmgetacl, parse or mmputacl, plus plain counters.
+      The hot paths only record into it when the module level STATS is set,
+      see enable_stats().
+
+      The histogram buckets double from 10us to about 10s.
+      """
+      BUCKETS = [ 0.00001 * 2 ** idx for idx in range( 21 ) ]
+
+      def __init__( self ):
+          self.lock = threading.Lock()
+          self.started = time.time()
+          self.phases = {}
+          self.counts = {}
+          self.totals = None
+          self.writer = None
+
+
+      def record( self, name, elapsed, error=False ):
+          """
+          Record one call of a phase.
+
+          :param: The phase name.
+          :param: The seconds it took.
+          :param: True if the call failed.
+          """
+          bucket = bisect.bisect_left( self.BUCKETS, elapsed )
+          with self.lock:
+             phase = self.phases.get( name )
+             if phase == None:
+                phase = self.phases[name] = { 'CALLS': 0, 'ERRORS': 0, 'SECONDS': 0.0,
+                                              'BUCKETS': [ 0 ] * ( len( self.BUCKETS ) + 1 ) }
+             phase['CALLS'] += 1
+             phase['SECONDS'] += elapsed
+             phase['BUCKETS'][bucket] += 1
+             if error:
+                phase['ERRORS'] += 1
+
+
+      def count( self, name, value=1 ):
+          with self.lock:
+             self.counts[name] = self.counts.get( name, 0 ) + value
+
+
+      def percentile( self, name, fraction ):
+          """
+          The upper bound of the histogram bucket holding the given fraction
+          of the calls of a phase, in seconds. None past the last bucket.
+          """
+          phase = self.phases[name]
+          wanted = phase['CALLS'] * fraction
+          seen = 0
+          for idx in range( len( self.BUCKETS ) ):
+              seen += phase['BUCKETS'][idx]
+              if seen >= wanted:
+                 return self.BUCKETS[idx]
+          return None
+
+
+      def as_dict( self ):
+          with self.lock:
+             result = {}
+             result['elapsed'] = time.time() - self.started
+             result['counters'] = dict( self.counts )
+             result['phases'] = {}
+             for ( name, phase ) in self.phases.items():
+                 result['phases'][name] = { 'calls': phase['CALLS'], 'errors': phase['ERRORS'],
+                                            'seconds': phase['SECONDS'], 'buckets': list( phase['BUCKETS'] ) }
+             result['bucket_bounds'] = list( self.BUCKETS )
+          if self.totals != None:
+             result['totals'] = dict( self.totals.counts )
+          return result
+
+
+      def merge( self, stats ):
+          """
+          Add the statistics of another run, as returned by its as_dict(), eg.
+          read back from its --stats-file.
+          """
+          with self.lock:
+             for ( name, phase ) in stats.get( 'phases', {} ).items():
+                 mine = self.phases.get( name )
+                 if mine == None:
+                    mine = self.phases[name] = { 'CALLS': 0, 'ERRORS': 0, 'SECONDS': 0.0,
+                                                 'BUCKETS': [ 0 ] * ( len( self.BUCKETS ) + 1 ) }
+                 mine['CALLS'] += phase['calls']
+                 mine['ERRORS'] += phase['errors']
+                 mine['SECONDS'] += phase['seconds']
+                 for idx in range( len( mine['BUCKETS'] ) ):
+                     mine['BUCKETS'][idx] += phase['buckets'][idx]
+             for ( name, value ) in stats.get( 'counters', {} ).items():
+                 self.counts[name] = self.counts.get( name, 0 ) + value
+
+
+      def report( self ):
+          """
+          The statistics as a table for the end of a run.
+          """
+          lines = [ "Elapsed: %.3f s" % ( time.time() - self.started ),
+                    "%-20s %10s %8s %11s %10s %10s %10s" % ( 'Phase', 'Calls', 'Errors', 'Total s', 'Mean ms', 'p50 ms', 'p99 ms' ) ]
+          for name in sorted( self.phases ):
+              phase = self.phases[name]
+              p50 = self.percentile( name, 0.5 )
+              p99 = self.percentile( name, 0.99 )
+              lines.append( "%-20s %10d %8d %11.3f %10.3f %10s %10s" % ( name, phase['CALLS'], phase['ERRORS'], phase['SECONDS'],
+                            phase['SECONDS'] * 1000.0 / max( 1, phase['CALLS'] ),
+                            '%.3f' % ( p50 * 1000.0 ) if p50 != None else '>10000',
+                            '%.3f' % ( p99 * 1000.0 ) if p99 != None else '>10000' ) )
+          for name in sorted( self.counts ):
+              lines.append( "%-20s %10d" % ( name, self.counts[name] ) )
+          return '\n'.join( lines )
+
+
+      def prometheus( self ):
+          """
+          The statistics in the Prometheus text format, for the node exporter
+          textfile collector.
+          """
+          stats = self.as_dict()
+          lines = [ '# HELP ssacl_phase_seconds Time spent in each phase of the run.',
+                    '# TYPE ssacl_phase_seconds histogram' ]
+          for name in sorted( stats['phases'] ):
+              phase = stats['phases'][name]
+              total = 0
+              for idx in range( len( self.BUCKETS ) ):
+                  total += phase['buckets'][idx]
+                  lines.append( 'ssacl_phase_seconds_bucket{phase="%s",le="%g"} %d' % ( name, self.BUCKETS[idx], total ) )
+              lines.append( 'ssacl_phase_seconds_bucket{phase="%s",le="+Inf"} %d' % ( name, phase['calls'] ) )
+              lines.append( 'ssacl_phase_seconds_sum{phase="%s"} %f' % ( name, phase['seconds'] ) )
+              lines.append( 'ssacl_phase_seconds_count{phase="%s"} %d' % ( name, phase['calls'] ) )
+
+          lines += [ '# HELP ssacl_phase_errors_total Failed calls in each phase of the run.',
+                     '# TYPE ssacl_phase_errors_total counter' ]
+          for name in sorted( stats['phases'] ):
+              lines.append( 'ssacl_phase_errors_total{phase="%s"} %d' % ( name, stats['phases'][name]['errors'] ) )
+
+          lines += [ '# HELP ssacl_count_total Event counters of the run.',
+                     '# TYPE ssacl_count_total counter' ]
+          for name in sorted( stats['counters'] ):
+              lines.append( 'ssacl_count_total{name="%s"} %d' % ( name, stats['counters'][name] ) )
+
+          if 'totals' in stats:
+             lines += [ '# HELP ssacl_files_total Files by the outcome of their ACL change.',
+                        '# TYPE ssacl_files_total counter' ]
+             for name in sorted( stats['totals'] ):
+                 lines.append( 'ssacl_files_total{result="%s"} %d' % ( name, stats['totals'][name] ) )
+
+          lines += [ '# HELP ssacl_elapsed_seconds Seconds since the run started.',
+                     '# TYPE ssacl_elapsed_seconds gauge',
+                     'ssacl_elapsed_seconds %f' % ( stats['elapsed'] ) ]
+          return '\n'.join( lines ) + '\n'
+
+
+      def write( self, path ):
+          """
+          Write the statistics to a file, replacing it atomically. A name
+          ending in .prom gets the Prometheus text format, anything else JSON.
+          """
+          if path.endswith( '.prom' ):
+             text = self.prometheus()
+          else:
+             text = json.dumps( self.as_dict(), sort_keys=True ) + '\n'
+
+          tmpfile = '%s.%d.tmp' % ( path, os.getpid() )
+          fd = open( tmpfile, 'w' )
+          fd.write( text )
+          fd.close()
+          os.rename( tmpfile, path )
+
+
+      def start_writer( self, path, interval=30 ):
+          """
+          Write the statistics to path every interval seconds from a
+          background thread, and once more at exit or stop_writer().
+          """
+          stopped = threading.Event()
+          def run():
+              while not stopped.wait( interval ):
+                 self.write( path )
+
+          self.writer = threading.Thread( target=run )
+          self.writer.daemon = True
+          self.writer.stopped = stopped
+          self.writer.start()
+          STATS_WRITERS.add( ( self, path ) )
+
+
+      def stop_writer( self, path ):
+          """
+          Stop the background writes and write the statistics a last time.
+          Does nothing once stopped.
+          """
+          if self.writer == None:
+             return
+          self.writer.stopped.set()
+          self.writer = None
+          STATS_WRITERS.discard( ( self, path ) )
+          self.write( path )
+
+
+def _stop_stats_writers():
+    for ( stats, path ) in list( STATS_WRITERS ):
+        stats.stop_writer( path )
+
+# One hook for all of the writers, rather than one for each run_stats, which
+# a process running many commands, eg. ssacl_server.py, would pile up.
+atexit.register( _stop_stats_writers )
+
+
+def enable_stats():
+    """
+    Start collecting run statistics.
+
+    :return: The run_stats object, also kept in STATS.
+    """
+    global STATS
+    if STATS == None:
+       STATS = run_stats()
+    return STATS
+
+
+class lru_cache:
+      """
+      A thread safe mapping that holds at most size entries, dropping the
+      least recently used one to make room, and counts its hits and misses.
+      A size of 0 caches nothing.
+      """
+      def __init__( self, size=4096 ):
+          self.size = size
+          self.lock = threading.Lock()
+          self.entries = collections.OrderedDict()
+          self.hits = 0
+          self.misses = 0
+
+
+      def get( self, key ):
+          """
+          :return: The value cached for key, or None.
+          """
+          with self.lock:
+             value = self.entries.pop( key, None )
+             if value is None:
+                self.misses += 1
+                return None
+             # Back in as the most recently used.
+             self.entries[key] = value
+             self.hits += 1
+             return value
+
+
+      def put( self, key, value ):
+          if self.size < 1:
+             return
+          with self.lock:
+             self.entries.pop( key, None )
+             self.entries[key] = value
+             while len( self.entries ) > self.size:
+                self.entries.popitem( last=False )
+
+
+      def hit_rate( self ):
+          """
+          :return: The fraction of the lookups that were hits.
+          """
+          return self.hits / float( max( 1, self.hits + self.misses ) )
+
+
+      def __len__( self ):
+          return len( self.entries )
+
+
+class acl_throttle:
+      """
+      Paces the mmgetacl and mmputacl calls of a run, so a bulk change does
+      not swamp the token manager and metadata servers for everybody else.
+
+      With a rate, the calls are started no faster than that many per second,
+      across all the threads, by a token bucket without burst.
+
+      With a latency target, the number of calls in flight adapts to the
+      mean latency of the calls: every ADJUST_SECONDS it is cut to DECREASE
+      of what it was when the mean is above the target, and raised by one up
+      to the starting limit when it is not.
+
+      Threads call acquire() before a call and release() after it. The
+      asyncio engine uses reserve() and record() and keeps its own count of
+      calls in flight against limit.
+      """
+      ADJUST_SECONDS = 1.0
+      DECREASE = 0.7
+
+      def __init__( self, rate=0, target=0, limit=1, verbose=False ):
+          """
+          :param: The calls per second, 0 for no limit.
+          :param: The mean call latency to stay under, in seconds, 0 for none.
+          :param: The most calls in flight, where the adaptive limit starts.
+          :param: Print every change of the limit.
+          """
+          self.rate = rate
+          self.target = target
+          self.maximum = max( 1, limit )
+          self.limit = self.maximum
+          self.verbose = verbose
+          self.cond = threading.Condition()
+          self.inflight = 0
+          self.next_start = 0.0
+          self.calls = 0
+          self.seconds = 0.0
+          self.last_adjust = time.time()
+
+
+      def reserve( self, calls=1 ):
+          """
+          Take the rate allowance for some calls.
+
+          :return: The seconds to wait before starting them.
+          """
+          if not self.rate:
+             return 0.0
+          with self.cond:
+             now = time.time()
+             start = max( now, self.next_start )
+             self.next_start = start + calls / float( self.rate )
+          return start - now
+
+
+      def record( self, elapsed, calls=1 ):
+          """
+          Feed the latency of finished calls to the adaptive limit.
+
+          :param: The seconds they took, one after the other.
+          :param: The number of calls.
+          """
+          if not self.target:
+             return
+          with self.cond:
+             self.calls += calls
+             self.seconds += elapsed
+             now = time.time()
+             if now - self.last_adjust < self.ADJUST_SECONDS:
+                return
+
+             mean = self.seconds / self.calls
+             if mean > self.target:
+                limit = max( 1, int( self.limit * self.DECREASE ) )
+             else:
+                limit = min( self.maximum, self.limit + 1 )
+             self.calls = 0
+             self.seconds = 0.0
+             self.last_adjust = now
+             if limit == self.limit:
+                return
+
+             if self.verbose:
+                print("Throttle: %d -> %d calls in flight, mean latency %.1f ms, target %.1f ms" % ( self.limit, limit,
+                      mean * 1000.0, self.target * 1000.0 ))
+             if STATS:
+                STATS.count( 'throttle_decrease' if limit < self.limit else 'throttle_increase' )
+             self.limit = limit
+             self.cond.notify_all()
+
+
+      def acquire( self, calls=1 ):
+          """
+          Wait for a slot and the rate allowance to start calls.
+          """
+          if STATS:
+             start = time.time()
+          if self.target:
+             with self.cond:
+                while self.inflight >= self.limit:
+                   self.cond.wait()
+                self.inflight += 1
+          wait = self.reserve( calls )
+          if wait > 0:
+             time.sleep( wait )
+          if STATS:
+             STATS.record( 'throttle_wait', time.time() - start )
+
+
+      def release( self, elapsed, calls=1 ):
+          """
+          Give back the slot of calls started with acquire().
+          """
+          if self.target:
+             with self.cond:
+                self.inflight -= 1
+                self.cond.notify()
+          self.record( elapsed, calls )
+
+
+def enable_throttle( rate=0, target=0, limit=1, verbose=False ):
+    """
+    Pace the mmgetacl and mmputacl calls from here on, see acl_throttle.
+
+    :return: The acl_throttle object, also kept in THROTTLE.
+    """
+    global THROTTLE
+    THROTTLE = acl_throttle( rate, target, limit, verbose )
+    return THROTTLE
+
+
+def reset_run_state():
+    """
+    Stop collecting statistics and pacing the calls, so that the next run
+    in the same process starts afresh, see ssacl_server.py. The ACLs the
+    xattr backend encoded are forgotten too, since an ACL file given with
+    -f may have been edited since.
+    """
+    global STATS, THROTTLE
+    STATS = None
+    THROTTLE = None
+    if BACKEND.name == 'xattr':
+       BACKEND.encoded = {}
+
+
+class acl_file_cache:
+      """
+      A directory of ACL files named by the hash of their contents. Every
+      distinct ACL is written once, however many files it is applied to, and
+      the same file is handed to every mmputacl -i that needs it. The
+      directory is created in /dev/shm when it is available, and removed when
+      the program exits.
+      """
+      def __init__( self, directory=None ):
+          if directory == None:
+             if os.path.isdir( '/dev/shm' ) and os.access( '/dev/shm', os.W_OK ):
+                directory = '/dev/shm'
+             else:
+                directory = tempfile.gettempdir()
+
+          self.directory = tempfile.mkdtemp( prefix='ssacl.', dir=directory )
+          self.files = {}
+          self.lock = threading.Lock()
+          ACL_FILE_CACHES.add( self )
+
+
+      def get( self, myacls=None, def_acl=None ):
+          """
+          Return the name of an ACL file holding the rendered ACL.
+
+          :param: The ACL dict.
+          :param: The ACL dict to take missing permissions from.
+          :return: The ACL file name, or None on bad arguments.
+          """
+          text = render_acl_text( myacls, def_acl )
+          if text == None:
+             return None
+          return self.get_text( text )
+
+
+      def get_text( self, text ):
+          """
+          Return the name of an ACL file holding the given ACL text.
+          """
+          key = hashlib.sha1( text.encode( 'utf-8' ) ).hexdigest()
+          aclfile = self.files.get( key )
+          if aclfile != None:
+             return aclfile
+
+          with self.lock:
+             aclfile = self.files.get( key )
+             if aclfile == None:
+                if STATS:
+                   start = time.time()
+                aclfile = os.path.join( self.directory, key + '.acl' )
+                fd = open( aclfile, "w" )
+                fd.write( text )
+                fd.close()
+                self.files[key] = aclfile
+                if STATS:
+                   STATS.record( 'write_acl_file', time.time() - start )
+          return aclfile
+
+
+      def cleanup( self ):
+          """
+          Remove the cache directory and every ACL file in it.
+          """
+          with self.lock:
+             self.files = {}
+             shutil.rmtree( self.directory, ignore_errors=True )
+          ACL_FILE_CACHES.discard( self )
+
+
+def _cleanup_acl_file_caches():
+    for cache in list( ACL_FILE_CACHES ):
+        cache.cleanup()
+
+# One hook for all of the caches, as for the --stats-file writers.
+atexit.register( _cleanup_acl_file_caches )
+
+
+def get_temp_filename():
+    """
+    Use the tempfile module to generate unique temporary work filenames.
+
+    Deprecated: ssacl no longer calls this itself.  The name belongs to a
+    NamedTemporaryFile that is removed as soon as it is dropped, so another
+    process can take the same name before you write to it.  Use
+    tempfile.mkstemp() instead.
+    """
+    tf = tempfile.NamedTemporaryFile()
+    return tf.name
+
+
+def gac_update_default_acl( filename=None, aclGroup=None, aclPerms=None, dryrun=False, verbose=False ):
+    """
+    This function will update the default ACL on a directory to the contents of the specified ACL file.
+    """
+    ( fd, aclFile ) = tempfile.mkstemp( prefix='ssacl.' )
+    os.close( fd )
+
+    cmd = MMGETACL + ' -d -o ' + aclFile + ' "' + filename + '"'
+    #cmd = [ MMGETACL, '-d', '-o', aclFile, filename ]
+    if dryrun:
+       print( "".join(cmd) )
+    else:
+       if verbose:
+          print( "".join(cmd) )
+       ( rc, stdout, stderr ) = execute_command( cmd )
+       if rc != 0:
+          print("Command: %s ERROR: %s" % ( cmd, rc ) )
+          print("STDOUT: %s\nSTDERR: %s" % ( stdout, stderr ) )
+          return None
+
+
+    found = False
+    foundUser = False
+    foundGroup = False
+    foundOther = False
+    foundMask = False
+    with open( aclFile ) as f:
+       inputLine = f.read()
+       if aclGroup in inputLine:
+          found = True
+       if 'user::' in inputLine:
+          foundUser = True
+       if 'group::' in inputLine:
+          foundGroup = True
+       if 'other::' in inputLine:
+          foundOther = True
+       if 'mask::' in inputLine:
+          foundMask = True
+
+    if foundUser == False:
+       fd = open( aclFile, "a" )
+       fd.write( "user::rwxc\n" )
+       fd.write( "group::r-x-\n" )
+       fd.write( "other::----\n" )
+       fd.write( "mask::r-x-\n" )
+       foundMask = True
+       fd.close()
+
+    #if foundGroup == False:
+    #   fd = open( aclFile, "a" )
+    #   fd.close()
+
+    #if foundOther == False:
+    #   fd = open( aclFile, "a" )
+    #   fd.close()
+
+    #if foundMask == False:
+    #   fd = open( aclFile, "a" )
+    #   fd.close()
+
+    if found == False:
+       fd = open( aclFile, "a" )
+       if foundMask == False:
+          fd.write( "mask::r-x-\n" )
+       fd.write( "group:" + aclGroup + ":" + aclPerms + "\n" )
+       fd.close()
+
+       cmd = MMPUTACL + ' -d -i ' + aclFile + ' "' + filename + '"'
+       #cmd = [ MMPUTACL, '-d', '-i', aclFile, filename ]
+       if dryrun:
+          print( "".join(cmd) )
+       else:
+          if verbose:
+             print( "".join(cmd) )
+          ( rc, stdout, stderr ) = execute_command( cmd )
           if rc != 0:
              print("Command: %s ERROR: %s" % ( cmd, rc ) )
              print("STDOUT: %s\nSTDERR: %s" % ( stdout, stderr ) )
@@ -746,7 +2288,8 @@ def gac_update_acl( filename=None, aclGroup=None, aclPerms=None, dryrun=False, v
     """
     This function will update the default ACL on a directory to the contents of the specified ACL file.
     """
-    aclFile = get_temp_filename()
+    ( fd, aclFile ) = tempfile.mkstemp( prefix='ssacl.' )
+    os.close( fd )
 
     cmd = MMGETACL + ' -o ' + aclFile + ' "' + filename + '"'
     #cmd = [ MMGETACL, '-o', aclFile, filename ]
@@ -819,19 +2362,9 @@ def set_default_acl( filename=None, aclfile=None, dryrun=False, verbose=False ):
     :param: A fully qualified pathname to the ACL file to use.
     :param: Execute in dry-run mode. True or False. Default: False
     :param: Execute in verbose mode. True or False. Default: False
+    :return: The mmputacl return code. 0 in dry-run mode.
     """
-    cmd = MMPUTACL + ' -d -i ' + aclfile + ' "' + filename + '"'
-    #cmd = [ MMPUTACL, '-d', '-i', aclfile, "'"+filename+"'" ]
-    #cmd = [ MMPUTACL, '-d', '-i', aclfile, filename ]
-    if dryrun:
-       print( "".join(cmd) )
-    else:
-       if verbose:
-          print( "".join(cmd) )
-       ( rc, stdout, stderr ) = execute_command( cmd )
-       if rc != 0:
-          print("Command: %s ERROR: %s" % ( cmd, rc ) )
-          print("STDOUT: %s\nSTDERR: %s" % ( stdout, stderr ) )
+    return BACKEND.put_acl( filename, aclfile, True, dryrun, verbose )
 
 
 def set_acl( filename=None, aclfile=None, dryrun=False, verbose=False ):
@@ -842,20 +2375,9 @@ def set_acl( filename=None, aclfile=None, dryrun=False, verbose=False ):
     :param: A fully qualified pathname to the ACL file to use.
     :param: Execute in dry-run mode. True or False. Default: False
     :param: Execute in verbose mode. True or False. Default: False
+    :return: The mmputacl return code. 0 in dry-run mode.
     """
-    #cmd = MMPUTACL + '-i ' + aclfile + ' "' + filename + '"'
-    #cmd = [ MMPUTACL, '-i', aclfile, "'"+filename+"'" ]
-    cmd = MMPUTACL + ' -i ' + aclfile + ' "' + filename + '"'
-    #cmd = [ MMPUTACL, '-i', aclfile, filename ]
-    if dryrun:
-       print( "".join(cmd) )
-    else:
-       if verbose:
-          print( "".join(cmd) )
-       ( rc, stdout, stderr ) = execute_command( cmd )
-       if rc != 0:
-          print("Command: %s ERROR: %s" % ( cmd, rc ) )
-          print("STDOUT: %s\nSTDERR: %s" % ( stdout, stderr ) )
+    return BACKEND.put_acl( filename, aclfile, False, dryrun, verbose )
 
 
 def return_json( theacl=None ):
@@ -869,6 +2391,1248 @@ def return_json( theacl=None ):
        return json.dumps( theacl )
 
 
+class _stat_entry:
+      """
+      A stand in for os.DirEntry when scandir is not available.
+      """
+      def __init__( self, dirpath, name ):
+          self.name = name
+          self.path = os.path.join( dirpath, name )
+          try:
+             self.mode = os.stat( self.path ).st_mode
+          except OSError:
+             self.mode = 0
+
+      def is_dir( self ):
+          return S_ISDIR( self.mode )
+
+      def is_file( self ):
+          return S_ISREG( self.mode )
+
+
+def _scan_directory( dirpath ):
+    if STATS:
+       start = time.time()
+    try:
+       if scandir != None:
+          entries = scandir( dirpath )
+       else:
+          entries = iter( [ _stat_entry( dirpath, name ) for name in os.listdir( dirpath ) ] )
+    except OSError:
+       if STATS:
+          STATS.record( 'scandir', time.time() - start, True )
+       raise
+
+    if STATS:
+       STATS.record( 'scandir', time.time() - start )
+    return entries
+
+
+def _entry_kind( entry ):
+    """
+    Classify a directory entry the way os.stat would, following symbolic
+    links. is_dir() and is_file() answer from the d_type in the directory
+    entry, so only links and file systems without d_type cost a stat.
+    """
+    try:
+       if entry.is_dir():
+          return 'd'
+       if entry.is_file():
+          return 'f'
+    except OSError:
+       pass
+
+    if STATS:
+       STATS.count( 'walk_stats' )
+    try:
+       os.stat( entry.path )
+    except OSError:
+       return 'l'
+    return 'o'
+
+
+def iter_directory_tree( topdir, recursive=True, onerror=None, prune=None, onlisted=None ):
+    """
+    Walk the directory tree rooted at topdir without recursion, streaming
+    the entries of each directory instead of listing it first. Directories
+    are yielded before their contents, and .snapshots directories are
+    skipped.
+
+    At most MAX_OPEN_DIRS directories are held open on the way down. Past
+    that, the rest of the directory being read is listed into memory and
+    closed before its sub-directory is opened, so the walk stays depth first
+    and holds no more than the unread entries of the directories above it.
+
+    :param: The directory to walk.
+    :param: Descend into the sub-directories. Only topdir is listed if False.
+    :param: A function called with the OSError when a directory can not be read.
+    :param: A function called with each sub-directory. When it returns True
+            the sub-directory is neither yielded nor walked.
+    :param: A function called with each directory once all of its entries
+            have been yielded. It is not called when the listing failed.
+    :return: A generator of ( pathname, kind ) tuples. kind is d for a
+             directory, f for a regular file, l for a broken symbolic link and
+             o for anything else.
+    """
+    # Entries are ( directory, entry iterator, held open ).
+    stack = []
+    opened = 0
+    try:
+       stack.append( ( topdir, _scan_directory( topdir ), True ) )
+       opened += 1
+    except OSError as e:
+       if onerror:
+          onerror( e )
+
+    while stack:
+       try:
+          if STATS:
+             start = time.time()
+             entry = next( stack[-1][1] )
+             STATS.record( 'readdir', time.time() - start )
+          else:
+             entry = next( stack[-1][1] )
+       except StopIteration:
+          ( dirpath, entries, isopen ) = stack.pop()
+          if isopen:
+             opened -= 1
+             if hasattr( entries, 'close' ):
+                entries.close()
+          if onlisted:
+             onlisted( dirpath )
+          continue
+       except OSError as e:
+          if stack.pop()[2]:
+             opened -= 1
+          if onerror:
+             onerror( e )
+          continue
+
+       kind = _entry_kind( entry )
+       if kind == 'd':
+          if entry.path.endswith( '/.snapshots' ):
+             continue
+          if prune and prune( entry.path ):
+             continue
+          yield ( entry.path, kind )
+
+          if recursive:
+             if opened >= MAX_OPEN_DIRS and stack[-1][2]:
+                ( dirpath, entries, isopen ) = stack.pop()
+                opened -= 1
+                try:
+                   rest = list( entries )
+                except OSError as e:
+                   rest = None
+                   if onerror:
+                      onerror( e )
+                if hasattr( entries, 'close' ):
+                   entries.close()
+                if rest == None:
+                   continue
+                stack.append( ( dirpath, iter( rest ), False ) )
+             try:
+                stack.append( ( entry.path, _scan_directory( entry.path ), True ) )
+                opened += 1
+             except OSError as e:
+                if onerror:
+                   onerror( e )
+       else:
+          yield ( entry.path, kind )
+
+
+def path_hash( path ):
+    """
+    A stable, non-negative hash of a path, the same in every process and on
+    every host. It is taken over the bytes of the name on disk.
+    """
+    if not isinstance( path, bytes ):
+       if hasattr( os, 'fsencode' ):
+          path = os.fsencode( path )
+       else:
+          path = path.encode( 'utf-8' )
+    return zlib.crc32( path ) & 0xffffffff
+
+
+def shard_of( path, count ):
+    """
+    The shard, out of count, that a path belongs to when a run is split
+    across hosts. It is picked by the directory, so the entries of a
+    directory are all handled on one host and their tokens stay there.
+    """
+    return path_hash( os.path.dirname( os.path.abspath( path ) ) ) % count
+
+
+def parse_policy_line( line ):
+    """
+    Parse one line of a mmapplypolicy LIST file:
+
+       inode generation snapid  [SHOW fields] -- /path/name
+
+    :param: The line.
+    :return: A dict with INODE, GEN, SNAPID, SHOW (a list of the SHOW fields)
+             and PATH, or None when the line is not in that format.
+    """
+    idx = line.find( ' -- ' )
+    if idx < 0:
+       return None
+
+    fields = line[0:idx].split()
+    if len( fields ) < 3:
+       return None
+
+    record = {}
+    record['INODE'] = fields[0]
+    record['GEN'] = fields[1]
+    record['SNAPID'] = fields[2]
+    record['SHOW'] = fields[3:]
+    record['PATH'] = line[idx + 4:].rstrip( '\n' )
+    return record
+
+
+POLICY_LIST = 'ssacl'
+
+def policy_rules( where=None ):
+    """
+    The policy that lists every file and directory, or the ones matching a
+    WHERE clause, eg. MISC_ATTRIBUTES LIKE '%+%' for the ones with an ACL.
+    """
+    rules = "RULE '%s' LIST '%s' DIRECTORIES_PLUS\n" % ( POLICY_LIST, POLICY_LIST )
+    if where:
+       rules += "WHERE ( %s )\n" % ( where )
+    return rules
+
+
+def find_with_policy( topdir, where=None, args=None, workdir=None ):
+    """
+    Find the files and directories below topdir with a mmapplypolicy LIST
+    rule instead of walking the tree. The policy engine scans the inodes in
+    parallel, on more than one node with -N, and the list it writes is
+    streamed from disk.
+
+    :param: The directory to scan.
+    :param: A WHERE clause for the rule, or None for everything.
+    :param: More mmapplypolicy arguments, eg. [ '-N', 'coreio' ].
+    :param: Where to make the directory for the policy and the list.
+            Default: the temporary directory.
+    :return: A generator of the paths. mmapplypolicy errors are reported
+             and end it early.
+    """
+    tmpdir = tempfile.mkdtemp( prefix='ssacl-policy.', dir=workdir )
+    try:
+       policy = os.path.join( tmpdir, 'policy.in' )
+       with open( policy, 'w' ) as fd:
+          fd.write( policy_rules( where ) )
+
+       cmd = [ MMAPPLYPOLICY, topdir, '-P', policy, '-f', tmpdir, '-I', 'defer' ] + ( args or [] )
+       log = open( os.path.join( tmpdir, 'policy.log' ), 'w+' )
+       if STATS:
+          start = time.time()
+       rc = Popen( cmd, stdout=log, stderr=STDOUT ).wait()
+       if STATS:
+          STATS.record( os.path.basename( MMAPPLYPOLICY ), time.time() - start, rc != 0 )
+
+       if rc != 0:
+          log.seek( 0 )
+          print("Command: %s ERROR: %s" % ( ' '.join( cmd ), rc ))
+          print("OUTPUT: %s" % ( ''.join( log.readlines()[-20:] ) ))
+          log.close()
+          return
+       log.close()
+
+       # Nothing matched when there is no list.
+       listfile = os.path.join( tmpdir, 'list.' + POLICY_LIST )
+       if os.path.isfile( listfile ):
+          with open( listfile ) as fd:
+             for path in iter_path_list( fd ):
+                 yield path
+    finally:
+       shutil.rmtree( tmpdir, ignore_errors=True )
+
+
+def _split_stream( fd, separator, size=65536 ):
+    """
+    Split the contents of a file on a separator, a block at a time.
+    """
+    pending = separator[0:0]
+    while True:
+       block = fd.read( size )
+       if not block:
+          break
+       parts = ( pending + block ).split( separator )
+       pending = parts.pop()
+       for part in parts:
+           yield part
+    if pending:
+       yield pending
+
+
+def iter_path_list( fd, nul=False ):
+    """
+    Stream the paths in a list: one per line, NUL separated as written by
+    find -print0, or the lines of a mmapplypolicy LIST file, which is
+    recognised by its first line. Memory use does not depend on the length
+    of the list.
+
+    :param: An open file.
+    :param: The paths are separated by NULs instead of newlines.
+    :return: A generator of the paths.
+    """
+    if nul:
+       # Split the bytes, and decode each name as os.scandir would, so a
+       # name that is not valid in the file system encoding comes through.
+       entries = _split_stream( getattr( fd, 'buffer', fd ), b'\0' )
+       if hasattr( os, 'fsdecode' ):
+          entries = ( os.fsdecode( entry ) for entry in entries )
+    else:
+       entries = ( line.rstrip( '\n' ) for line in fd )
+
+    policy = None
+    for entry in entries:
+        if not entry:
+           continue
+
+        if policy == None:
+           record = parse_policy_line( entry )
+           policy = record != None and record['INODE'].isdigit()
+
+        if policy:
+           record = parse_policy_line( entry )
+           if record != None:
+              yield record['PATH']
+        else:
+           yield entry
+
+
+class backup_writer:
+      """
+      Write ACL backup records as JSON lines, one record per line, spread over
+      a number of shard files by a hash of the path. The files are named
+      prefix.NNN.jsonl, with .gz appended when they are compressed. A prefix
+      of - writes a single stream to stdout.
+      """
+      suffix = '.jsonl'
+
+      def __init__( self, prefix, shards=1, compress=False ):
+          self.lock = threading.Lock()
+          self.files = []
+          self.names = []
+          self.count = 0
+
+          if prefix == '-':
+             self.files.append( None )
+             self.start_file( None )
+             return
+
+          for idx in range( max( 1, shards ) ):
+              name = '%s.%03d%s' % ( prefix, idx, self.suffix )
+              if compress:
+                 name += '.gz'
+                 fd = gzip.open( name, 'wb' )
+              else:
+                 fd = open( name, 'wb' )
+              self.files.append( fd )
+              self.names.append( name )
+              self.start_file( fd )
+
+
+      def start_file( self, fd ):
+          """
+          Called once for every shard file when it is opened.
+          """
+          pass
+
+
+      def emit( self, fd, text ):
+          if fd == None:
+             sys.stdout.write( text )
+          else:
+             fd.write( text.encode( 'utf-8' ) )
+
+
+      def write( self, record ):
+          """
+          Write one record. The record is a dict with at least a path key.
+          """
+          self.write_line( record['path'], json.dumps( record, sort_keys=True ) + '\n' )
+
+
+      def write_line( self, path, line ):
+          """
+          Write a record that is already encoded as a JSON line, eg. one read
+          from an earlier backup.
+          """
+          shard = path_hash( path ) % len( self.files )
+          with self.lock:
+             self.emit( self.files[shard], line )
+             self.count += 1
+
+
+      def close( self ):
+          with self.lock:
+             for fd in self.files:
+                 if fd != None:
+                    fd.close()
+             self.files = []
+
+
+DEDUP_HEADER = '#ssacl-dedup 1'
+
+class dedup_backup_writer( backup_writer ):
+      """
+      Write ACL backup records in the deduplicated format. Every distinct ACL
+      is written once, as an A line with a numeric id, the first time a shard
+      needs it. Files are written as F lines that refer to their ACL and
+      default ACL by id, under a D line naming their directory. The FQPN and
+      DIRNAME keys, and the owner and group, are taken out of the ACLs so
+      files in different places with the same permissions share an entry.
+
+         #ssacl-dedup 1
+         ["A",1,{"GROUPP":"r-x-","GROUPS":{},...}]
+         ["D","/gpfs/fs/dir"]
+         ["F","name",inode,gen,ctime,type,owner,group,aclid,daclid]
+
+      Records are sharded by their directory, so a directory's files stay in
+      one shard. The files are named prefix.NNN.dedup.
+      """
+      suffix = '.dedup'
+
+      def start_file( self, fd ):
+          if not hasattr( self, 'acl_ids' ):
+             self.acl_ids = {}
+             self.emitted = {}
+             self.current_dir = {}
+          self.emitted[ id( fd ) ] = set()
+          self.current_dir[ id( fd ) ] = None
+          self.emit( fd, DEDUP_HEADER + '\n' )
+
+
+      def _acl_id( self, fd, acl, owner, group, lines ):
+          if acl == None:
+             return None
+
+          stripped = {}
+          for ( key, value ) in acl.items():
+              if key == 'FQPN' or key == 'DIRNAME':
+                 continue
+              if key == 'OWNER' and value == owner:
+                 continue
+              if key == 'GROUP' and value == group:
+                 continue
+              stripped[key] = value
+
+          key = json.dumps( stripped, sort_keys=True, separators=( ',', ':' ) )
+          aclid = self.acl_ids.get( key )
+          if aclid == None:
+             aclid = len( self.acl_ids ) + 1
+             self.acl_ids[key] = aclid
+
+          emitted = self.emitted[ id( fd ) ]
+          if aclid not in emitted:
+             emitted.add( aclid )
+             lines.append( '["A",%d,%s]\n' % ( aclid, key ) )
+          return aclid
+
+
+      def write( self, record ):
+          ( dirname, name ) = os.path.split( record['path'] )
+          acl = record.get( 'acl' ) or {}
+          owner = acl.get( 'OWNER' )
+          group = acl.get( 'GROUP' )
+
+          with self.lock:
+             fd = self.files[ path_hash( dirname ) % len( self.files ) ]
+             lines = []
+             if self.current_dir[ id( fd ) ] != dirname:
+                self.current_dir[ id( fd ) ] = dirname
+                lines.append( json.dumps( [ 'D', dirname ], separators=( ',', ':' ) ) + '\n' )
+
+             aclid = self._acl_id( fd, record.get( 'acl' ), owner, group, lines )
+             daclid = self._acl_id( fd, record.get( 'dacl' ), owner, group, lines )
+             lines.append( json.dumps( [ 'F', name, record.get( 'inode' ), record.get( 'gen' ), record.get( 'ctime' ),
+                                         record.get( 'type' ), owner, group, aclid, daclid ], separators=( ',', ':' ) ) + '\n' )
+             self.emit( fd, ''.join( lines ) )
+             self.count += 1
+
+
+      def write_line( self, path, line ):
+          self.write( json.loads( line ) )
+
+
+def open_backup_writer( prefix, shards=1, compress=False, format='jsonl' ):
+    """
+    Open a backup writer for the given format, jsonl or dedup.
+    """
+    if format == 'dedup':
+       return dedup_backup_writer( prefix, shards, compress )
+    return backup_writer( prefix, shards, compress )
+
+
+def backup_files( path ):
+    """
+    The files that make up a backup. path is either a single backup file or
+    the prefix given to a backup writer, in which case its shards are returned.
+    """
+    if os.path.isfile( path ) or path == '-':
+       return [ path ]
+
+    names = []
+    for suffix in [ '.jsonl', '.jsonl.gz', '.dedup', '.dedup.gz' ]:
+        names += glob.glob( path + '.[0-9][0-9][0-9]' + suffix )
+    return sorted( names )
+
+
+def _backup_file_lines( name ):
+    if name == '-':
+       for line in sys.stdin:
+           yield line
+       return
+
+    if name.endswith( '.gz' ):
+       fd = gzip.open( name, 'rb' )
+    else:
+       fd = open( name, 'rb' )
+    for line in fd:
+        yield line.decode( 'utf-8' )
+    fd.close()
+
+
+def iter_backup_lines( path ):
+    """
+    Stream the lines of a backup, one shard after the other, uncompressing
+    them on the fly.
+    """
+    for name in backup_files( path ):
+        for line in _backup_file_lines( name ):
+            yield line
+
+
+class dedup_backup_reader:
+      """
+      Stream the entries of a deduplicated backup without building ACL dicts.
+      Iterating yields ( path, inode, gen, ctime, type, owner, group, aclid,
+      daclid ) tuples; self.acls maps the ids to the canonical JSON text of
+      the ACLs seen so far. The ids are the same in every shard of a backup.
+      """
+      def __init__( self, lines ):
+          self.lines = lines
+          self.acls = {}
+
+
+      def __iter__( self ):
+          dirname = ''
+          for line in self.lines:
+              if line.startswith( '#' ):
+                 continue
+              line = line.strip()
+              if not line:
+                 continue
+
+              item = json.loads( line )
+              tag = item[0]
+              if tag == 'F':
+                 yield ( os.path.join( dirname, item[1] ), ) + tuple( item[2:] )
+              elif tag == 'D':
+                 dirname = item[1]
+              elif tag == 'A':
+                 self.acls[ item[1] ] = json.dumps( item[2], sort_keys=True, separators=( ',', ':' ) )
+
+
+      def acl( self, aclid, path, kind, owner, group, default=False ):
+          """
+          Rebuild the full ACL dict for an entry.
+          """
+          if aclid == None:
+             return None
+
+          acl = json.loads( self.acls[aclid] )
+          if kind == 'd':
+             dirname = path
+          else:
+             dirname = os.path.dirname( path )
+
+          if default:
+             acl['FQPN'] = dirname
+          else:
+             acl['FQPN'] = path
+             acl['DIRNAME'] = dirname
+          if owner != None and 'OWNER' not in acl:
+             acl['OWNER'] = owner
+          if group != None and 'GROUP' not in acl:
+             acl['GROUP'] = group
+          return acl
+
+
+def _read_dedup_lines( lines ):
+    reader = dedup_backup_reader( lines )
+    for ( path, inode, gen, ctime, kind, owner, group, aclid, daclid ) in reader:
+        record = {}
+        record['path'] = path
+        record['inode'] = inode
+        if gen != None:
+           record['gen'] = gen
+        if ctime != None:
+           record['ctime'] = ctime
+        record['type'] = kind
+        record['acl'] = reader.acl( aclid, path, kind, owner, group )
+        record['dacl'] = reader.acl( daclid, path, kind, owner, group, True )
+        yield record
+
+
+def _read_plain_lines( lines ):
+    """
+    Read JSON lines records, and the ACL: / DACL: lines printed by ssacl --json
+    and by the verbose mode of older versions of backup_acls.py.
+    """
+    pending = None
+    for line in lines:
+        line = line.strip()
+        if line.startswith( '{' ):
+           if pending:
+              yield pending
+              pending = None
+           yield json.loads( line )
+        elif line.startswith( 'ACL: ' ):
+           if pending:
+              yield pending
+           acl = json.loads( line[5:] )
+           pending = {}
+           pending['path'] = acl.get( 'FQPN' )
+           pending['inode'] = None
+           if acl.get( 'FQPN' ) == acl.get( 'DIRNAME' ):
+              pending['type'] = 'd'
+           else:
+              pending['type'] = 'f'
+           pending['acl'] = acl
+           pending['dacl'] = None
+        elif line.startswith( 'DACL: ' ) and pending:
+           pending['dacl'] = json.loads( line[6:] )
+           pending['type'] = 'd'
+    if pending:
+       yield pending
+
+
+def read_backup( path ):
+    """
+    Stream the records of a backup, whatever its format: JSON lines, the
+    deduplicated format, or the ACL: / DACL: text of older backups.
+
+    :param: A backup file, the prefix of a sharded backup, or - for stdin.
+    :return: A generator of record dicts.
+    """
+    for name in backup_files( path ):
+        lines = _backup_file_lines( name )
+        for first in lines:
+            if first.startswith( DEDUP_HEADER ):
+               records = _read_dedup_lines( lines )
+            else:
+               records = _read_plain_lines( itertools.chain( [ first ], lines ) )
+            for record in records:
+                yield record
+            break
+
+
+def _sorted_run( lines, tmpdir=None ):
+    """
+    Write lines, sorted, to an anonymous temporary file.
+
+    :return: The file, rewound.
+    """
+    fd = tempfile.TemporaryFile( mode='w+', dir=tmpdir )
+    fd.writelines( lines )
+    fd.seek( 0 )
+    return fd
+
+
+def _signature_lines( path, with_records=False ):
+    """
+    The unsorted entries for sorted_backup_lines(). In a deduplicated backup
+    the signatures of each distinct ACL are worked out once, unless the
+    records are wanted too.
+    """
+    for name in backup_files( path ):
+        if name != '-' and not with_records:
+           lines = _backup_file_lines( name )
+           first = next( lines, '' )
+           if first.startswith( DEDUP_HEADER ):
+              reader = dedup_backup_reader( lines )
+              known = {}
+              for entry in reader:
+                  ( aclid, daclid ) = entry[7:9]
+                  signatures = known.get( ( aclid, daclid ) )
+                  if signatures == None:
+                     acls = [ None, None ]
+                     if aclid != None:
+                        acls[0] = json.loads( reader.acls[aclid] )
+                     if daclid != None:
+                        acls[1] = json.loads( reader.acls[daclid] )
+                     signatures = json.dumps( [ acl_signature( acls[0] ), acl_signature( acls[1] ) ] )
+                     known[ ( aclid, daclid ) ] = signatures
+                  yield json.dumps( entry[0] ) + '\t' + signatures + '\n'
+              continue
+           lines.close()
+
+        for record in read_backup( name ):
+            line = json.dumps( record['path'] ) + '\t' + json.dumps( [ acl_signature( record.get( 'acl' ) ), acl_signature( record.get( 'dacl' ) ) ] )
+            if with_records:
+               line += '\t' + json.dumps( record, sort_keys=True )
+            yield line + '\n'
+
+
+def sorted_lines( source, chunk=DIFF_CHUNK, tmpdir=None ):
+    """
+    Sort a stream of lines with bounded memory. Runs of chunk lines are
+    sorted and spilled to temporary files, which are merged DIFF_MERGE_WIDTH
+    at a time.
+
+    :param: An iterable of lines, each ending in a newline.
+    :param: The number of lines sorted in memory at a time.
+    :param: Where to spill the sorted runs. Default: the temporary directory.
+    :return: A generator of the lines, in order.
+    """
+    runs = []
+    lines = []
+    try:
+       for line in source:
+           lines.append( line )
+           if len( lines ) >= chunk:
+              lines.sort()
+              runs.append( ( 0, _sorted_run( lines, tmpdir ) ) )
+              lines = []
+
+              # Merge the runs of a level once there are enough of them, to
+              # keep the number of open files down.
+              while len( runs ) >= DIFF_MERGE_WIDTH and len( set( [ run[0] for run in runs[-DIFF_MERGE_WIDTH:] ] ) ) == 1:
+                 level = runs[-1][0]
+                 merging = [ run[1] for run in runs[-DIFF_MERGE_WIDTH:] ]
+                 del runs[-DIFF_MERGE_WIDTH:]
+                 runs.append( ( level + 1, _sorted_run( heapq.merge( *merging ), tmpdir ) ) )
+                 for fd in merging:
+                     fd.close()
+
+       lines.sort()
+       if not runs:
+          for line in lines:
+              yield line
+          return
+
+       for line in heapq.merge( iter( lines ), *[ run[1] for run in runs ] ):
+           yield line
+    finally:
+       for run in runs:
+           run[1].close()
+
+
+def sorted_backup_lines( path, with_records=False, chunk=DIFF_CHUNK, tmpdir=None ):
+    """
+    Stream the entries of a backup sorted by path, with bounded memory, see
+    sorted_lines().
+
+    Each entry is a line of tab separated JSON: the path, the acl_signature()
+    of the ACL and of the default ACL, and with with_records the whole record.
+    The path is JSON encoded, so a tab never appears in it and the lines sort
+    the same way in every backup.
+
+    :param: The backup file or prefix.
+    :param: Keep the records, eg. to write them out again.
+    :param: The number of entries sorted in memory at a time.
+    :param: Where to spill the sorted runs. Default: the temporary directory.
+    :return: A generator of the lines, in order.
+    """
+    return sorted_lines( _signature_lines( path, with_records ), chunk, tmpdir )
+
+
+def _unique_entries( lines ):
+    """
+    Split sorted backup lines into ( JSON path, line ) tuples, keeping the
+    first of the entries with the same path.
+    """
+    last = None
+    for line in lines:
+        key = line[0:line.index( '\t' )]
+        if key != last:
+           yield ( key, line )
+           last = key
+
+
+def diff_backups( old, new, with_records=False, totals=None, chunk=DIFF_CHUNK, tmpdir=None ):
+    """
+    Compare two backups path by path, with a merge of both sorted by path.
+    Memory use does not depend on the size of the backups.
+
+    :param: The earlier backup file or prefix.
+    :param: The later backup file or prefix.
+    :param: Hand back the records of both backups too.
+    :param: A counters object to count the paths added, removed, changed
+            and unchanged in.
+    :param: The number of entries sorted in memory at a time.
+    :param: Where to spill the sorted runs.
+    :return: A generator of ( path, old, new ) tuples, one for each path
+             whose ACLs differ. old and new are [ ACL signature, default ACL
+             signature ] lists, or None when the path is not in that backup.
+             With with_records each gets its record as a third element.
+    """
+    def parse( fields ):
+        signatures = json.loads( fields[1] )
+        if len( fields ) > 2:
+           signatures.append( json.loads( fields[2] ) )
+        return signatures
+
+    olds = _unique_entries( sorted_backup_lines( old, with_records, chunk, tmpdir ) )
+    news = _unique_entries( sorted_backup_lines( new, with_records, chunk, tmpdir ) )
+    before = next( olds, None )
+    after = next( news, None )
+
+    while before != None or after != None:
+       if after == None or ( before != None and before[0] < after[0] ):
+          fields = before[1].rstrip( '\n' ).split( '\t' )
+          if totals:
+             totals.add( 'removed' )
+          yield ( json.loads( fields[0] ), parse( fields ), None )
+          before = next( olds, None )
+       elif before == None or after[0] < before[0]:
+          fields = after[1].rstrip( '\n' ).split( '\t' )
+          if totals:
+             totals.add( 'added' )
+          yield ( json.loads( fields[0] ), None, parse( fields ) )
+          after = next( news, None )
+       else:
+          old_fields = before[1].rstrip( '\n' ).split( '\t' )
+          new_fields = after[1].rstrip( '\n' ).split( '\t' )
+          if old_fields[1] == new_fields[1]:
+             if totals:
+                totals.add( 'unchanged' )
+          else:
+             if totals:
+                totals.add( 'changed' )
+             yield ( json.loads( old_fields[0] ), parse( old_fields ), parse( new_fields ) )
+          before = next( olds, None )
+          after = next( news, None )
+
+
+def cleared_record( record ):
+    """
+    The record that takes a path back to no extended ACL: the ACL keeps only
+    its user, group and other permissions, and a directory loses its default
+    ACL, as --restore does for a default ACL the backup did not record.
+
+    :param: A backup record.
+    :return: A new record.
+    """
+    cleared = dict( record )
+    acl = record.get( 'acl' )
+    if acl:
+       cleared['acl'] = dict( [ ( key, value ) for ( key, value ) in acl.items() if key not in [ 'MASK', 'USERS', 'GROUPS' ] ] )
+    if record.get( 'type' ) == 'd' or record.get( 'dacl' ):
+       dacl = record.get( 'dacl' ) or acl or {}
+       cleared['dacl'] = dict( [ ( key, value ) for ( key, value ) in dacl.items() if key in [ 'FQPN', 'OWNER', 'GROUP' ] ] )
+    return cleared
+
+
+def signature_changes( old, new ):
+    """
+    The entries that differ between two acl_signature() values, as they come
+    back from diff_backups().
+
+    :return: A list of ( entry, old perms, new perms ) tuples, eg.
+             ( 'group:daemon', 'r---', 'r-x-' ). A perms is None where the
+             entry is missing.
+    """
+    old = old or [ None, None, None, None, [], [] ]
+    new = new or [ None, None, None, None, [], [] ]
+
+    changes = []
+    for ( idx, entry ) in enumerate( [ 'user:', 'group:', 'other:', 'mask:' ] ):
+        if old[idx] != new[idx]:
+           changes.append( ( entry, old[idx], new[idx] ) )
+
+    for ( idx, kind ) in [ ( 4, 'user:' ), ( 5, 'group:' ) ]:
+        before = dict( [ ( name, perms ) for ( name, perms ) in old[idx] ] )
+        after = dict( [ ( name, perms ) for ( name, perms ) in new[idx] ] )
+        for name in sorted( set( before ) | set( after ) ):
+            if before.get( name ) != after.get( name ):
+               changes.append( ( kind + name, before.get( name ), after.get( name ) ) )
+    return changes
+
+
+JOURNAL_HEADER = '#ssacl-journal 1'
+
+class progress_journal:
+      """
+      An append-only record of the work a run has finished, so that a run
+      that was interrupted can be resumed without starting over. Each line is
+      a JSON array:
+
+         ["C", command]  the options of the run that wrote the journal
+         ["F", path]     the ACLs of path have been applied
+         ["D", path]     everything below directory path is done
+
+      The lines are buffered and synced to disk every JOURNAL_SYNC_RECORDS
+      records, and by a background thread every JOURNAL_SYNC_SECONDS seconds
+      however few were written, so a crash loses at most that much progress,
+      and only ever work that is redone on resume.
+
+      A directory is done once its own ACLs, all of its entries and all of its
+      sub-directories are. The walk reports every entry with add() before it
+      is queued and every directory with listed() once its entries are all
+      read. The workers report every file with done() once it is applied, in
+      any order and from any thread. An entry that fails is never reported,
+      which keeps its directory and the ones above it from completing.
+
+      On resume the finished directories are skipped whole, and only the F
+      lines of files outside them are kept in memory. The paths of --file,
+      --policy and --restore runs have no directories to finish, so those
+      keep one entry per file that was done.
+      """
+      def __init__( self, path, resume=False ):
+          """
+          :param: The journal file.
+          :param: Load the work an earlier run recorded in it, and append to it.
+          """
+          self.lock = threading.Lock()
+          self.path = path
+          self.files = set()
+          self.dirs = set()
+          self.command = None
+          self.skipped = 0
+          self.pending = {}
+          self.unsynced = 0
+          self.last_sync = time.time()
+
+          if resume:
+             self.load()
+
+          self.fd = open( path, 'a' )
+          if self.fd.tell() == 0:
+             self.fd.write( JOURNAL_HEADER + '\n' )
+
+          stopped = threading.Event()
+          def run():
+              while not stopped.wait( JOURNAL_SYNC_SECONDS ):
+                 with self.lock:
+                    if self.fd != None and self.unsynced:
+                       self._sync()
+
+          self.syncer = threading.Thread( target=run )
+          self.syncer.daemon = True
+          self.syncer.stopped = stopped
+          self.syncer.start()
+
+
+      def load( self ):
+          """
+          Read the work recorded in the journal, the finished directories
+          first, then the files outside them. The files below the finished
+          directories are never asked about. A last line cut short by a crash
+          is ignored.
+          """
+          for ( kind, value ) in self._records():
+              if kind == 'D':
+                 self.dirs.add( value )
+              elif kind == 'C':
+                 self.command = value
+
+          for ( kind, value ) in self._records():
+              if kind == 'F' and not ( self.dirs and self._covered( os.path.dirname( value ) ) ):
+                 self.files.add( value )
+
+
+      def _records( self ):
+          with open( self.path ) as fd:
+             for line in fd:
+                 if line.startswith( '#' ):
+                    continue
+                 try:
+                    ( kind, value ) = json.loads( line )
+                 except ValueError:
+                    continue
+                 yield ( kind, value )
+
+
+      def _covered( self, path ):
+          while True:
+             if path in self.dirs:
+                return True
+             parent = os.path.dirname( path )
+             if parent == path:
+                return False
+             path = parent
+
+
+      def completed( self, path ):
+          """
+          :return: True if path, or a directory above it, was finished by an
+                   earlier run. Its tree can be skipped.
+          """
+          if self.dirs and self._covered( os.path.abspath( path ) ):
+             self.skipped += 1
+             return True
+          return False
+
+
+      def record_command( self, command ):
+          with self.lock:
+             self.command = command
+             self._write( 'C', command )
+
+
+      def add( self, path, isdir=False, own=True ):
+          """
+          Report a path found by the walk. A directory is tracked until it is
+          listed and everything in it is done.
+
+          :param: The path.
+          :param: The path is a directory whose entries will be walked.
+          :param: False if the path belongs to another --shard. A directory
+                  is still tracked for its entries, but not its own ACLs.
+          :return: False if its own ACLs were finished by an earlier run, or
+                   are left to another shard.
+          """
+          path = os.path.abspath( path )
+          parent = os.path.dirname( path )
+          with self.lock:
+             if isdir:
+                # One count for the listing, and one for each entry in it.
+                if path in self.pending:
+                   self.pending[path] += 1
+                else:
+                   self.pending[path] = 1
+                   if parent in self.pending:
+                      self.pending[parent] += 1
+                if not own:
+                   return False
+                if path in self.files:
+                   self.skipped += 1
+                   return False
+                self.pending[path] += 1
+                return True
+
+             if not own:
+                return False
+             if path in self.files:
+                self.skipped += 1
+                return False
+             if parent in self.pending:
+                self.pending[parent] += 1
+             return True
+
+
+      def listed( self, path ):
+          """
+          Report that all the entries of a directory have been added.
+          """
+          with self.lock:
+             self._release( os.path.abspath( path ) )
+
+
+      def done( self, path ):
+          """
+          Report that the ACLs of a path have been applied.
+          """
+          path = os.path.abspath( path )
+          with self.lock:
+             self._write( 'F', path )
+             if path in self.pending:
+                self._release( path )
+             else:
+                self._release( os.path.dirname( path ) )
+
+
+      def _release( self, path ):
+          while path in self.pending:
+             self.pending[path] -= 1
+             if self.pending[path] > 0:
+                break
+             del self.pending[path]
+             self._write( 'D', path )
+             path = os.path.dirname( path )
+
+
+      def _write( self, kind, value ):
+          self.fd.write( json.dumps( [ kind, value ] ) + '\n' )
+          self.unsynced += 1
+          if self.unsynced >= JOURNAL_SYNC_RECORDS or time.time() - self.last_sync >= JOURNAL_SYNC_SECONDS:
+             self._sync()
+
+
+      def _sync( self ):
+          if STATS:
+             start = time.time()
+          self.fd.flush()
+          os.fsync( self.fd.fileno() )
+          if STATS:
+             STATS.record( 'journal_sync', time.time() - start )
+          self.unsynced = 0
+          self.last_sync = time.time()
+
+
+      def close( self ):
+          self.syncer.stopped.set()
+          with self.lock:
+             if self.fd != None:
+                self._sync()
+                self.fd.close()
+                self.fd = None
+
+
+class acl_pipeline:
+      """
+      A staged worker pipeline. Every stage has its own pool of threads and
+      a bounded queue feeding it, so a fast producer blocks in submit()
+      instead of running ahead of the workers by millions of entries.
+
+      A stage is a tuple of ( name, function, workers ). The function is
+      called with one item and its return value is handed to the next stage.
+      Returning None drops the item.
+
+      A stage may add a fourth element, a batch size. Its function is then
+      called with a list of up to that many queued items and returns a list
+      of results for the next stage. When it raises, the items of the batch
+      are tried again one at a time, so only the ones that fail are lost and
+      each of them is reported and counted.
+      """
+      _STOP = object()
+
+      def __init__( self, stages, queue_size=1024 ):
+          self.stages = []
+          self.lock = threading.Lock()
+          self.processed = {}
+          self.failed = {}
+
+          for spec in stages:
+              name = spec[0]
+              stage = {}
+              stage['NAME'] = name
+              stage['FUNCTION'] = spec[1]
+              if len( spec ) > 3:
+                 stage['BATCH'] = spec[3]
+              else:
+                 stage['BATCH'] = 0
+              stage['QUEUE'] = queue.Queue( maxsize=queue_size )
+              stage['THREADS'] = []
+              self.processed[name] = 0
+              self.failed[name] = 0
+              self.stages.append( stage )
+
+          for idx in range( len( self.stages ) ):
+              for count in range( max( 1, stages[idx][2] ) ):
+                  t = threading.Thread( target=self._run_stage, args=( idx, ) )
+                  t.daemon = True
+                  t.start()
+                  self.stages[idx]['THREADS'].append( t )
+
+
+      def _run_stage( self, idx ):
+          stage = self.stages[idx]
+          if idx + 1 < len( self.stages ):
+             next_queue = self.stages[idx + 1]['QUEUE']
+          else:
+             next_queue = None
+
+          stopped = False
+          while not stopped:
+             item = stage['QUEUE'].get()
+             if item is self._STOP:
+                break
+
+             if stage['BATCH']:
+                # Take whatever else is already queued, up to the batch size.
+                batch = [ item ]
+                while len( batch ) < stage['BATCH']:
+                   try:
+                      item = stage['QUEUE'].get_nowait()
+                   except queue.Empty:
+                      break
+                   if item is self._STOP:
+                      stopped = True
+                      break
+                   batch.append( item )
+                item = batch
+
+             failures = 0
+             try:
+                result = self._call( stage, item )
+             except Exception as e:
+                if not stage['BATCH']:
+                   self._failed( stage, item, e )
+                   continue
+                ( result, failures ) = self._retry_singly( stage, item, e )
+
+             if stage['BATCH']:
+                results = result or []
+                done = len( item ) - failures
+             else:
+                results = [ result ]
+                done = 1
+
+             with self.lock:
+                self.processed[stage['NAME']] += done
+
+             if next_queue is not None:
+                for result in results:
+                    if result is not None:
+                       next_queue.put( result )
+
+
+      def _call( self, stage, item ):
+          if STATS:
+             start = time.time()
+          try:
+             result = stage['FUNCTION']( item )
+          except Exception:
+             if STATS:
+                STATS.record( 'stage_' + stage['NAME'], time.time() - start, True )
+             raise
+          if STATS:
+             STATS.record( 'stage_' + stage['NAME'], time.time() - start )
+          return result
+
+
+      def _retry_singly( self, stage, batch, error ):
+          """
+          Run the items of a batch that raised one at a time.
+
+          :return: A ( results, failures ) tuple.
+          """
+          if len( batch ) == 1:
+             self._failed( stage, batch[0], error )
+             return ( [], 1 )
+
+          results = []
+          failures = 0
+          for item in batch:
+              try:
+                 results += self._call( stage, [ item ] ) or []
+              except Exception as e:
+                 self._failed( stage, item, e )
+                 failures += 1
+          return ( results, failures )
+
+
+      def _failed( self, stage, item, error ):
+          print("ERROR: %s: %s: %s" % ( stage['NAME'], item, error ) )
+          with self.lock:
+             self.failed[stage['NAME']] += 1
+
+
+      def submit( self, item ):
+          """
+          Queue an item for the first stage. Blocks while that queue is full.
+          """
+          self.stages[0]['QUEUE'].put( item )
+
+
+      def close( self ):
+          """
+          Drain the pipeline one stage at a time and wait for the workers to exit.
+          """
+          for stage in self.stages:
+              for t in stage['THREADS']:
+                  stage['QUEUE'].put( self._STOP )
+              for t in stage['THREADS']:
+                  t.join()
+
+
 if __name__ == '__main__':
    print("Get File ACL")
    a = mmacls( '/data/acl/a' )
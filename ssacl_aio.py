@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+An asyncio engine for the mmgetacl and mmputacl calls of ssacl.
+
+execute_command() blocks its thread until the command exits, so a run can
+only have as many calls in flight as it has threads. Here the commands are
+started with asyncio subprocesses from one thread, and a semaphore keeps up
+to a given number of them in flight.
+
+This needs Python 3.5 or later. The ssacl module itself still runs on
+Python 2, so the asyncio code is kept in this module.
+
+   engine = aio_engine( 256 )
+   myacl = await engine.fetch( '/gpfs/fs/dir', with_default=True )
+   rc = await myacl.set_acl_async( aclfile )
+
+"""
+
+import os
+import sys
+import time
+import asyncio
+from asyncio.subprocess import PIPE
+
+import ssacl
+from ssacl import mmacls, parse_acl
+
+
+class aio_engine:
+      """
+      Run ACL commands as asyncio subprocesses, at most limit at a time.
+      With a backend other than mm the ACLs are read and written in
+      process, and the limit does not apply.
+      """
+      def __init__( self, limit=256, dryrun=False, verbose=False ):
+          self.limit = limit
+          self.dryrun = dryrun
+          self.verbose = verbose
+          self.semaphore = None
+          self.slots = None
+          self.inflight = 0
+
+
+      async def execute( self, argv ):
+          """
+          Run a command.
+
+          :param: The command as a list of arguments. No shell is involved.
+          :return: A tuple of ( return code, stdout, stderr ).
+          """
+          if self.semaphore == None:
+             self.semaphore = asyncio.Semaphore( self.limit )
+             self.slots = asyncio.Condition()
+
+          throttle = ssacl.THROTTLE
+          async with self.semaphore:
+             if throttle:
+                await self.throttle_wait( throttle )
+             if ssacl.STATS or throttle:
+                start = time.time()
+             try:
+                subp = await asyncio.create_subprocess_exec( *argv, stdout=PIPE, stderr=PIPE )
+                ( outdata, errdata ) = await subp.communicate()
+             finally:
+                if throttle and throttle.target:
+                   async with self.slots:
+                      self.inflight -= 1
+                      self.slots.notify_all()
+             if ssacl.STATS:
+                ssacl.STATS.record( os.path.basename( argv[0] ), time.time() - start, subp.returncode != 0 )
+             if throttle:
+                throttle.record( time.time() - start )
+          return ( subp.returncode, outdata.decode( 'utf-8', 'replace' ), errdata.decode( 'utf-8', 'replace' ) )
+
+
+      async def throttle_wait( self, throttle ):
+          """
+          Wait for a slot under the adaptive limit of the acl_throttle, and for
+          its rate allowance. The slot is given back in execute().
+          """
+          if ssacl.STATS:
+             start = time.time()
+          if throttle.target:
+             async with self.slots:
+                await self.slots.wait_for( lambda: self.inflight < throttle.limit )
+                self.inflight += 1
+          wait = throttle.reserve()
+          if wait > 0:
+             await asyncio.sleep( wait )
+          if ssacl.STATS:
+             ssacl.STATS.record( 'throttle_wait', time.time() - start )
+
+
+      async def get_acl_text( self, filename, default=False ):
+          """
+          :return: The ACL text as mmgetacl prints it, or None if it failed.
+          """
+          backend = ssacl.get_backend()
+          if backend.name != 'mm':
+             return backend.get_acl_text( filename, default )
+
+          if default:
+             cmd = [ ssacl.MMGETACL, '-d', filename ]
+          else:
+             cmd = [ ssacl.MMGETACL, filename ]
+
+          ( rc, stdout, stderr ) = await self.execute( cmd )
+          if rc != 0:
+             print("Command: %s ERROR: %s" % ( ' '.join( cmd ), rc ) )
+             print("STDOUT: %s\nSTDERR: %s" % ( stdout, stderr ) )
+             return None
+          return stdout
+
+
+      async def put_acl( self, filename, aclfile, default=False, dryrun=False, verbose=False ):
+          """
+          Set the ACL, or the default ACL, of a file to the contents of an ACL file.
+          An empty default ACL removes it, with mmdelacl -d.
+
+          :return: The mmputacl return code. 0 in dry-run mode.
+          """
+          backend = ssacl.get_backend()
+          if backend.name != 'mm':
+             return backend.put_acl( filename, aclfile, default, dryrun, verbose )
+
+          if default and os.path.getsize( aclfile ) == 0:
+             cmd = [ ssacl.MMDELACL, '-d', filename ]
+          elif default:
+             cmd = [ ssacl.MMPUTACL, '-d', '-i', aclfile, filename ]
+          else:
+             cmd = [ ssacl.MMPUTACL, '-i', aclfile, filename ]
+
+          if dryrun:
+             print( ' '.join( cmd ) )
+             return 0
+          if verbose:
+             print( ' '.join( cmd ) )
+
+          ( rc, stdout, stderr ) = await self.execute( cmd )
+          if rc != 0:
+             print("Command: %s ERROR: %s" % ( ' '.join( cmd ), rc ) )
+             print("STDOUT: %s\nSTDERR: %s" % ( stdout, stderr ) )
+          return rc
+
+
+      async def fetch( self, filename, with_default=False ):
+          """
+          Fetch the ACL of a file, and of a directory its default ACL too when
+          with_default is set.
+
+          :return: An async_mmacls object. Its filename is None when the file
+                   does not exist, and its acls None when the fetch failed.
+          """
+          myacl = async_mmacls( filename, self )
+          if myacl.filename == None:
+             return myacl
+
+          await myacl.get_acl_async()
+          if myacl.acls != None and with_default and myacl.is_file == False:
+             await myacl.get_default_acl_async()
+          return myacl
+
+
+class async_mmacls( mmacls ):
+      """
+      A mmacls object that fetches and applies its ACLs through an aio_engine.
+      The constructor does not fetch anything; await get_acl_async() or use
+      aio_engine.fetch().
+      """
+      def __init__( self, fname=None, engine=None ):
+          mmacls.__init__( self, fname, {} )
+          self.acls = None
+          if engine == None:
+             engine = aio_engine()
+          self.engine = engine
+          self.dryrun = engine.dryrun
+          self.verbose = engine.verbose
+
+
+      async def get_acl_async( self ):
+          output = await self.engine.get_acl_text( self.filename )
+          if output == None:
+             self.acls = None
+             return None
+
+          self.acls = parse_acl( output, self.filename, self.dirname )
+          return self.acls
+
+
+      async def get_default_acl_async( self ):
+          output = await self.engine.get_acl_text( self.filename, True )
+          if output == None:
+             self.default_acls = None
+             return None
+
+          self.default_acls = parse_acl( output, self.dirname )
+          return self.default_acls
+
+
+      async def set_acl_async( self, aclfile=None ):
+          return await self.engine.put_acl( self.filename, aclfile, False, self.dryrun, self.verbose )
+
+
+      async def set_default_acl_async( self, aclfile=None ):
+          return await self.engine.put_acl( self.filename, aclfile, True, self.dryrun, self.verbose )
+
+
+async def _run_item( engine, item, path, transform, done, failed, missing, with_default ):
+    myacl = await engine.fetch( path, with_default )
+    if myacl.filename == None:
+       if missing:
+          missing( item )
+       return
+
+    if myacl.acls == None:
+       if failed:
+          failed( item )
+       return
+
+    work = transform( myacl, item )
+    if work == None:
+       return
+
+    ( myacl, acl_file, default_acl_file ) = work
+    rc = 0
+    if acl_file:
+       rc = await myacl.set_acl_async( acl_file ) or rc
+    if default_acl_file:
+       rc = await myacl.set_default_acl_async( default_acl_file ) or rc
+    done( work, rc )
+
+
+def _errors( tasks ):
+    count = 0
+    for task in tasks:
+        error = task.exception()
+        if error != None:
+           print("ERROR: %s" % ( error ))
+           count += 1
+    return count
+
+
+async def _run_items( engine, items, transform, done, failed, missing, with_default, path_of ):
+    errors = 0
+    pending = set()
+    for item in items:
+        # Keep the walk at most two tasks per slot ahead of the commands.
+        if len( pending ) >= engine.limit * 2:
+           ( finished, pending ) = await asyncio.wait( pending, return_when=asyncio.FIRST_COMPLETED )
+           errors += _errors( finished )
+
+        path = path_of( item ) if path_of else item
+        pending.add( asyncio.ensure_future( _run_item( engine, item, path, transform, done, failed, missing, with_default ) ) )
+
+    if pending:
+       ( finished, pending ) = await asyncio.wait( pending )
+       errors += _errors( finished )
+    return errors
+
+
+def run_acl_tasks( items, transform, done, failed=None, missing=None, limit=256, with_default=False, path_of=None, dryrun=False, verbose=False ):
+    """
+    Fetch, transform and apply the ACLs for a stream of items with up to
+    limit mmgetacl and mmputacl calls in flight, all from the calling thread.
+
+    :param: An iterable of paths, or of records holding one.
+    :param: A function called with the fetched async_mmacls object and the
+            item. It returns a ( mmacls object, ACL file, default ACL file )
+            tuple, where either file may be None, or None to skip the item.
+    :param: A function called with that tuple and the return code once the
+            ACLs are applied.
+    :param: A function called with the item when its ACL can not be fetched.
+    :param: A function called with the item when its file does not exist.
+    :param: The number of commands in flight.
+    :param: Fetch the default ACLs of directories as well.
+    :param: A function returning the path of an item. Items are paths if None.
+    :param: Only print the mmputacl commands.
+    :param: Print the mmputacl commands as they run.
+    :return: The number of items that raised an exception.
+    """
+    engine = aio_engine( limit, dryrun, verbose )
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop( loop )
+    watcher = None
+    if sys.version_info < ( 3, 8 ):
+       # Before 3.8 the child watcher reaps the mmgetacl and mmputacl
+       # processes from a SIGCHLD handler, which needs the loop attached and
+       # only works in the main thread.
+       watcher = asyncio.get_child_watcher()
+       watcher.attach_loop( loop )
+    try:
+       return loop.run_until_complete( _run_items( engine, items, transform, done, failed, missing, with_default, path_of ) )
+    finally:
+       if watcher:
+          watcher.attach_loop( None )
+       asyncio.set_event_loop( None )
+       loop.close()
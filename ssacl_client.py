@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+
+Run an ssacl command line on ssacl_server.py. It takes the same arguments
+as ssacl, prints the same output and exits with the same status, but only
+imports what it needs to talk to the server, so a call costs little more
+than starting the interpreter. When no server is listening, ssacl itself
+is run instead.
+
+   ssacl_client.py --add -g nfsnobody -a r-x- /data/proj/new
+   find /data/proj -newer /data/proj/.stamp | ssacl_client.py --list --file -
+
+The socket is SSACL_SOCKET, or /var/run/ssacl.sock. When the command reads
+standard input, a --file, --restore or --diff given as -, it is streamed to
+the server while the command runs, a block at a time, so a list of millions
+of paths is never held in memory.
+
+There is _NO_ support. Use it at your own risk.
+
+If you find a bug, fix it.  Then, send me the diff and I'll merge it into the code.
+
+"""
+
+import sys
+import os
+import json
+import errno
+import socket
+import argparse
+import threading
+
+SOCKET = os.environ.get( 'SSACL_SOCKET', '/var/run/ssacl.sock' )
+
+class option_error( Exception ):
+      pass
+
+
+class option_parser( argparse.ArgumentParser ):
+      """
+      Leaves the reporting of bad options to ssacl.
+      """
+      def error( self, message ):
+          raise option_error( message )
+
+
+def reads_stdin( argv ):
+    """
+    True if the ssacl command line reads standard input: the --file list,
+    or the --restore or --diff backup, given as -. A - that is the value of
+    another option does not count.
+    """
+    parser = option_parser( add_help=False )
+    parser.add_argument( "--file", dest = "input_file", default = None )
+    parser.add_argument( "--restore", dest = "restore", default = None )
+    parser.add_argument( "--diff", dest = "diff", default = [], nargs = 2 )
+    try:
+       ( options, args ) = parser.parse_known_args( argv )
+    except option_error:
+       return False
+    return '-' in [ options.input_file, options.restore ] + options.diff
+
+
+def send_stdin( sock ):
+    """
+    Copy standard input to the server, and close the sending side of the
+    socket at its end. It runs while the output is read, so neither side
+    waits on the other.
+    """
+    stdin = getattr( sys.stdin, 'buffer', sys.stdin )
+    read = getattr( stdin, 'read1', stdin.read )
+    try:
+       for block in iter( lambda: read( 65536 ), b'' ):
+           sock.sendall( block )
+       sock.shutdown( socket.SHUT_WR )
+    except socket.error:
+       # The command ended without reading all of it.
+       pass
+
+
+def run_remote( argv, path=SOCKET ):
+    """
+    Send a command line to the server and relay its output.
+
+    :param: The ssacl arguments.
+    :param: The server socket.
+    :return: The exit status of the command.
+    :raise: socket.error if the server can not be reached.
+    """
+    sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+    sock.connect( path )
+
+    request = { 'argv': argv, 'cwd': os.getcwd(), 'stdin': reads_stdin( argv ) }
+    sock.sendall( ( json.dumps( request ) + '\n' ).encode( 'utf-8' ) )
+    if request['stdin']:
+       feeder = threading.Thread( target=send_stdin, args=( sock, ) )
+       feeder.daemon = True
+       feeder.start()
+
+    for line in sock.makefile( 'rb' ):
+        reply = json.loads( line.decode( 'utf-8' ) )
+        if 'out' in reply:
+           sys.stdout.write( reply['out'] )
+        if 'err' in reply:
+           sys.stdout.flush()
+           sys.stderr.write( reply['err'] )
+        if 'rc' in reply:
+           return reply['rc']
+
+    sys.stderr.write( "ERROR: The server closed the connection.\n" )
+    return 1
+
+
+if __name__ == '__main__':
+   try:
+      rc = run_remote( sys.argv[1:] )
+   except socket.error as e:
+      if e.errno not in [ errno.ENOENT, errno.ECONNREFUSED ]:
+         raise
+      os.execvp( 'ssacl', [ 'ssacl' ] + sys.argv[1:] )
+   sys.exit( rc )
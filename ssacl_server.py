@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+"""
+
+Run ssacl commands for ssacl_client.py, without starting a new ssacl for
+each one. Every ssacl pays for starting the interpreter, importing the
+module and setting up its options before it looks at a single file, which
+adds up when scripts call it thousands of times. This loads ssacl once,
+listens on a Unix socket, and runs the command lines sent to it in the
+same process, where the ACL files written by earlier commands, the user
+and group lookups, and the directory ACLs fetched by --check stay warm.
+The ACL files are started over after an hour, or once there are 65536 of
+them. The --jobs workers are not kept: every command starts its own
+threads, which costs far less than starting ssacl did.
+
+   ssacl_server.py -s /var/run/ssacl.sock &
+   ssacl_client.py --add -g nfsnobody -a r-x- /data/proj/new
+   ssacl_client.py --check -u ckerner -a rw-- /data/proj/results
+
+A request is one JSON line, {"argv": [...], "cwd": "...", "stdin": true}.
+When stdin is true, the standard input of the client follows, up to the
+end of its side of the connection, and is read by the command as it runs
+without being held in memory. The reply is a JSON line for every piece of output, {"out": "..."} or
+{"err": "..."}, and a last {"rc": N} with the exit status. The commands
+run one at a time, in the working directory of the client, with the
+permissions of the server. The socket is only open to the user running
+the server, and connections from other users are refused.
+
+There is _NO_ support. Use it at your own risk.
+
+If you find a bug, fix it.  Then, send me the diff and I'll merge it into the code.
+
+"""
+
+from __future__ import print_function
+import sys
+import os
+import io
+import time
+import json
+import errno
+import signal
+import socket
+import struct
+import threading
+import traceback
+
+try:
+   import socketserver
+except ImportError:
+   import SocketServer as socketserver
+
+# The socket when neither --socket nor SSACL_SOCKET is given.
+DEFAULT_SOCKET = '/var/run/ssacl.sock'
+
+# One command runs at a time, the ssacl options and counters are global.
+RUN_LOCK = threading.Lock()
+
+def parse_options( argv ):
+    """
+    This function handles the parsing of the command line arguments.
+
+    Args:
+      argv: A list of command line arguments, passed in from sys.argv
+
+    Returns
+      options: A dictionary of the command line option settings
+      args   : A list of files
+
+    """
+
+    import argparse
+    import textwrap
+    parser = argparse.ArgumentParser(
+                                     formatter_class = argparse.RawTextHelpFormatter,
+                                     prog = 'ssacl_server.py',
+                                     description = textwrap.dedent('''\
+                                             ssacl_server.py - Run ssacl commands sent over a Unix socket
+
+                                             Loads ssacl once and runs the command lines sent by ssacl_client.py,
+                                             keeping its caches warm between them.
+
+                                             '''),
+                                     epilog = textwrap.dedent('''\
+
+                                             Chad Kerner - ckerner@illinois.edu
+                                             Senior Storage Engineer, Storage Enabling Technologies
+                                             National Center for Supercomputing Applications
+                                             University of Illinois, Urbana-Champaign''')
+                                    )
+
+    parser.add_argument( "-s", "--socket",
+                         dest = "socket",
+                         default = os.environ.get( 'SSACL_SOCKET', DEFAULT_SOCKET ),
+                         action = 'store',
+                         help = "The Unix socket to listen on. Default: SSACL_SOCKET or %s" % ( DEFAULT_SOCKET ))
+
+    parser.add_argument( "--ssacl",
+                         dest = "ssacl",
+                         default = None,
+                         action = 'store',
+                         help = "The ssacl script to load. Default: ssacl in the PATH, or next to this script")
+
+    parser.add_argument( "-v", "--verbose",
+                         dest = "verbose",
+                         default = False,
+                         action = 'store_true',
+                         help = "Log every command, with its exit status and time, on stderr. Default: %(default)s")
+
+    options, args = parser.parse_known_args( argv )
+    return ( options, args )
+
+
+def find_ssacl():
+    """
+    :return: The path of the ssacl script, or None if there is none.
+    """
+    dirs = os.environ.get( 'PATH', '' ).split( os.pathsep )
+    dirs.append( os.path.dirname( os.path.abspath( __file__ ) ) )
+    for dirname in dirs:
+        path = os.path.join( dirname, 'ssacl' )
+        if dirname and os.path.isfile( path ):
+           return path
+    return None
+
+
+def load_ssacl( path ):
+    """
+    Load the ssacl script as the ssacl_cli module. It imports the ssacl
+    module itself as usual.
+
+    :return: The module, with run_command() to run a command line.
+    """
+    sys.dont_write_bytecode = True
+    try:
+       import importlib.util
+       import importlib.machinery
+    except ImportError:
+       import imp
+       return imp.load_source( 'ssacl_cli', path )
+
+    loader = importlib.machinery.SourceFileLoader( 'ssacl_cli', path )
+    module = importlib.util.module_from_spec( importlib.util.spec_from_loader( 'ssacl_cli', loader ) )
+    loader.exec_module( module )
+    return module
+
+
+def client_stdin( rfile ):
+    """
+    The rest of a request stream as the standard input of a command: text
+    on python 3, and the stream itself on python 2, as sys.stdin is.
+    """
+    if sys.version_info[0] < 3:
+       return rfile
+    return io.TextIOWrapper( rfile, encoding='utf-8', errors='surrogateescape' )
+
+
+def peer_uid( sock ):
+    """
+    :return: The uid of the process at the other end of a Unix socket, or
+             None where SO_PEERCRED is not available.
+    """
+    if not hasattr( socket, 'SO_PEERCRED' ):
+       return None
+    creds = sock.getsockopt( socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize( '3i' ) )
+    return struct.unpack( '3i', creds )[1]
+
+
+class reply_stream:
+      """
+      A file like object standing in for sys.stdout or sys.stderr while a
+      command runs. What is written is sent to the client as {key: text}
+      lines, a whole line or more at a time. Once the client is gone the
+      output is dropped and the command runs to its end.
+      """
+      def __init__( self, connection, key ):
+          self.connection = connection
+          self.key = key
+          self.pending = ''
+          self.lock = threading.Lock()
+
+
+      def write( self, text ):
+          with self.lock:
+             self.pending += text
+             if '\n' not in text:
+                return
+             idx = self.pending.rindex( '\n' ) + 1
+             ( text, self.pending ) = ( self.pending[0:idx], self.pending[idx:] )
+          self.connection.send( { self.key: text } )
+
+
+      def flush( self ):
+          with self.lock:
+             ( text, self.pending ) = ( self.pending, '' )
+          if text:
+             self.connection.send( { self.key: text } )
+
+
+      def isatty( self ):
+          return False
+
+
+class request_handler( socketserver.StreamRequestHandler ):
+      """
+      Runs the command line of one request with its output sent back.
+      """
+      def setup( self ):
+          socketserver.StreamRequestHandler.setup( self )
+          self.send_lock = threading.Lock()
+          self.gone = False
+
+
+      def finish( self ):
+          try:
+             socketserver.StreamRequestHandler.finish( self )
+          except ( IOError, OSError ):
+             pass
+
+
+      def send( self, reply ):
+          with self.send_lock:
+             if self.gone:
+                return
+             try:
+                self.wfile.write( ( json.dumps( reply ) + '\n' ).encode( 'utf-8' ) )
+                self.wfile.flush()
+             except ( IOError, OSError ):
+                self.gone = True
+
+
+      def handle( self ):
+          uid = peer_uid( self.request )
+          if uid != None and uid != 0 and uid != os.getuid():
+             self.send( { 'err': 'ERROR: uid %d may not use this server.\n' % ( uid ), 'rc': 1 } )
+             return
+
+          try:
+             request = json.loads( self.rfile.readline().decode( 'utf-8' ) )
+             argv = [ str( arg ) for arg in request['argv'] ]
+          except ( ValueError, KeyError, TypeError ):
+             self.send( { 'err': 'ERROR: Bad request.\n', 'rc': 1 } )
+             return
+
+          stdin = None
+          if request.get( 'stdin' ):
+             stdin = client_stdin( self.rfile )
+
+          start = time.time()
+          with RUN_LOCK:
+             rc = self.run( argv, request.get( 'cwd' ), stdin )
+             # While the lock is held sys.stderr is the server's own again;
+             # after it, it may be the next client's.
+             if self.server.verbose:
+                print("%s rc=%d %.1fms" % ( ' '.join( argv ), rc, ( time.time() - start ) * 1000 ), file=sys.stderr)
+          self.send( { 'rc': rc } )
+
+
+      def run( self, argv, cwd, stdin ):
+          """
+          Run a command line with the standard streams of the client.
+
+          :param: The command line.
+          :param: The working directory of the client.
+          :param: The client's standard input, from client_stdin(), or None.
+          :return: The exit status.
+          """
+          out = reply_stream( self, 'out' )
+          err = reply_stream( self, 'err' )
+          saved = ( sys.stdin, sys.stdout, sys.stderr, os.getcwd() )
+          ( sys.stdin, sys.stdout, sys.stderr ) = ( stdin or io.StringIO( u'' ), out, err )
+          try:
+             if cwd:
+                os.chdir( cwd )
+             rc = self.server.ssacl.run_command( argv )
+          except SystemExit as e:
+             if e.code == None or isinstance( e.code, int ):
+                rc = e.code or 0
+             else:
+                print( e.code, file=sys.stderr )
+                rc = 1
+          except OSError as e:
+             print("ERROR: %s" % ( e ), file=sys.stderr)
+             rc = 1
+          except Exception:
+             traceback.print_exc()
+             rc = 1
+          finally:
+             out.flush()
+             err.flush()
+             ( sys.stdin, sys.stdout, sys.stderr ) = saved[0:3]
+             os.chdir( saved[3] )
+             # Leave the request stream to finish(), not to the wrapper.
+             if stdin != None and hasattr( stdin, 'detach' ):
+                stdin.detach()
+          return rc
+
+
+class ssacl_server( socketserver.ThreadingMixIn, socketserver.UnixStreamServer ):
+      daemon_threads = True
+
+      def __init__( self, path, ssacl, verbose=False ):
+          self.ssacl = ssacl
+          self.verbose = verbose
+          old_umask = os.umask( 0o077 )
+          try:
+             socketserver.UnixStreamServer.__init__( self, path, request_handler )
+          finally:
+             os.umask( old_umask )
+
+
+def socket_in_use( path ):
+    """
+    :return: True if a server answers on path. A socket left behind by a
+             server that is gone is removed.
+    """
+    if not os.path.exists( path ):
+       return False
+    probe = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+    try:
+       probe.connect( path )
+       return True
+    except socket.error as e:
+       if e.errno != errno.ECONNREFUSED:
+          raise
+       os.unlink( path )
+       return False
+    finally:
+       probe.close()
+
+
+if __name__ == '__main__':
+   ( options, args ) = parse_options( sys.argv[1:] )
+
+   path = options.ssacl or find_ssacl()
+   if path == None or not os.path.isfile( path ):
+      print("ERROR: The ssacl script was not found, give it with --ssacl.")
+      sys.exit(1)
+
+   if socket_in_use( options.socket ):
+      print("ERROR: Socket: %s is in use by another server." % ( options.socket ))
+      sys.exit(1)
+
+   server = ssacl_server( options.socket, load_ssacl( path ), options.verbose )
+
+   def stop( signum, frame ):
+       raise KeyboardInterrupt()
+   signal.signal( signal.SIGTERM, stop )
+
+   if options.verbose:
+      print("Listening on %s" % ( options.socket ), file=sys.stderr)
+   try:
+      server.serve_forever()
+   except KeyboardInterrupt:
+      pass
+   finally:
+      server.server_close()
+      os.unlink( options.socket )